@@ -20,6 +20,8 @@ import multiprocessing
 
 import numpy as np
 
+import npz_row_index
+
 keys = [
     "binaryInputNCHWPacked",
     "globalInputNC",
@@ -53,25 +55,30 @@ def get_numpy_npz_headers(filename):
         return npzheaders
 
 
+# Returns (filename, num_rows, is_permanent), where is_permanent is False if the file could not be read for
+# a reason that may go away on a later run, so that its None should not be recorded in the row index
 def compute_num_rows(filename):
     try:
         npheaders = get_numpy_npz_headers(filename)
     except PermissionError:
         print("WARNING: No permissions for reading file: ", filename)
-        return (filename,None)
+        return (filename,None,False)
     except zipfile.BadZipFile:
         print("WARNING: Bad zip file: ", filename)
-        return (filename,None)
+        return (filename,None,True)
+    except OSError as e:
+        print("WARNING: Could not read file, skipping it for now: ", filename, str(e))
+        return (filename,None,False)
     if npheaders is None or len(npheaders) <= 0:
         print("WARNING: bad npz headers for file: ", filename)
-        return (filename,None)
+        return (filename,None,True)
 
     if "binaryInputNCHWPacked" in npheaders:
         (shape, is_fortran, dtype) = npheaders["binaryInputNCHWPacked"]
     else:
         (shape, is_fortran, dtype) = npheaders["binaryInputNCHWPacked.npy"]
     num_rows = shape[0]
-    return (filename,num_rows)
+    return (filename,num_rows,True)
 
 
 class TimeStuff(object):
@@ -149,6 +156,7 @@ if __name__ == '__main__':
     optional_args.add_argument('-window-factor', type=float, required=True, help='Switch window factor when there are too many new rows')
     optional_args.add_argument('-check-wait-seconds', type=int, required=True, help='How long to wait for next check')
     optional_args.add_argument('-summary-file', required=False, help='Summary json file for directory contents')
+    optional_args.add_argument('-row-index-file', required=False, help='Sqlite file caching the row count of each npz file by path and mtime, shared with other scripts, created if needed')
     required_args.add_argument('-record-file', required=True, help='Path to record last data rows number')
     
     required_args.add_argument('-num-processes', type=int, required=True, help='Number of multiprocessing processes for shuffling in parallel')
@@ -176,6 +184,7 @@ if __name__ == '__main__':
         add_to_data_rows = args.add_to_window_size
 
     summary_file = args.summary_file
+    row_index_file = args.row_index_file
     record_file = args.record_file
     num_processes = args.num_processes
     exclude = args.exclude
@@ -322,8 +331,9 @@ if __name__ == '__main__':
     
         with TimeStuff("Computing rows for unsummarized files"):
             with multiprocessing.Pool(num_processes) as pool:
-                results = pool.map(compute_num_rows,files_with_unknown_num_rows)
-                results = dict(results)
+                results = npz_row_index.compute_num_rows_using_index(
+                    row_index_file, [info for info in all_files if len(info) < 3], compute_num_rows, pool
+                )
                 for i in range(len(all_files)):
                     info = all_files[i]
                     if len(info) < 3:
@@ -37,6 +37,7 @@ echo "Beginning counting data at" $(date "+%Y-%m-%d %H:%M:%S")
          -window-factor 2.0 \
          -check-wait-seconds 120 \
          -record-file "../datanum_checkpoint.json.txt" \
+         -row-index-file "$BASEDIR"/selfplay_row_index.sqlite \
          "$@" \
          2>&1 | tee "$BASEDIR"/count_data.log &
 
@@ -1,5 +1,8 @@
 import logging
 import os
+import queue
+import threading
+import zipfile
 
 import numpy as np
 
@@ -8,6 +11,195 @@ import torch.nn.functional
 
 import modelconfigs
 
+def unpack_binary_input_numpy(binaryInputNCHWPacked, pos_len: int):
+    """Reference implementation: unpack N,C,ceil(HW/8) packed uint8 bits into an N,C,H,W float32 numpy array."""
+    binaryInputNCHW = np.unpackbits(binaryInputNCHWPacked,axis=2)
+    assert len(binaryInputNCHW.shape) == 3
+    assert binaryInputNCHW.shape[2] == ((pos_len * pos_len + 7) // 8) * 8
+    binaryInputNCHW = binaryInputNCHW[:,:,:pos_len*pos_len]
+    binaryInputNCHW = np.reshape(binaryInputNCHW, (
+        binaryInputNCHW.shape[0], binaryInputNCHW.shape[1], pos_len, pos_len
+    )).astype(np.float32)
+    return binaryInputNCHW
+
+def unpack_binary_input_torch(binaryInputNCHWPacked, pos_len: int):
+    """
+    Same as unpack_binary_input_numpy, but for a uint8 torch tensor, running on whatever device the tensor is on.
+    Bits are big-endian within each byte, matching np.unpackbits.
+    """
+    assert len(binaryInputNCHWPacked.shape) == 3
+    assert binaryInputNCHWPacked.dtype == torch.uint8
+    (n, c, num_bytes) = binaryInputNCHWPacked.shape
+    assert num_bytes == (pos_len * pos_len + 7) // 8
+    shifts = torch.arange(7, -1, -1, dtype=torch.uint8, device=binaryInputNCHWPacked.device)
+    bits = torch.bitwise_and(torch.bitwise_right_shift(binaryInputNCHWPacked.unsqueeze(-1), shifts), 1)
+    bits = bits.view(n, c, num_bytes * 8)[:,:,:pos_len*pos_len]
+    return bits.reshape(n, c, pos_len, pos_len).to(torch.float32)
+
+def rows_board_mask(binaryInputNCHW, start: int, end: int, pos_len: int, packed: bool):
+    """
+    The on-board mask, channel 0 of the binary inputs, of rows start:end as an N1HW bool tensor on the host,
+    read before the rows go to the device. See the full_board and board_bounds arguments of Model.forward.
+    """
+    if packed:
+        board_mask = np.unpackbits(binaryInputNCHW[start:end,0,:], axis=1, count=pos_len*pos_len).astype(bool)
+    else:
+        board_mask = binaryInputNCHW[start:end,0,:,:] == 1.0
+    return torch.from_numpy(board_mask.reshape(end-start, 1, pos_len, pos_len))
+
+def board_mask_bounds(board_mask):
+    """
+    Given an N1HW bool board mask, returns ((y0, y1, x0, x1), fills_bounds), where y0:y1, x0:x1 is the smallest box
+    containing every board in the batch, and fills_bounds is whether every board covers that whole box.
+    """
+    (n, _, h, w) = board_mask.shape
+    union_mask = board_mask.any(dim=0).view(h, w)
+    ys = torch.nonzero(union_mask.any(dim=1)).view(-1)
+    xs = torch.nonzero(union_mask.any(dim=0)).view(-1)
+    if len(ys) <= 0:
+        return ((0, h, 0, w), False)
+    bounds = (int(ys[0]), int(ys[-1]) + 1, int(xs[0]), int(xs[-1]) + 1)
+    fills_bounds = bool(board_mask[:, :, bounds[0]:bounds[1], bounds[2]:bounds[3]].all())
+    return (bounds, fills_bounds)
+
+
+def is_training_data_file(filename):
+    """True for files output by shuffle.py, either npz (compressed or not) or an npydir of raw .npy arrays"""
+    return filename.endswith(".npz") or filename.endswith(".npydir")
+
+def get_num_rows_of_training_file(npz_file):
+    """
+    Number of rows actually stored in a training data file, from its globalInputNC array header without loading anything.
+    This can be less than num_rows in shuffle.py's json, which counts rows before truncating to whole batches.
+    """
+    if os.path.isdir(npz_file):
+        return np.load(os.path.join(npz_file, "globalInputNC.npy"), mmap_mode="r").shape[0]
+    with zipfile.ZipFile(npz_file) as z:
+        with z.open("globalInputNC.npy") as f:
+            version = np.lib.format.read_magic(f)
+            if version == (1,0):
+                (shape, fortran_order, dtype) = np.lib.format.read_array_header_1_0(f)
+            else:
+                (shape, fortran_order, dtype) = np.lib.format.read_array_header_2_0(f)
+    return shape[0]
+
+def load_npz_training_file(
+    npz_file,
+    pos_len: int,
+    num_bin_features: int,
+    num_global_features: int,
+    unpack_on_device: bool,
+):
+    """
+    Load a single npz file of training rows into numpy arrays, ready for batching.
+
+    If npz_file is an npydir as written by shuffle.py -output-format npydir, the arrays are memory-mapped
+    instead, so that batches are read straight from the page cache with no decompression or whole-file copy.
+
+    If unpack_on_device, binary inputs are left packed as "binaryInputNCHWPacked" so that they can be unpacked
+    per batch after moving to the device, otherwise they are unpacked here into float32 "binaryInputNCHW".
+    Targets are left in their stored dtypes and are converted to float32 per batch.
+    """
+    if os.path.isdir(npz_file):
+        def load_key(key):
+            return np.load(os.path.join(npz_file, key + ".npy"), mmap_mode="r")
+        binaryInputNCHWPacked = load_key("binaryInputNCHWPacked")
+        globalInputNC = load_key("globalInputNC")
+        policyTargetsNCMove = load_key("policyTargetsNCMove")
+        globalTargetsNC = load_key("globalTargetsNC")
+        scoreDistrN = load_key("scoreDistrN")
+        valueTargetsNCHW = load_key("valueTargetsNCHW")
+    else:
+        with np.load(npz_file) as npz:
+            binaryInputNCHWPacked = npz["binaryInputNCHWPacked"]
+            globalInputNC = npz["globalInputNC"]
+            policyTargetsNCMove = npz["policyTargetsNCMove"]
+            globalTargetsNC = npz["globalTargetsNC"]
+            scoreDistrN = npz["scoreDistrN"]
+            valueTargetsNCHW = npz["valueTargetsNCHW"]
+        del npz
+
+    assert len(binaryInputNCHWPacked.shape) == 3
+    assert binaryInputNCHWPacked.shape[1] == num_bin_features
+    assert globalInputNC.shape[1] == num_global_features
+
+    data = dict(
+        globalInputNC = globalInputNC,
+        policyTargetsNCMove = policyTargetsNCMove,
+        globalTargetsNC = globalTargetsNC,
+        scoreDistrN = scoreDistrN,
+        valueTargetsNCHW = valueTargetsNCHW,
+    )
+    if unpack_on_device:
+        data["binaryInputNCHWPacked"] = binaryInputNCHWPacked
+    else:
+        data["binaryInputNCHW"] = unpack_binary_input_numpy(binaryInputNCHWPacked, pos_len)
+    return data
+
+
+def rows_to_device(array, start: int, end: int, device):
+    """torch.from_numpy(array[start:end]).to(device), copying only those rows first if array is a read-only memmap"""
+    rows = array[start:end]
+    if not rows.flags.writeable:
+        rows = np.array(rows)
+    return torch.from_numpy(rows).to(device)
+
+
+def prefetch_npz_training_files(npz_files, load_fn, num_prefetch_files: int):
+    """
+    Yields load_fn(npz_file) for each file in order, with up to num_prefetch_files files being loaded
+    ahead of time by a background thread so that decompression and unpacking overlap with training.
+
+    np.load decompression and most of the numpy unpacking and casting release the GIL, so a thread is
+    enough to keep the training thread from stalling at file boundaries.
+    If num_prefetch_files <= 0, loads everything synchronously on the calling thread instead.
+    """
+    if num_prefetch_files <= 0:
+        for npz_file in npz_files:
+            yield load_fn(npz_file)
+        return
+
+    loaded_queue = queue.Queue(maxsize=num_prefetch_files)
+    stop_event = threading.Event()
+    done = object()
+
+    def put_until_stopped(item):
+        while not stop_event.is_set():
+            try:
+                loaded_queue.put(item, timeout=1.0)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def worker():
+        try:
+            for npz_file in npz_files:
+                if stop_event.is_set():
+                    return
+                if not put_until_stopped(load_fn(npz_file)):
+                    return
+        except BaseException as e:
+            put_until_stopped(e)
+            return
+        put_until_stopped(done)
+
+    thread = threading.Thread(target=worker, name="npz_prefetch", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = loaded_queue.get()
+            if item is done:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        # If the consumer stops early, make sure the worker doesn't stay blocked on a full queue
+        stop_event.set()
+        thread.join()
+
+
 def read_npz_training_data(
     npz_files,
     batch_size: int,
@@ -15,59 +207,83 @@ def read_npz_training_data(
     rank: int,
     pos_len: int,
     device,
-    randomize_symmetries: bool,
+    randomize_symmetries,
     model_config: modelconfigs.ModelConfig,
+    num_prefetch_files: int = 2,
+    unpack_on_device: bool = True,
+    start_row: int = 0,
+    rand = None,
 ):
-    rand = np.random.default_rng(seed=list(os.urandom(12)))
+    """
+    Yields batches of training data from npz_files, striding batches across ranks.
+
+    randomize_symmetries:
+        False - no symmetries are applied.
+        True or "batch" - one random symmetry is applied to the whole batch.
+        "row" - every row in the batch gets its own random symmetry, applied by a single gather.
+    start_row: skip this many rows at the start of the first file, to resume partway through.
+    rand: np.random.Generator to draw symmetries from, by default a freshly seeded one.
+    """
+    assert randomize_symmetries in (False, True, "batch", "row"), f"Unknown randomize_symmetries: {randomize_symmetries}"
+    if rand is None:
+        rand = np.random.default_rng(seed=list(os.urandom(12)))
+    if randomize_symmetries == "row":
+        symmetry_gather_indices = get_symmetry_gather_indices(pos_len, device)
+        symmetry_gather_indices_policy = get_symmetry_gather_indices_policy(pos_len, device)
+        symmetry_gather_indices_host = get_symmetry_gather_indices(pos_len, "cpu")
     num_bin_features = modelconfigs.get_num_bin_input_features(model_config)
     num_global_features = modelconfigs.get_num_global_input_features(model_config)
 
-    for npz_file in npz_files:
-        with np.load(npz_file) as npz:
-            binaryInputNCHWPacked = npz["binaryInputNCHWPacked"]
-            globalInputNC = npz["globalInputNC"]
-            policyTargetsNCMove = npz["policyTargetsNCMove"].astype(np.float32)
-            globalTargetsNC = npz["globalTargetsNC"]
-            scoreDistrN = npz["scoreDistrN"].astype(np.float32)
-            valueTargetsNCHW = npz["valueTargetsNCHW"].astype(np.float32)
-        del npz
-
-        binaryInputNCHW = np.unpackbits(binaryInputNCHWPacked,axis=2)
-        assert len(binaryInputNCHW.shape) == 3
-        assert binaryInputNCHW.shape[2] == ((pos_len * pos_len + 7) // 8) * 8
-        binaryInputNCHW = binaryInputNCHW[:,:,:pos_len*pos_len]
-        binaryInputNCHW = np.reshape(binaryInputNCHW, (
-            binaryInputNCHW.shape[0], binaryInputNCHW.shape[1], pos_len, pos_len
-        )).astype(np.float32)
+    def load_fn(npz_file):
+        return load_npz_training_file(npz_file, pos_len, num_bin_features, num_global_features, unpack_on_device)
 
-        assert binaryInputNCHW.shape[1] == num_bin_features
-        assert globalInputNC.shape[1] == num_global_features
+    def yield_batches(data, num_whole_steps):
+        if unpack_on_device:
+            binaryInputNCHWPacked = data["binaryInputNCHWPacked"]
+        else:
+            binaryInputNCHW = data["binaryInputNCHW"]
+        globalInputNC = data["globalInputNC"]
+        policyTargetsNCMove = data["policyTargetsNCMove"]
+        globalTargetsNC = data["globalTargetsNC"]
+        scoreDistrN = data["scoreDistrN"]
+        valueTargetsNCHW = data["valueTargetsNCHW"]
 
-        num_samples = binaryInputNCHW.shape[0]
-        # Just discard stuff that doesn't divide evenly
-        num_whole_steps = num_samples // (batch_size * world_size)
-
-        #logging.info(f"Beginning {npz_file} with {num_whole_steps * world_size} usable batches, my rank is {rank}")
         for n in range(num_whole_steps):
             start = (n * world_size + rank) * batch_size
             end = start + batch_size
 
-            batch_binaryInputNCHW = torch.from_numpy(binaryInputNCHW[start:end]).to(device)
-            batch_globalInputNC = torch.from_numpy(globalInputNC[start:end]).to(device)
-            batch_policyTargetsNCMove = torch.from_numpy(policyTargetsNCMove[start:end]).to(device)
-            batch_globalTargetsNC = torch.from_numpy(globalTargetsNC[start:end]).to(device)
-            batch_scoreDistrN = torch.from_numpy(scoreDistrN[start:end]).to(device)
-            batch_valueTargetsNCHW = torch.from_numpy(valueTargetsNCHW[start:end]).to(device)
+            if unpack_on_device:
+                batch_board_mask = rows_board_mask(binaryInputNCHWPacked, start, end, pos_len, packed=True)
+                # Move only the packed bits and expand them on the device, 32x less data to transfer than float32
+                batch_binaryInputNCHWPacked = rows_to_device(binaryInputNCHWPacked, start, end, device)
+                batch_binaryInputNCHW = unpack_binary_input_torch(batch_binaryInputNCHWPacked, pos_len)
+            else:
+                batch_board_mask = rows_board_mask(binaryInputNCHW, start, end, pos_len, packed=False)
+                batch_binaryInputNCHW = rows_to_device(binaryInputNCHW, start, end, device)
+            batch_globalInputNC = rows_to_device(globalInputNC, start, end, device)
+            batch_policyTargetsNCMove = rows_to_device(policyTargetsNCMove, start, end, device).to(torch.float32)
+            batch_globalTargetsNC = rows_to_device(globalTargetsNC, start, end, device)
+            batch_scoreDistrN = rows_to_device(scoreDistrN, start, end, device).to(torch.float32)
+            batch_valueTargetsNCHW = rows_to_device(valueTargetsNCHW, start, end, device).to(torch.float32)
 
 
-            if randomize_symmetries:
+            if randomize_symmetries == "row":
+                host_symms = torch.from_numpy(rand.integers(0,8,size=[batch_size]))
+                symms = host_symms.to(device)
+                batch_board_mask = apply_symmetry_per_row(batch_board_mask, host_symms, symmetry_gather_indices_host)
+                batch_binaryInputNCHW = apply_symmetry_per_row(batch_binaryInputNCHW, symms, symmetry_gather_indices)
+                batch_policyTargetsNCMove = apply_symmetry_per_row(batch_policyTargetsNCMove, symms, symmetry_gather_indices_policy)
+                batch_valueTargetsNCHW = apply_symmetry_per_row(batch_valueTargetsNCHW, symms, symmetry_gather_indices)
+            elif randomize_symmetries:
                 symm = int(rand.integers(0,8))
+                batch_board_mask = apply_symmetry(batch_board_mask, symm)
                 batch_binaryInputNCHW = apply_symmetry(batch_binaryInputNCHW, symm)
                 batch_policyTargetsNCMove = apply_symmetry_policy(batch_policyTargetsNCMove, symm, pos_len)
                 batch_valueTargetsNCHW = apply_symmetry(batch_valueTargetsNCHW, symm)
             batch_binaryInputNCHW = batch_binaryInputNCHW.contiguous()
             batch_policyTargetsNCMove = batch_policyTargetsNCMove.contiguous()
             batch_valueTargetsNCHW = batch_valueTargetsNCHW.contiguous()
+            (batch_board_bounds, batch_fills_board_bounds) = board_mask_bounds(batch_board_mask)
 
             batch = dict(
                 binaryInputNCHW = batch_binaryInputNCHW,
@@ -76,9 +292,49 @@ def read_npz_training_data(
                 globalTargetsNC = batch_globalTargetsNC,
                 scoreDistrN = batch_scoreDistrN,
                 valueTargetsNCHW = batch_valueTargetsNCHW,
+                # Hints for Model.forward, computed on the host so that using them doesn't wait on the device
+                fullBoard = bool(batch_board_mask.all()),
+                boardBounds = batch_board_bounds,
+                fullBoardBounds = batch_fills_board_bounds,
             )
             yield batch
 
+    global_batch_size = batch_size * world_size
+    # Rows at the end of a file that didn't fill a whole global batch, joined with the start of the next file.
+    # Only the rows left over after the very last file are discarded.
+    carry = None
+    num_carry_rows = 0
+    for data in prefetch_npz_training_files(npz_files, load_fn, num_prefetch_files):
+        if start_row > 0:
+            data = {key: value[start_row:] for key, value in data.items()}
+            start_row = 0
+        num_samples = data["globalInputNC"].shape[0]
+
+        if carry is not None:
+            num_needed = global_batch_size - num_carry_rows
+            if num_samples < num_needed:
+                carry = {key: np.concatenate((carry[key], data[key])) for key in carry}
+                num_carry_rows += num_samples
+                continue
+            joined = {key: np.concatenate((carry[key], data[key][:num_needed])) for key in carry}
+            carry = None
+            num_carry_rows = 0
+            yield from yield_batches(joined, 1)
+            del joined
+            data = {key: value[num_needed:] for key, value in data.items()}
+            num_samples -= num_needed
+
+        num_whole_steps = num_samples // global_batch_size
+        #logging.info(f"Beginning file with {num_whole_steps * world_size} usable batches, my rank is {rank}")
+        yield from yield_batches(data, num_whole_steps)
+
+        num_leftover = num_samples - num_whole_steps * global_batch_size
+        if num_leftover > 0:
+            # Copy so that we don't keep the whole file alive just for its tail
+            carry = {key: value[num_samples-num_leftover:].copy() for key, value in data.items()}
+            num_carry_rows = num_leftover
+        del data
+
 
 def apply_symmetry_policy(tensor, symm, pos_len):
     """Same as apply_symmetry but also handles the pass index"""
@@ -120,3 +376,33 @@ def apply_symmetry(tensor, symm):
     if symm == 7:
         return tensor.flip(-2)
 
+def get_symmetry_gather_indices(pos_len, device):
+    """
+    Returns an int64 tensor of shape (8, pos_len*pos_len) such that for a flattened (..., pos_len*pos_len) tensor x,
+    x[..., indices[symm]] is the flattening of apply_symmetry(x viewed as (..., pos_len, pos_len), symm).
+    """
+    positions = torch.arange(pos_len*pos_len, dtype=torch.int64).view(pos_len, pos_len)
+    return torch.stack([apply_symmetry(positions, symm).reshape(pos_len*pos_len) for symm in range(8)]).to(device)
+
+def get_symmetry_gather_indices_policy(pos_len, device):
+    """Same as get_symmetry_gather_indices but also maps the pass index at the end to itself"""
+    indices = get_symmetry_gather_indices(pos_len, device)
+    pass_indices = torch.full((8,1), pos_len*pos_len, dtype=torch.int64, device=device)
+    return torch.cat((indices, pass_indices), dim=1)
+
+def apply_symmetry_per_row(tensor, symms, gather_indices):
+    """
+    Apply a possibly different symmetry operation to each row of the given tensor.
+
+    Args:
+        tensor (torch.Tensor): Tensor to be transformed. (N, C, W, W) for spatial tensors, or (N, C, W*W+1)
+            for policy tensors with a pass index at the end.
+        symms (torch.Tensor): (N,) int64 tensor of symmetries to apply to each row, as in apply_symmetry.
+        gather_indices (torch.Tensor): from get_symmetry_gather_indices, or get_symmetry_gather_indices_policy
+            for policy tensors.
+    """
+    n = tensor.shape[0]
+    c = tensor.shape[1]
+    num_positions = gather_indices.shape[1]
+    indices = gather_indices[symms].view(n, 1, num_positions).expand(n, c, num_positions)
+    return torch.gather(tensor.reshape(n, c, num_positions), 2, indices).view(tensor.shape)
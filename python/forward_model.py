@@ -21,6 +21,7 @@ from model_pytorch import Model
 from metrics_pytorch import Metrics
 import data_processing_pytorch
 from load_model import load_model
+from fuse_model import fuse_model_for_inference
 
 # HANDLE COMMAND AND ARGS -------------------------------------------------------------------
 
@@ -80,15 +81,10 @@ def main(args):
 
     batch = np.load(npz_file)
 
+    inference_model = fuse_model_for_inference(swa_model.module if swa_model is not None else model)
+
     with torch.no_grad():
-        model.eval()
-        if swa_model is not None:
-            swa_model.eval()
-
-        if swa_model is not None:
-            model_outputs = swa_model(torch.tensor(batch["binaryInputNCHW"],device=device),torch.tensor(batch["globalInputNC"],device=device))
-        else:
-            model_outputs = model(torch.tensor(batch["binaryInputNCHW"],device=device),torch.tensor(batch["globalInputNC"],device=device))
+        model_outputs = inference_model(torch.tensor(batch["binaryInputNCHW"],device=device),torch.tensor(batch["globalInputNC"],device=device))
 
         postprocessed = model.postprocess_output(model_outputs)
 
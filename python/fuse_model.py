@@ -0,0 +1,180 @@
+import copy
+from typing import Optional, Tuple
+
+import torch
+import torch.nn
+
+from model_pytorch import (
+    Model,
+    NormMask,
+    BiasMask,
+    AffineMask,
+    NormActConv,
+    KataConvAndGPool,
+    KataConvAndAttentionPool,
+    ResBlock,
+    BottleneckResBlock,
+    NestedBottleneckResBlock,
+    NestedNestedBottleneckResBlock,
+    PolicyHead,
+    ValueHead,
+)
+
+def fuse_model_for_inference(model: Model) -> Model:
+    """
+    Return an eval-only copy of model that computes the same outputs with fewer ops, leaving model untouched.
+    * The conv1x1 branch of repvgg-linear NormActConvs is merged into the center of the 3x3 kernel.
+    * Every NormMask and BiasMask is reduced to its eval-mode per-channel affine transform, which is folded into
+      the weights and bias of the convolution that directly precedes it where nothing else reads that convolution's
+      output. What remains of the layer is just the mask multiply, since convolutions spill outside the board.
+    * Norms that read the residual trunk can't be folded, those become a precomputed AffineMask.
+    The result must not be trained, and no longer supports add_reg_dict or the brenorm methods.
+    """
+    fused = copy.deepcopy(model)
+    fused.eval()
+    fused.requires_grad_(False)
+    with torch.no_grad():
+        for module in fused.modules():
+            if isinstance(module, NormActConv):
+                merge_conv1x1(module)
+
+        for block in fused.blocks:
+            fuse_block(block)
+        fuse_policy_head(fused.policy_head)
+        fuse_value_head(fused.value_head)
+        if fused.has_intermediate_head:
+            fuse_policy_head(fused.intermediate_policy_head)
+            fuse_value_head(fused.intermediate_value_head)
+
+        replace_remaining_norms(fused)
+    return fused
+
+
+def merge_conv1x1(normactconv: NormActConv):
+    if normactconv.conv1x1 is None:
+        return
+    conv = normactconv.conv
+    # Torch conv order is oc,ic,h,w, add the 1x1 conv to the center of the h,w
+    h,w = (conv.weight.shape[2],conv.weight.shape[3])
+    assert h % 2 == 1, "Conv1x1 can't be merged with even-sized convolution kernel"
+    assert w % 2 == 1, "Conv1x1 can't be merged with even-sized convolution kernel"
+    assert conv.bias is None
+    assert normactconv.conv1x1.bias is None
+    conv.weight[:,:,h//2:h//2+1,w//2:w//2+1] += normactconv.conv1x1.weight
+    normactconv.conv1x1 = None
+
+
+def norm_affine(norm) -> Tuple[Optional[torch.Tensor], torch.Tensor]:
+    """Return (weight, bias) such that norm(x) == (x * weight + bias) * mask in eval mode, weight None meaning 1"""
+    c_in = norm.c_in
+    weight = None
+    if isinstance(norm, NormMask):
+        if norm.gamma is not None:
+            weight = norm.gamma.view(c_in)
+        if norm.scale is not None:
+            weight = norm.scale * (weight if weight is not None else torch.ones_like(norm.beta.view(c_in)))
+        bias = norm.beta.view(c_in)
+        if norm.is_using_batchnorm:
+            inv_std = 1.0 / norm.running_std
+            weight = inv_std if weight is None else weight * inv_std
+            bias = bias - norm.running_mean * weight
+    elif isinstance(norm, BiasMask):
+        if norm.scale is not None:
+            weight = norm.scale * torch.ones_like(norm.beta.view(c_in))
+        bias = norm.beta.view(c_in)
+    else:
+        assert False, f"Cannot compute affine transform of {type(norm)}"
+    return (weight, bias)
+
+
+def fold_into_conv(conv: torch.nn.Conv2d, weight: Optional[torch.Tensor], bias: Optional[torch.Tensor]):
+    if weight is not None:
+        conv.weight.mul_(weight.view(-1,1,1,1))
+        if conv.bias is not None:
+            conv.bias.mul_(weight)
+    if bias is not None:
+        if conv.bias is None:
+            conv.bias = torch.nn.Parameter(bias.detach().clone(), requires_grad=False)
+        else:
+            conv.bias.add_(bias)
+
+
+def fold_into_linear(linear: torch.nn.Linear, weight: Optional[torch.Tensor]):
+    assert linear.bias is None
+    if weight is not None:
+        linear.weight.mul_(weight.view(-1,1))
+
+
+def fold_into_normactconv(normactconv: NormActConv, weight: Optional[torch.Tensor], bias: Optional[torch.Tensor]):
+    """Fold an affine transform of the output of normactconv into its final convolutions"""
+    assert normactconv.conv1x1 is None
+    if normactconv.convpool is None:
+        fold_into_conv(normactconv.conv, weight, bias)
+    elif isinstance(normactconv.convpool, KataConvAndGPool):
+        # Output is conv1r(x) + linear_g(pooled), broadcast over the board
+        fold_into_conv(normactconv.convpool.conv1r, weight, bias)
+        fold_into_linear(normactconv.convpool.linear_g, weight)
+    elif isinstance(normactconv.convpool, KataConvAndAttentionPool):
+        # Output is conv1r(x) + conv_mix(pooled)
+        fold_into_conv(normactconv.convpool.conv1r, weight, bias)
+        fold_into_conv(normactconv.convpool.conv_mix, weight, None)
+    else:
+        assert False
+
+
+def fold_norm_into(module, norm_name: str, fold_fn):
+    """Fold module.<norm_name> into the preceding op by calling fold_fn(weight, bias), then replace it with the bare mask"""
+    norm = getattr(module, norm_name)
+    (weight, bias) = norm_affine(norm)
+    fold_fn(weight, bias)
+    setattr(module, norm_name, AffineMask(norm.c_in, None, None))
+
+
+def fold_normactconv_chain(normactconvs):
+    """Fold the norm of each NormActConv into the previous one, for NormActConvs applied directly one after another"""
+    for (prev, cur) in zip(normactconvs[:-1], normactconvs[1:]):
+        fold_norm_into(cur, "norm", lambda weight, bias: fold_into_normactconv(prev, weight, bias))
+
+
+def fuse_convpools(module):
+    for submodule in list(module.modules()):
+        if isinstance(submodule, (KataConvAndGPool, KataConvAndAttentionPool)):
+            fold_norm_into(submodule, "normg", lambda weight, bias: fold_into_conv(submodule.conv1g, weight, bias))
+
+
+def fuse_block(block):
+    # The first norm of every block reads the residual trunk and the last NormActConv feeds the residual sum,
+    # so only the norms between NormActConvs of the same block can be folded.
+    if isinstance(block, ResBlock):
+        fuse_convpools(block)
+        fold_normactconv_chain([block.normactconv1, block.normactconv2])
+    elif isinstance(block, BottleneckResBlock):
+        fuse_convpools(block)
+        fold_normactconv_chain([block.normactconvp] + list(block.normactconvstack) + [block.normactconvq])
+    elif isinstance(block, (NestedBottleneckResBlock, NestedNestedBottleneckResBlock)):
+        for subblock in block.blockstack:
+            fuse_block(subblock)
+    else:
+        assert False, f"Unknown block type: {type(block)}"
+
+
+def fuse_policy_head(head: PolicyHead):
+    fold_norm_into(head, "biasg", lambda weight, bias: fold_into_conv(head.conv1g, weight, bias))
+    # bias2 reads conv1p(x) + linear_g(pooled)
+    def fold_bias2(weight, bias):
+        fold_into_conv(head.conv1p, weight, bias)
+        fold_into_linear(head.linear_g, weight)
+    fold_norm_into(head, "bias2", fold_bias2)
+
+
+def fuse_value_head(head: ValueHead):
+    fold_norm_into(head, "bias1", lambda weight, bias: fold_into_conv(head.conv1, weight, bias))
+
+
+def replace_remaining_norms(module):
+    for (name, child) in module.named_children():
+        if isinstance(child, (NormMask, BiasMask)):
+            (weight, bias) = norm_affine(child)
+            setattr(module, name, AffineMask(child.c_in, weight, bias))
+        else:
+            replace_remaining_norms(child)
@@ -130,7 +130,7 @@ class Metrics:
         return 0.25 * global_weight * weight * loss
 
 
-    def loss_seki_samplewise(self, pred_logits, target, target_ownership, weight, mask, mask_sum_hw, global_weight, is_training, skip_moving_update):
+    def loss_seki_samplewise(self, pred_logits, target, target_ownership, weight, mask, mask_sum_hw, global_weight, is_training, skip_moving_update, moving_update_fraction):
         assert self.num_seki_logits == 4
         assert pred_logits.shape == (self.n, self.num_seki_logits, self.pos_len, self.pos_len)
         assert target.shape == (self.n, self.pos_len, self.pos_len)
@@ -144,10 +144,13 @@ class Metrics:
         unowned_proportion = torch.mean(unowned_proportion * weight)
         if is_training:
             if not skip_moving_update:
-                self.moving_unowned_proportion_sum *= 0.998
-                self.moving_unowned_proportion_weight *= 0.998
-                self.moving_unowned_proportion_sum += unowned_proportion.item()
-                self.moving_unowned_proportion_weight += 1.0
+                # The sum becomes a tensor on the device so that updating it never waits on the device.
+                # The weight doesn't depend on the data, so it stays a float.
+                # A batch that is only a fraction of an optimizer step counts for that fraction of an update,
+                # so that the average decays at the same rate per step however the step is split into micro-batches.
+                decay = 0.998 ** moving_update_fraction
+                self.moving_unowned_proportion_sum = self.moving_unowned_proportion_sum * decay + moving_update_fraction * unowned_proportion.detach()
+                self.moving_unowned_proportion_weight = self.moving_unowned_proportion_weight * decay + moving_update_fraction
             moving_unowned_proportion = self.moving_unowned_proportion_sum / self.moving_unowned_proportion_weight
             seki_weight_scale = 8.0 * 0.005 / (0.005 + moving_unowned_proportion)
         else:
@@ -369,6 +372,7 @@ class Metrics:
         td_value_loss_scales,
         main_loss_scale,
         intermediate_loss_scale,
+        moving_update_fraction=1.0,
     ):
         results = self.metrics_dict_batchwise_single_heads_output(
             raw_model,
@@ -378,7 +382,8 @@ class Metrics:
             soft_policy_weight_scale=soft_policy_weight_scale,
             value_loss_scale=value_loss_scale,
             td_value_loss_scales=td_value_loss_scales,
-            is_intermediate=False
+            is_intermediate=False,
+            moving_update_fraction=moving_update_fraction,
         )
         if main_loss_scale is not None:
             results["loss_sum"] = main_loss_scale * results["loss_sum"]
@@ -400,7 +405,8 @@ class Metrics:
                     soft_policy_weight_scale=soft_policy_weight_scale,
                     value_loss_scale=value_loss_scale,
                     td_value_loss_scales=td_value_loss_scales,
-                    is_intermediate=True
+                    is_intermediate=True,
+                    moving_update_fraction=moving_update_fraction,
                 )
                 for key,value in iresults.items():
                     if key != "loss_sum":
@@ -420,6 +426,7 @@ class Metrics:
         value_loss_scale,
         td_value_loss_scales,
         is_intermediate,
+        moving_update_fraction,
     ):
         (
             policy_logits,
@@ -652,6 +659,7 @@ class Metrics:
             global_weight,
             is_training,
             skip_moving_update=is_intermediate,
+            moving_update_fraction=moving_update_fraction,
         )
         loss_seki = loss_seki.sum()
         seki_weight_scale = seki_weight_scale.sum() if not isinstance(seki_weight_scale,float) else seki_weight_scale
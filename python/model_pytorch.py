@@ -1,16 +1,23 @@
 import math
+import collections
+import contextlib
 import numpy as np
 import torch
 import torch.nn
 import torch.nn.functional
 import torch.nn.init
+import torch.utils.checkpoint
 import packaging
 import packaging.version
-from typing import List, Dict, Optional
+from typing import AbstractSet, List, Dict, Optional, Tuple
 
 import modelconfigs
 
 EXTRA_SCORE_DISTR_RADIUS = 60
+# KataConvAndAttentionPool computes its src x dst attention matrix in chunks of dst points of at most about this many elements
+ATTENTION_POOL_CHUNK_ELEMENTS = 1 << 24
+# The raw outputs of each head, in the order Model.forward returns them
+MODEL_OUTPUT_NAMES = ("policy", "value", "miscvalue", "moremiscvalue", "ownership", "scoring", "futurepos", "seki", "scorebelief")
 
 def act(activation, inplace=False):
     if activation == "relu":
@@ -87,6 +94,12 @@ class SoftPlusWithGradientFloorFunction(torch.autograd.Function):
             grad_x = grad_output * (grad_floor + (1.0 - grad_floor) / (1.0 + torch.exp(-x)))
         return grad_x, grad_grad_floor, grad_square
 
+def apply_mask(x, mask):
+    """x * mask, where mask None means every board in the batch covers the full pos_len x pos_len, see Model.forward"""
+    if mask is None:
+        return x
+    return x * mask
+
 class BiasMask(torch.nn.Module):
     def __init__(
         self,
@@ -125,9 +138,36 @@ class BiasMask(torch.nn.Module):
         Returns: NCHW
         """
         if self.scale is not None:
-            return (x * self.scale + self.beta) * mask
+            return apply_mask(x * self.scale + self.beta, mask)
         else:
-            return (x + self.beta) * mask
+            return apply_mask(x + self.beta, mask)
+
+class AffineMask(torch.nn.Module):
+    def __init__(self, c_in, weight: Optional[torch.Tensor], bias: Optional[torch.Tensor]):
+        """Inference-only stand-in for a NormMask or BiasMask in eval mode, see fuse_model.py.
+
+        weight and bias are per-channel tensors of shape C or None. If both are None, the normalization
+        was folded into the preceding convolution and only the masking remains.
+        """
+        super(AffineMask, self).__init__()
+        self.c_in = c_in
+        self.register_buffer("weight", None if weight is None else weight.detach().clone().view(1, c_in, 1, 1))
+        self.register_buffer("bias", None if bias is None else bias.detach().clone().view(1, c_in, 1, 1))
+
+    def forward(self, x, mask, mask_sum: float):
+        """
+        Parameters:
+        x: NCHW
+        mask: N1HW
+        mask_sum: scalar
+
+        Returns: NCHW
+        """
+        if self.weight is not None:
+            x = x * self.weight
+        if self.bias is not None:
+            x = x + self.bias
+        return apply_mask(x, mask)
 
 
 class NormMask(torch.nn.Module):
@@ -164,6 +204,13 @@ class NormMask(torch.nn.Module):
         )
         self.c_in = c_in
 
+        # Set by Model.run_trunk_block while the enclosing block runs under activation checkpointing.
+        # "forward" for the original pass, "recompute" when backward reruns it, None otherwise.
+        # The recompute must not update running statistics again, and reuses the batch renorm r and d of the original pass,
+        # which are passed along in checkpoint_renorm_stash, a deque belonging to that one checkpointed call.
+        self.checkpoint_phase = None
+        self.checkpoint_renorm_stash = None
+
         self.scale = None
         self.gamma = None
         if self.norm_kind == "bnorm" or (self.norm_kind == "fixscaleonenorm" and self.is_last_batchnorm):
@@ -238,24 +285,24 @@ class NormMask(torch.nn.Module):
     def _compute_bnorm_values(self, x, mask, mask_sum: float):
         # This is the mean, computed only over exactly the areas of the mask, weighting each spot equally,
         # even across different elements in the batch that might have different board sizes.
-        mean = torch.sum(x * mask, dim=(0,2,3),keepdim=True) / mask_sum
+        mean = torch.sum(apply_mask(x, mask), dim=(0,2,3),keepdim=True) / mask_sum
         zeromean_x = x - mean
         # Similarly, the variance computed exactly only over those spots
-        var = torch.sum(torch.square(zeromean_x * mask),dim=(0,2,3),keepdim=True) / mask_sum
+        var = torch.sum(torch.square(apply_mask(zeromean_x, mask)),dim=(0,2,3),keepdim=True) / mask_sum
         std = torch.sqrt(var + self.epsilon)
         return zeromean_x, mean, std
 
     def apply_gamma_beta_scale_mask(self, x, mask):
         if self.scale is not None:
             if self.gamma is not None:
-                return (x * (self.gamma * self.scale) + self.beta) * mask
+                return apply_mask(x * (self.gamma * self.scale) + self.beta, mask)
             else:
-                return (x * self.scale + self.beta) * mask
+                return apply_mask(x * self.scale + self.beta, mask)
         else:
             if self.gamma is not None:
-                return (x * self.gamma + self.beta) * mask
+                return apply_mask(x * self.gamma + self.beta, mask)
             else:
-                return (x + self.beta) * mask
+                return apply_mask(x + self.beta, mask)
 
 
     def forward(self, x, mask, mask_sum: float):
@@ -275,9 +322,10 @@ class NormMask(torch.nn.Module):
 
                 detached_mean = mean.view(self.c_in).detach()
                 detached_std = std.view(self.c_in).detach()
-                with torch.no_grad():
-                    self.running_mean += self.running_avg_momentum * (detached_mean - self.running_mean)
-                    self.running_std += self.running_avg_momentum * (detached_std - self.running_std)
+                if self.checkpoint_phase != "recompute":
+                    with torch.no_grad():
+                        self.running_mean += self.running_avg_momentum * (detached_mean - self.running_mean)
+                        self.running_std += self.running_avg_momentum * (detached_std - self.running_std)
 
                 return self.apply_gamma_beta_scale_mask(zeromean_x / std, mask)
             else:
@@ -290,23 +338,28 @@ class NormMask(torch.nn.Module):
 
                 detached_mean = mean.view(self.c_in).detach()
                 detached_std = std.view(self.c_in).detach()
-                with torch.no_grad():
-                    unclipped_r = detached_std / self.renorm_running_std
-                    unclipped_d = (detached_mean - self.renorm_running_mean) / self.renorm_running_std
-                    r = unclipped_r.clamp(1.0 / self.rmax, self.rmax)
-                    d = unclipped_d.clamp(-self.dmax, self.dmax)
-
-                    self.renorm_running_mean += self.renorm_avg_momentum * (detached_mean - self.renorm_running_mean)
-                    self.renorm_running_std += self.renorm_avg_momentum * (detached_std - self.renorm_running_std)
-                    self.running_mean += self.running_avg_momentum * (detached_mean - self.running_mean)
-                    self.running_std += self.running_avg_momentum * (detached_std - self.running_std)
-
-                    upper_rclippage = torch.mean(torch.nn.functional.relu(torch.log(unclipped_r / r)))
-                    lower_rclippage = torch.mean(torch.nn.functional.relu(-torch.log(unclipped_r / r)))
-                    dclippage = torch.mean(torch.abs(unclipped_d - d))
-                    self.renorm_upper_rclippage += 0.01 * (upper_rclippage - self.renorm_upper_rclippage)
-                    self.renorm_lower_rclippage += 0.01 * (lower_rclippage - self.renorm_lower_rclippage)
-                    self.renorm_dclippage += 0.01 * (dclippage - self.renorm_dclippage)
+                if self.checkpoint_phase == "recompute":
+                    (r, d) = self.checkpoint_renorm_stash.popleft()
+                else:
+                    with torch.no_grad():
+                        unclipped_r = detached_std / self.renorm_running_std
+                        unclipped_d = (detached_mean - self.renorm_running_mean) / self.renorm_running_std
+                        r = unclipped_r.clamp(1.0 / self.rmax, self.rmax)
+                        d = unclipped_d.clamp(-self.dmax, self.dmax)
+
+                        self.renorm_running_mean += self.renorm_avg_momentum * (detached_mean - self.renorm_running_mean)
+                        self.renorm_running_std += self.renorm_avg_momentum * (detached_std - self.renorm_running_std)
+                        self.running_mean += self.running_avg_momentum * (detached_mean - self.running_mean)
+                        self.running_std += self.running_avg_momentum * (detached_std - self.running_std)
+
+                        upper_rclippage = torch.mean(torch.nn.functional.relu(torch.log(unclipped_r / r)))
+                        lower_rclippage = torch.mean(torch.nn.functional.relu(-torch.log(unclipped_r / r)))
+                        dclippage = torch.mean(torch.abs(unclipped_d - d))
+                        self.renorm_upper_rclippage += 0.01 * (upper_rclippage - self.renorm_upper_rclippage)
+                        self.renorm_lower_rclippage += 0.01 * (lower_rclippage - self.renorm_lower_rclippage)
+                        self.renorm_dclippage += 0.01 * (dclippage - self.renorm_dclippage)
+                    if self.checkpoint_phase == "forward":
+                        self.checkpoint_renorm_stash.append((r, d))
 
                 if self.rmax > 1.00000001 or self.dmax > 0.00000001:
                     return self.apply_gamma_beta_scale_mask(zeromean_x / std * r.detach().view(1,self.c_in,1,1) + d.detach().view(1,self.c_in,1,1), mask)
@@ -341,7 +394,9 @@ class KataGPool(torch.nn.Module):
         layer_mean = torch.sum(x, dim=(2, 3), keepdim=True, dtype=torch.float32) / mask_sum_hw
         # All activation functions we use right now are always greater than -1.0, and map 0 -> 0.
         # So off-board areas will equal 0, and then this max is mask-safe if we assign -1.0 to off-board areas.
-        (layer_max,_argmax) = torch.max((x+(mask-1.0)).view(x.shape[0],x.shape[1],-1).to(torch.float32), dim=2)
+        if mask is not None:
+            x = x + (mask - 1.0)
+        (layer_max,_argmax) = torch.max(x.view(x.shape[0],x.shape[1],-1).to(torch.float32), dim=2)
         layer_max = layer_max.view(x.shape[0],x.shape[1],1,1)
 
         out_pool1 = layer_mean
@@ -462,6 +517,7 @@ class KataConvAndAttentionPool(torch.nn.Module):
         )
         self.actg = act(activation, inplace=True)
         self.conv_mix = torch.nn.Conv2d(c_gpool*2, c_out, kernel_size=1, padding="same", bias=False)
+        self.chunk_elements = ATTENTION_POOL_CHUNK_ELEMENTS
 
     def initialize(self, scale):
         # Scaling so that variance on the r and g branches adds up to 1.0
@@ -513,26 +569,58 @@ class KataConvAndAttentionPool(torch.nn.Module):
         outg = self.conv1g(out)
         outk = self.conv1k(out).view(n*self.c_apheads, self.c_gpool//self.c_apheads, h*w)
         outq = self.conv1q(out).view(n*self.c_apheads, self.c_gpool//self.c_apheads, h*w)
-        attention_logits = torch.bmm(torch.transpose(outk,1,2), outq) # n*heads, src h*w, dst h*w
-        attention_logits = attention_logits.view(n, self.c_apheads, h*w, h*w)
-        attention_logits = attention_logits - (1.0 - mask.view(n,1,h*w,1)) * 6000.0
-        attention_logits = attention_logits.view(n * self.c_apheads, h*w, h*w)
-        attention = torch.nn.functional.softmax(attention_logits, dim=1)
-        attention_scale = 0.1 / torch.sqrt(torch.sum(torch.square(attention), dim=1, keepdim=True)) # n*heads, 1, h*w
 
         outg = self.normg(outg, mask=mask, mask_sum=mask_sum)
         outg = self.actg(outg).view(n*self.c_apheads, self.c_gpool//self.c_apheads, h*w)
 
-        out_pool1 = torch.bmm(outg, attention)
-        out_pool2 = out_pool1 * attention_scale
+        # The full attention matrix is quadratic in board area, so go through it a chunk of dst points at a time.
+        # While training, each chunk is recomputed during backward so that only one chunk of it is ever in memory.
+        chunk_size = max(1, min(h*w, self.chunk_elements // (n * self.c_apheads * h*w)))
+        if chunk_size >= h*w:
+            (out_pool1, out_pool2) = self.attention_pool_chunk(outk, outq, outg, mask)
+        else:
+            pool_chunks = []
+            for start in range(0, h*w, chunk_size):
+                outq_chunk = outq[:, :, start:start+chunk_size]
+                if self.training and torch.is_grad_enabled():
+                    pool_chunks.append(torch.utils.checkpoint.checkpoint(self.attention_pool_chunk, outk, outq_chunk, outg, mask, use_reentrant=False))
+                else:
+                    pool_chunks.append(self.attention_pool_chunk(outk, outq_chunk, outg, mask))
+            out_pool1 = torch.cat([pool_chunk[0] for pool_chunk in pool_chunks], dim=2)
+            out_pool2 = torch.cat([pool_chunk[1] for pool_chunk in pool_chunks], dim=2)
         out_pool1 = out_pool1.view(n, self.c_gpool, h*w)
         out_pool2 = out_pool2.view(n, self.c_gpool, h*w)
 
-        outg = torch.cat((out_pool1, out_pool2), dim=1).view(n, 2 * self.c_gpool, h, w) * mask
+        outg = apply_mask(torch.cat((out_pool1, out_pool2), dim=1).view(n, 2 * self.c_gpool, h, w), mask)
         outg = self.conv_mix(outg)
         out = outr + outg
         return out
 
+    def attention_pool_chunk(self, outk, outq_chunk, outg, mask):
+        """
+        Parameters:
+        outk: (N*heads)C(HW) keys for all src points
+        outq_chunk: (N*heads)C(dst) queries for a chunk of dst points
+        outg: (N*heads)C(HW) values for all src points
+        mask: N1HW or None
+
+        Returns: both attention pools for the dst points in the chunk, each (N*heads)C(dst)
+        """
+        nheads = outk.shape[0]
+        hw = outk.shape[2]
+        num_dst = outq_chunk.shape[2]
+        attention_logits = torch.bmm(torch.transpose(outk,1,2), outq_chunk) # n*heads, src h*w, dst
+        if mask is not None:
+            attention_logits = attention_logits.view(nheads // self.c_apheads, self.c_apheads, hw, num_dst)
+            attention_logits = attention_logits - (1.0 - mask.view(nheads // self.c_apheads,1,hw,1)) * 6000.0
+            attention_logits = attention_logits.view(nheads, hw, num_dst)
+        attention = torch.nn.functional.softmax(attention_logits, dim=1)
+        attention_scale = 0.1 / torch.sqrt(torch.sum(torch.square(attention), dim=1, keepdim=True)) # n*heads, 1, dst
+
+        out_pool1 = torch.bmm(outg, attention)
+        out_pool2 = out_pool1 * attention_scale
+        return (out_pool1, out_pool2)
+
     # def forward(self, x, mask, mask_sum_hw, mask_sum:float):
     #     """
     #     Parameters:
@@ -1171,7 +1259,8 @@ class PolicyHead(torch.nn.Module):
         outpolicy = outp
 
         # mask out parts outside the board by making them a huge neg number, so that they're 0 after softmax
-        outpolicy = outpolicy - (1.0 - mask) * 5000.0
+        if mask is not None:
+            outpolicy = outpolicy - (1.0 - mask) * 5000.0
         # NC(HW) concat with NC1
         return torch.cat((outpolicy.view(outpolicy.shape[0],outpolicy.shape[1],-1), outpass.unsqueeze(-1)),dim=2)
 
@@ -1291,28 +1380,69 @@ class ValueHead(torch.nn.Module):
     def add_brenorm_clippage(self, upper_rclippage, lower_rclippage, dclippage):
         pass
 
-    def forward(self, x, mask, mask_sum_hw, mask_sum:float, input_global):
-        outv1 = x
-        outv1 = self.conv1(outv1)
-        outv1 = self.bias1(outv1, mask=mask, mask_sum=mask_sum)
-        outv1 = self.act1(outv1)
-
-        outpooled = self.gpool(outv1, mask=mask, mask_sum_hw=mask_sum_hw).squeeze(-1).squeeze(-1)
-
-        outv2 = self.linear2(outpooled)
-        outv2 = self.act2(outv2)
+    def forward(self, x, mask, mask_sum_hw, mask_sum:float, input_global, outputs: Optional[AbstractSet[str]] = None):
+        """
+        outputs: names from MODEL_OUTPUT_NAMES to compute, or None for all. The others are returned as None.
+        """
+        def wanted(name):
+            return outputs is None or name in outputs
+
+        out_value = None
+        out_miscvalue = None
+        out_moremiscvalue = None
+        out_ownership = None
+        out_scoring = None
+        out_futurepos = None
+        out_seki = None
+        out_scorebelief_logprobs = None
+
+        if any(wanted(name) for name in ("value", "miscvalue", "moremiscvalue", "ownership", "scoring", "scorebelief")):
+            outv1 = x
+            outv1 = self.conv1(outv1)
+            outv1 = self.bias1(outv1, mask=mask, mask_sum=mask_sum)
+            outv1 = self.act1(outv1)
+
+            if any(wanted(name) for name in ("value", "miscvalue", "moremiscvalue", "scorebelief")):
+                outpooled = self.gpool(outv1, mask=mask, mask_sum_hw=mask_sum_hw).squeeze(-1).squeeze(-1)
+
+                if any(wanted(name) for name in ("value", "miscvalue", "moremiscvalue")):
+                    outv2 = self.linear2(outpooled)
+                    outv2 = self.act2(outv2)
+
+                    # Different subheads
+                    if wanted("value"):
+                        out_value = self.linear_valuehead(outv2)
+                    if wanted("miscvalue"):
+                        out_miscvalue = self.linear_miscvaluehead(outv2)
+                    if wanted("moremiscvalue"):
+                        out_moremiscvalue = self.linear_moremiscvaluehead(outv2)
+
+                if wanted("scorebelief"):
+                    out_scorebelief_logprobs = self.scorebelief(outpooled, input_global)
+
+            if wanted("ownership"):
+                out_ownership = apply_mask(self.conv_ownership(outv1), mask)
+            if wanted("scoring"):
+                out_scoring = apply_mask(self.conv_scoring(outv1), mask)
+        if wanted("futurepos"):
+            out_futurepos = apply_mask(self.conv_futurepos(x), mask)
+        if wanted("seki"):
+            out_seki = apply_mask(self.conv_seki(x), mask)
 
-        # Different subheads
-        out_value = self.linear_valuehead(outv2)
-        out_miscvalue = self.linear_miscvaluehead(outv2)
-        out_moremiscvalue = self.linear_moremiscvaluehead(outv2)
-        out_ownership = self.conv_ownership(outv1) * mask
-        out_scoring = self.conv_scoring(outv1) * mask
-        out_futurepos = self.conv_futurepos(x) * mask
-        out_seki = self.conv_seki(x) * mask
+        return (
+            out_value,
+            out_miscvalue,
+            out_moremiscvalue,
+            out_ownership,
+            out_scoring,
+            out_futurepos,
+            out_seki,
+            out_scorebelief_logprobs,
+        )
 
+    def scorebelief(self, outpooled, input_global):
         # Score belief head
-        batch_size = x.shape[0]
+        batch_size = outpooled.shape[0]
         outsv2 = (
             self.linear_s2(outpooled).view(batch_size,1,self.c_sv2) +
             self.linear_s2off(self.score_belief_offset_bias_vector.view(1,self.scorebelief_len,1)) +
@@ -1328,17 +1458,25 @@ class ValueHead(torch.nn.Module):
         out_scorebelief_logprobs = torch.nn.functional.log_softmax(outsv3, dim=1)
         # Take the mixture distribution weighted by outsmix_weights
         out_scorebelief_logprobs = torch.logsumexp(out_scorebelief_logprobs + outsmix_logweights.view(-1, 1, self.num_scorebeliefs), dim=2)
+        return out_scorebelief_logprobs
+
+@contextlib.contextmanager
+def norm_checkpoint_phase(module: torch.nn.Module, phase: str, renorm_stashes: Dict[torch.nn.Module, collections.deque]):
+    """
+    Set checkpoint_phase and checkpoint_renorm_stash on every NormMask within module for the duration, see NormMask.checkpoint_phase.
+    renorm_stashes holds each NormMask's stash for one checkpointed call, shared between its forward and recompute.
+    """
+    norms = [m for m in module.modules() if isinstance(m, NormMask)]
+    for norm in norms:
+        norm.checkpoint_phase = phase
+        norm.checkpoint_renorm_stash = renorm_stashes.setdefault(norm, collections.deque())
+    try:
+        yield
+    finally:
+        for norm in norms:
+            norm.checkpoint_phase = None
+            norm.checkpoint_renorm_stash = None
 
-        return (
-            out_value,
-            out_miscvalue,
-            out_moremiscvalue,
-            out_ownership,
-            out_scoring,
-            out_futurepos,
-            out_seki,
-            out_scorebelief_logprobs,
-        )
 
 class Model(torch.nn.Module):
     def __init__(self, config: modelconfigs.ModelConfig, pos_len: int):
@@ -1359,6 +1497,7 @@ class Model(torch.nn.Module):
         self.num_scorebeliefs = config["num_scorebeliefs"]
         self.num_total_blocks = len(self.block_kind)
         self.pos_len = pos_len
+        self.activation_checkpoint_every = 0
 
         if config["version"] <= 12 or (config["version"] >= 101 and config["version"] <= 199):
             self.td_score_multiplier = 20.0
@@ -1598,17 +1737,80 @@ class Model(torch.nn.Module):
             self.intermediate_policy_head.add_brenorm_clippage(upper_rclippage, lower_rclippage, dclippage)
             self.intermediate_value_head.add_brenorm_clippage(upper_rclippage, lower_rclippage, dclippage)
 
+    def set_activation_checkpointing(self, every_n_blocks: int):
+        """
+        While training, recompute the activations of every every_n_blocks-th trunk block during backward instead of
+        keeping them in memory, or 0 to disable. Running statistics of norms are still updated once per forward pass.
+        """
+        assert every_n_blocks >= 0
+        self.activation_checkpoint_every = every_n_blocks
+
+    def run_trunk_block(self, block_idx: int, block, out, mask, mask_sum_hw, mask_sum):
+        if (
+            self.activation_checkpoint_every > 0
+            and block_idx % self.activation_checkpoint_every == 0
+            and self.training
+            and torch.is_grad_enabled()
+        ):
+            # New for every call, so that if this forward pass never gets its backward, its stashed r and d
+            # are freed along with the rest of its graph instead of being popped by some later recompute
+            renorm_stashes = {}
+            return torch.utils.checkpoint.checkpoint(
+                block, out, mask, mask_sum_hw, mask_sum,
+                use_reentrant=False,
+                context_fn=lambda: (
+                    norm_checkpoint_phase(block, "forward", renorm_stashes),
+                    norm_checkpoint_phase(block, "recompute", renorm_stashes),
+                ),
+            )
+        return block(out, mask=mask, mask_sum_hw=mask_sum_hw, mask_sum=mask_sum)
+
     # Returns a tuple of tuples of outputs
     # The outer tuple indexes different sets of heads, such as if the net also computes intermediate heads.
     #   0 is the main output, 1 is intermediate.
     # The inner tuple ranges over the outputs of a set of heads (policy, value, etc).
-    def forward(self, input_spatial, input_global):
+    #
+    # full_board: whether every board in the batch fills the whole pos_len x pos_len, so that the on-board mask in
+    #   input channel 0 is all ones. Then all masking is skipped (mask is passed down as None) with identical results.
+    #   Only callers that know this ahead of time should pass True. The default False always masks, which is correct for
+    #   any batch and never waits on the device to look at the inputs.
+    # board_bounds: (y0, y1, x0, x1) containing every board in the batch. If given, the net only runs on that crop of
+    #   the input, and full_board refers to the crop. The outputs are padded back out to the full input size.
+    #   Every conv input is masked, so off-board areas contribute only zeros, the same as the padding at the crop edge.
+    # outputs: names from MODEL_OUTPUT_NAMES that the caller needs, or None for all. The branches of the heads that
+    #   only feed other outputs are skipped and those outputs are returned as None. If given, the intermediate head is
+    #   skipped too and only the main head's outputs are returned.
+    def forward(
+        self,
+        input_spatial,
+        input_global,
+        full_board: bool = False,
+        board_bounds: Optional[Tuple[int,int,int,int]] = None,
+        outputs: Optional[AbstractSet[str]] = None,
+    ):
         # float_formatter = "{:.3f}".format
         # np.set_printoptions(formatter={'float_kind':float_formatter}, threshold=1000000, linewidth=10000)
 
-        mask = input_spatial[:, 0:1, :, :].contiguous()
-        mask_sum_hw = torch.sum(mask,dim=(2,3),keepdim=True)
-        mask_sum = torch.sum(mask)
+        if board_bounds is not None:
+            (y0, y1, x0, x1) = board_bounds
+            h = input_spatial.shape[2]
+            w = input_spatial.shape[3]
+            if (y0, y1, x0, x1) != (0, h, 0, w):
+                cropped_outputs_byheads = self.forward(input_spatial[:, :, y0:y1, x0:x1].contiguous(), input_global, full_board=full_board, outputs=outputs)
+                return tuple(self.uncrop_single_heads_output(heads_outputs, board_bounds, h, w) for heads_outputs in cropped_outputs_byheads)
+
+        if outputs is not None:
+            assert all(name in MODEL_OUTPUT_NAMES for name in outputs), f"Unknown outputs: {outputs}"
+
+        if full_board:
+            (n, _, h, w) = input_spatial.shape
+            mask = None
+            mask_sum_hw = input_spatial.new_full((n, 1, 1, 1), float(h * w))
+            mask_sum = float(n * h * w)
+        else:
+            mask = input_spatial[:, 0:1, :, :].contiguous()
+            mask_sum_hw = torch.sum(mask,dim=(2,3),keepdim=True)
+            mask_sum = torch.sum(mask)
 
         x_spatial = self.conv_spatial(input_spatial)
         x_global = self.linear_global(input_global).unsqueeze(-1).unsqueeze(-1)
@@ -1616,13 +1818,15 @@ class Model(torch.nn.Module):
         # print("TENSOR BEFORE TRUNK")
         # print(out)
 
-        if self.has_intermediate_head:
+        # The intermediate head is only computed when all outputs are requested
+        with_intermediate_head = self.has_intermediate_head and outputs is None
+        if with_intermediate_head:
             count = 0
             for block in self.blocks[:self.intermediate_head_blocks]:
                 # print("TENSOR BEFORE BLOCK")
                 # print(count)
                 # print(out)
-                out = block(out, mask=mask, mask_sum_hw=mask_sum_hw, mask_sum=mask_sum)
+                out = self.run_trunk_block(count, block, out, mask=mask, mask_sum_hw=mask_sum_hw, mask_sum=mask_sum)
                 count += 1
 
             # print("INTERMEDIATE")
@@ -1645,7 +1849,7 @@ class Model(torch.nn.Module):
                 # print("TENSOR BEFORE BLOCK")
                 # print(count)
                 # print(out)
-                out = block(out, mask=mask, mask_sum_hw=mask_sum_hw, mask_sum=mask_sum)
+                out = self.run_trunk_block(count, block, out, mask=mask, mask_sum_hw=mask_sum_hw, mask_sum=mask_sum)
                 count += 1
 
         else:
@@ -1654,14 +1858,16 @@ class Model(torch.nn.Module):
                 # print("TENSOR BEFORE BLOCK")
                 # print(count)
                 # print(out)
-                out = block(out, mask=mask, mask_sum_hw=mask_sum_hw, mask_sum=mask_sum)
+                out = self.run_trunk_block(count, block, out, mask=mask, mask_sum_hw=mask_sum_hw, mask_sum=mask_sum)
                 count += 1
 
         out = self.norm_trunkfinal(out, mask=mask, mask_sum=mask_sum)
         out = self.act_trunkfinal(out)
 
         # print("MAIN")
-        out_policy = self.policy_head(out, mask=mask, mask_sum_hw=mask_sum_hw, mask_sum=mask_sum)
+        out_policy = None
+        if outputs is None or "policy" in outputs:
+            out_policy = self.policy_head(out, mask=mask, mask_sum_hw=mask_sum_hw, mask_sum=mask_sum)
         (
             out_value,
             out_miscvalue,
@@ -1671,9 +1877,9 @@ class Model(torch.nn.Module):
             out_futurepos,
             out_seki,
             out_scorebelief_logprobs,
-        ) = self.value_head(out, mask=mask, mask_sum_hw=mask_sum_hw, mask_sum=mask_sum, input_global=input_global)
+        ) = self.value_head(out, mask=mask, mask_sum_hw=mask_sum_hw, mask_sum=mask_sum, input_global=input_global, outputs=outputs)
 
-        if self.has_intermediate_head:
+        if with_intermediate_head:
             return (
                 (
                     out_policy,
@@ -1711,10 +1917,7 @@ class Model(torch.nn.Module):
                 out_scorebelief_logprobs,
             ),)
 
-    def float32ify_output(self, outputs_byheads):
-        return tuple(self.float32ify_single_heads_output(outputs) for outputs in outputs_byheads)
-
-    def float32ify_single_heads_output(self, outputs):
+    def uncrop_single_heads_output(self, outputs, board_bounds: Tuple[int,int,int,int], h: int, w: int):
         (
             out_policy,
             out_value,
@@ -1726,18 +1929,34 @@ class Model(torch.nn.Module):
             out_seki,
             out_scorebelief_logprobs,
         ) = outputs
+        (y0, y1, x0, x1) = board_bounds
+        padding = (x0, w - x1, y0, h - y1)
+        # Off-board policy logits are always exactly -5000, see PolicyHead, and the other spatial outputs are masked to 0.
+        if out_policy is not None:
+            n = out_policy.shape[0]
+            c = out_policy.shape[1]
+            out_policy_spatial = torch.nn.functional.pad(out_policy[:, :, :-1].view(n, c, y1 - y0, x1 - x0), padding, value=-5000.0)
+            out_policy = torch.cat((out_policy_spatial.view(n, c, h * w), out_policy[:, :, -1:]), dim=2)
+        def pad_spatial(out):
+            return None if out is None else torch.nn.functional.pad(out, padding)
         return (
-            out_policy.to(torch.float32),
-            out_value.to(torch.float32),
-            out_miscvalue.to(torch.float32),
-            out_moremiscvalue.to(torch.float32),
-            out_ownership.to(torch.float32),
-            out_scoring.to(torch.float32),
-            out_futurepos.to(torch.float32),
-            out_seki.to(torch.float32),
-            out_scorebelief_logprobs.to(torch.float32),
+            out_policy,
+            out_value,
+            out_miscvalue,
+            out_moremiscvalue,
+            pad_spatial(out_ownership),
+            pad_spatial(out_scoring),
+            pad_spatial(out_futurepos),
+            pad_spatial(out_seki),
+            out_scorebelief_logprobs,
         )
 
+    def float32ify_output(self, outputs_byheads):
+        return tuple(self.float32ify_single_heads_output(outputs) for outputs in outputs_byheads)
+
+    def float32ify_single_heads_output(self, outputs):
+        return tuple(None if out is None else out.to(torch.float32) for out in outputs)
+
     def postprocess_output(self, outputs_byheads):
         return tuple(self.postprocess_single_heads_output(outputs) for outputs in outputs_byheads)
 
@@ -1754,24 +1973,31 @@ class Model(torch.nn.Module):
             out_scorebelief_logprobs,
         ) = outputs
 
+        # Outputs that weren't requested from forward are None, as is everything computed from them
         policy_logits = out_policy
         value_logits = out_value
-        td_value_logits = torch.stack((out_miscvalue[:,4:7], out_miscvalue[:,7:10], out_moremiscvalue[:,2:5]), dim=1)
-        pred_td_score = out_moremiscvalue[:,5:8] * self.td_score_multiplier
+        td_value_logits = None
+        if out_miscvalue is not None and out_moremiscvalue is not None:
+            td_value_logits = torch.stack((out_miscvalue[:,4:7], out_miscvalue[:,7:10], out_moremiscvalue[:,2:5]), dim=1)
         ownership_pretanh = out_ownership
         pred_scoring = out_scoring
         futurepos_pretanh = out_futurepos
         seki_logits = out_seki
-        pred_scoremean = out_miscvalue[:, 0] * self.scoremean_multiplier
-        pred_scorestdev = SoftPlusWithGradientFloorFunction.apply(out_miscvalue[:, 1], 0.05, False) * self.scorestdev_multiplier
-        pred_lead = out_miscvalue[:, 2] * self.lead_multiplier
-        pred_variance_time = SoftPlusWithGradientFloorFunction.apply(out_miscvalue[:, 3], 0.05, False) * self.variance_time_multiplier
-        if self.config["version"] < 14 or (self.config["version"] >= 101 and self.config["version"] <= 199):
-            pred_shortterm_value_error = SoftPlusWithGradientFloorFunction.apply(out_moremiscvalue[:,0], 0.05, False) * self.shortterm_value_error_multiplier
-            pred_shortterm_score_error = SoftPlusWithGradientFloorFunction.apply(out_moremiscvalue[:,1], 0.05, False) * self.shortterm_score_error_multiplier
-        else:
-            pred_shortterm_value_error = SoftPlusWithGradientFloorFunction.apply(out_moremiscvalue[:,0], 0.05, True) * self.shortterm_value_error_multiplier
-            pred_shortterm_score_error = SoftPlusWithGradientFloorFunction.apply(out_moremiscvalue[:,1], 0.05, True) * self.shortterm_score_error_multiplier
+        (pred_scoremean, pred_scorestdev, pred_lead, pred_variance_time) = (None, None, None, None)
+        if out_miscvalue is not None:
+            pred_scoremean = out_miscvalue[:, 0] * self.scoremean_multiplier
+            pred_scorestdev = SoftPlusWithGradientFloorFunction.apply(out_miscvalue[:, 1], 0.05, False) * self.scorestdev_multiplier
+            pred_lead = out_miscvalue[:, 2] * self.lead_multiplier
+            pred_variance_time = SoftPlusWithGradientFloorFunction.apply(out_miscvalue[:, 3], 0.05, False) * self.variance_time_multiplier
+        (pred_td_score, pred_shortterm_value_error, pred_shortterm_score_error) = (None, None, None)
+        if out_moremiscvalue is not None:
+            pred_td_score = out_moremiscvalue[:,5:8] * self.td_score_multiplier
+            if self.config["version"] < 14 or (self.config["version"] >= 101 and self.config["version"] <= 199):
+                pred_shortterm_value_error = SoftPlusWithGradientFloorFunction.apply(out_moremiscvalue[:,0], 0.05, False) * self.shortterm_value_error_multiplier
+                pred_shortterm_score_error = SoftPlusWithGradientFloorFunction.apply(out_moremiscvalue[:,1], 0.05, False) * self.shortterm_score_error_multiplier
+            else:
+                pred_shortterm_value_error = SoftPlusWithGradientFloorFunction.apply(out_moremiscvalue[:,0], 0.05, True) * self.shortterm_value_error_multiplier
+                pred_shortterm_score_error = SoftPlusWithGradientFloorFunction.apply(out_moremiscvalue[:,1], 0.05, True) * self.shortterm_score_error_multiplier
         scorebelief_logits = out_scorebelief_logprobs
 
         return (
@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+"""
+Persistent index of the number of rows in selfplay npz files, shared by shuffle.py, count_data_and_wait.py
+and summarize_old_selfplay_files.py so that they don't have to reopen the zip headers of every file on every run.
+
+Entries are keyed by absolute path and mtime, so a file that is rewritten is simply recounted.
+Files that are permanently unreadable (a bad zip or bad npy header) are recorded with num_rows None, same as the
+scripts report them. Files that fail for reasons that may go away, such as permissions or a file still being written,
+are not recorded and are simply retried on the next run.
+
+The index is an sqlite file that several processes may read and write at once. Writes are single short
+transactions and are retried if the database is locked. We stay in sqlite's default rollback journal mode rather than WAL,
+since WAL relies on shared memory that doesn't work across machines on a network filesystem.
+"""
+import os
+import sqlite3
+import time
+
+class NpzRowIndex(object):
+
+    def __init__(self, index_file, timeout=60.0):
+        self.index_file = index_file
+        self.conn = sqlite3.connect(index_file, timeout=timeout, isolation_level=None)
+        self._with_retries(lambda: self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS npz_rows (path TEXT PRIMARY KEY, mtime REAL NOT NULL, num_rows INTEGER)"
+        ))
+
+    def _with_retries(self, f):
+        # sqlite already waits up to timeout on a lock, but on nfs locking can also fail outright, so try a few more times
+        for i in range(10):
+            try:
+                return f()
+            except sqlite3.OperationalError as e:
+                if "locked" not in str(e) and "busy" not in str(e):
+                    raise
+                if i == 9:
+                    raise
+                print("WARNING: row index %s is locked, retrying: %s" % (self.index_file, str(e)), flush=True)
+                time.sleep(1)
+
+    def lookup(self, filename_mtimes):
+        """
+        Given a list of (filename, mtime), return a dict filename -> num_rows for the files whose index entry
+        matches their current mtime. num_rows may be None for files previously found to be bad.
+        """
+        def do_lookup():
+            found = {}
+            cursor = self.conn.cursor()
+            batch_size = 500
+            for start in range(0, len(filename_mtimes), batch_size):
+                batch = filename_mtimes[start:start+batch_size]
+                paths = [os.path.abspath(filename) for (filename, mtime) in batch]
+                cursor.execute(
+                    "SELECT path, mtime, num_rows FROM npz_rows WHERE path IN (%s)" % ",".join("?" * len(paths)),
+                    paths
+                )
+                entries = {path: (mtime, num_rows) for (path, mtime, num_rows) in cursor.fetchall()}
+                for ((filename, mtime), path) in zip(batch, paths):
+                    entry = entries.get(path)
+                    if entry is not None and entry[0] == mtime:
+                        found[filename] = entry[1]
+            return found
+        return self._with_retries(do_lookup)
+
+    def record(self, filename_mtime_num_rowss):
+        """
+        Record a list of (filename, mtime, num_rows), replacing any older entries for those files.
+        If the index stays locked through all the retries, nothing is recorded and the files are simply recounted next time.
+        """
+        if len(filename_mtime_num_rowss) <= 0:
+            return
+        rows = [(os.path.abspath(filename), mtime, num_rows) for (filename, mtime, num_rows) in filename_mtime_num_rowss]
+        def do_record():
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.executemany("INSERT OR REPLACE INTO npz_rows (path, mtime, num_rows) VALUES (?,?,?)", rows)
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+        try:
+            self._with_retries(do_record)
+        except sqlite3.OperationalError as e:
+            if "locked" not in str(e) and "busy" not in str(e):
+                raise
+            print("WARNING: row index %s is still locked, not recording %d files: %s" % (self.index_file, len(rows), str(e)), flush=True)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_val, trace):
+        self.close()
+        return False
+
+
+def compute_num_rows_using_index(index_file, filename_mtimes, compute_num_rows, pool):
+    """
+    Return a dict filename -> num_rows for each (filename, mtime) in filename_mtimes, using and updating
+    the index at index_file, or without an index if index_file is None.
+    Files missing from the index are counted by pool.map(compute_num_rows, filenames), where compute_num_rows
+    returns (filename, num_rows, is_permanent) as in shuffle.py. Only permanent results are recorded in the index.
+    """
+    if index_file is None:
+        new_results = pool.map(compute_num_rows, [filename for (filename, mtime) in filename_mtimes])
+        return {filename: num_rows for (filename, num_rows, is_permanent) in new_results}
+
+    with NpzRowIndex(index_file) as index:
+        results = index.lookup(filename_mtimes)
+        missing = [(filename, mtime) for (filename, mtime) in filename_mtimes if filename not in results]
+        print("Row index %s had %d/%d files, counting %d" % (index_file, len(results), len(filename_mtimes), len(missing)), flush=True)
+        mtime_by_filename = dict(missing)
+        new_results = pool.map(compute_num_rows, [filename for (filename, mtime) in missing])
+        index.record([
+            (filename, mtime_by_filename[filename], num_rows)
+            for (filename, num_rows, is_permanent) in new_results if is_permanent
+        ])
+        results.update({filename: num_rows for (filename, num_rows, is_permanent) in new_results})
+    return results
@@ -10,6 +10,7 @@ import re
 import logging
 import colorsys
 import json
+import collections
 import numpy as np
 
 from board import Board
@@ -20,8 +21,10 @@ import torch.nn
 
 import modelconfigs
 from model_pytorch import Model, EXTRA_SCORE_DISTR_RADIUS
-from data_processing_pytorch import apply_symmetry
+from data_processing_pytorch import apply_symmetry, apply_symmetry_policy
 from load_model import load_model
+from fuse_model import fuse_model_for_inference
+from quantize_model import quantize_model_for_cpu, read_cpu_batches
 
 description = """
 Play go with a trained neural net!
@@ -31,11 +34,26 @@ Implements a basic GTP engine that uses the neural net directly to play moves.
 parser = argparse.ArgumentParser(description=description)
 parser.add_argument('-checkpoint', help='Checkpoint to test', required=False)
 parser.add_argument('-use-swa', help='Use SWA model', action="store_true", required=False)
+parser.add_argument('-int8-calibration-npzdir', help='Quantize the model to int8, calibrating on npz data in this dir', required=False)
+parser.add_argument('-symmetries', help='Comma-separated symmetries 0-7 to average the net over, evaluated as one batch', default="0", required=False)
+parser.add_argument('-output-cache-size', help='Number of positions to keep the outputs of the net for, 0 to disable', type=int, default=100, required=False)
+parser.add_argument('-search-visits', help='Choose moves by a search of this many visits instead of sampling the raw policy', type=int, required=False)
+parser.add_argument('-search-time', help='Choose moves by a search of this many seconds instead of sampling the raw policy', type=float, required=False)
+parser.add_argument('-search-batch-size', help='Number of leaves of the search to evaluate with the net at once', type=int, default=8, required=False)
 
 args = vars(parser.parse_args())
 
 checkpoint_file = args["checkpoint"]
 use_swa = args["use_swa"]
+int8_calibration_npzdir = args["int8_calibration_npzdir"]
+symmetries = [int(symmetry) for symmetry in args["symmetries"].split(",")]
+assert len(symmetries) > 0 and all(0 <= symmetry < 8 for symmetry in symmetries), "Symmetries must be in 0-7"
+output_cache_size = args["output_cache_size"]
+search_visits = args["search_visits"]
+search_time = args["search_time"]
+search_batch_size = args["search_batch_size"]
+assert search_batch_size > 0, "Search batch size must be positive"
+assert search_visits is None or search_visits >= 1, "Search visits must be at least 1"
 
 # Hardcoded max board size
 pos_len = 19
@@ -59,6 +77,11 @@ model_config = model.config
 if swa_model is not None:
     model = swa_model.module
     model.eval()
+if int8_calibration_npzdir is not None:
+    logging.info("Quantizing model to int8, calibrating on " + int8_calibration_npzdir)
+    model = quantize_model_for_cpu(model, read_cpu_batches(int8_calibration_npzdir, 32, pos_len, model_config), 8)
+else:
+    model = fuse_model_for_inference(model)
 
 features = Features(model_config, pos_len)
 
@@ -69,35 +92,175 @@ class GameState:
         self.moves = []
         self.boards = [self.board.copy()]
 
+    def copy(self):
+        gs = GameState(self.board_size)
+        gs.board = self.board.copy()
+        gs.moves = list(self.moves)
+        # Past boards are never modified, so they can be shared
+        gs.boards = list(self.boards)
+        return gs
+
+    def play(self,pla,loc):
+        self.board.play(pla,loc)
+        self.moves.append((pla,loc))
+        self.boards.append(self.board.copy())
+
 
 # Moves ----------------------------------------------------------------
 
 
-def get_outputs(gs, rules):
+# Outputs of the net that are enough for genmove, see Model.forward
+GENMOVE_OUTPUTS = {"policy", "value"}
+
+def inverse_symmetry(symmetry):
+    # For apply_symmetry, rotating by 90 and 270 degrees undo each other and every other symmetry is its own inverse
+    return {1: 3, 3: 1}.get(symmetry, symmetry)
+
+def unapply_symmetries(outputs, symmetries, board_size):
+    """Given raw single-head outputs of the net with row i evaluated under symmetries[i], transform every row back"""
+    (
+        out_policy,
+        out_value,
+        out_miscvalue,
+        out_moremiscvalue,
+        out_ownership,
+        out_scoring,
+        out_futurepos,
+        out_seki,
+        out_scorebelief_logprobs,
+    ) = outputs
+    def unapply(out, apply_fn):
+        if out is None:
+            return None
+        return torch.cat([apply_fn(out[i:i+1], inverse_symmetry(symmetry)) for (i, symmetry) in enumerate(symmetries)], dim=0)
+    unapply_policy = lambda out, symmetry: apply_symmetry_policy(out, symmetry, board_size)
+    return (
+        unapply(out_policy, unapply_policy),
+        out_value,
+        out_miscvalue,
+        out_moremiscvalue,
+        unapply(out_ownership, apply_symmetry),
+        unapply(out_scoring, apply_symmetry),
+        unapply(out_futurepos, apply_symmetry),
+        unapply(out_seki, apply_symmetry),
+        out_scorebelief_logprobs,
+    )
+
+class OutputCache:
+    """LRU cache of the outputs of the net by position, so that analysis commands on the same position share one evaluation"""
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+
+    def get(self, key):
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+output_cache = OutputCache(output_cache_size)
+
+def get_position_key(gs, rules):
+    """Everything about gs and rules that fill_row_features reads"""
+    board = gs.board
+    return (
+        board.size,
+        board.sit_zobrist(),
+        board.simple_ko_point,
+        # The previous move features and the ladder features of the previous two boards
+        tuple(gs.moves[-5:]),
+        tuple(prev_board.pos_zobrist() for prev_board in gs.boards[-3:-1]),
+        # The button feature
+        Board.PASS_LOC in [move[1] for move in gs.moves],
+        tuple(sorted(rules.items())),
+    )
+
+def evaluate_net(gss, rules, outputs):
+    """
+    Return the postprocessed outputs of the net for the current position of each of gss, evaluated as one batch.
+    Each has one row per symmetry. All of gss must have the same board size.
+    """
+    board_size = gss[0].board_size
+    assert all(gs.board_size == board_size for gs in gss)
     with torch.no_grad():
         model.eval()
 
-        bin_input_data = np.zeros(shape=[1]+model.bin_input_shape, dtype=np.float32)
-        global_input_data = np.zeros(shape=[1]+model.global_input_shape, dtype=np.float32)
-        pla = gs.board.pla
-        opp = Board.get_opp(pla)
-        move_idx = len(gs.moves)
+        bin_input_data = np.zeros(shape=[len(gss)]+model.bin_input_shape, dtype=np.float32)
+        global_input_data = np.zeros(shape=[len(gss)]+model.global_input_shape, dtype=np.float32)
         # This function assumes N(HW)C order but we actually use NCHW order, so work with it and revert
         bin_input_data = np.transpose(bin_input_data,axes=(0,2,3,1))
-        bin_input_data = bin_input_data.reshape([1,pos_len*pos_len,-1])
-        features.fill_row_features(gs.board,pla,opp,gs.boards,gs.moves,move_idx,rules,bin_input_data,global_input_data,idx=0)
-        bin_input_data = bin_input_data.reshape([1,pos_len,pos_len,-1])
+        bin_input_data = bin_input_data.reshape([len(gss),pos_len*pos_len,-1])
+        for (idx, gs) in enumerate(gss):
+            pla = gs.board.pla
+            opp = Board.get_opp(pla)
+            move_idx = len(gs.moves)
+            features.fill_row_features(gs.board,pla,opp,gs.boards,gs.moves,move_idx,rules,bin_input_data,global_input_data,idx=idx)
+        bin_input_data = bin_input_data.reshape([len(gss),pos_len,pos_len,-1])
         bin_input_data = np.transpose(bin_input_data,axes=(0,3,1,2))
 
-        # Currently we don't actually do any symmetries
-        # symmetry = 0
-        # model_outputs = model(apply_symmetry(batch["binaryInputNCHW"],symmetry),batch["globalInputNC"])
-
+        # Features places the board in the top left corner, so run the net on just the board.
+        # That also keeps the board in place under every symmetry, which otherwise acts on the whole pos_len x pos_len.
+        # Rows are ordered by position, then by symmetry.
+        board_input = torch.tensor(bin_input_data[:, :, :board_size, :board_size], dtype=torch.float32)
+        row_symmetries = symmetries * len(gss)
         model_outputs = model(
-            torch.tensor(bin_input_data, dtype=torch.float32),
-            torch.tensor(global_input_data, dtype=torch.float32),
+            torch.stack([apply_symmetry(board_input[i // len(symmetries)], symmetry) for (i, symmetry) in enumerate(row_symmetries)], dim=0),
+            torch.tensor(global_input_data, dtype=torch.float32).repeat_interleave(len(symmetries), dim=0),
+            full_board=True,
+            outputs=outputs,
         )
-        outputs = model.postprocess_output(model_outputs)
+        model_outputs = unapply_symmetries(model_outputs[0], row_symmetries, board_size)
+        model_outputs = (model.uncrop_single_heads_output(model_outputs, (0, board_size, 0, board_size), pos_len, pos_len),)
+        postprocessed = model.postprocess_output(model_outputs)[0]
+        return [
+            tuple(None if x is None else x[i*len(symmetries):(i+1)*len(symmetries)] for x in postprocessed)
+            for i in range(len(gss))
+        ]
+
+def get_net_outputs(gss, rules, outputs):
+    """Same as evaluate_net, but reusing previous results for the same position from output_cache"""
+    keys = [get_position_key(gs, rules) for gs in gss]
+    results = []
+    for key in keys:
+        # Results with every output computed can also answer requests for only some
+        result = output_cache.get((key, None))
+        if result is None and outputs is not None:
+            result = output_cache.get((key, frozenset(outputs)))
+        results.append(result)
+
+    missing = [i for i in range(len(gss)) if results[i] is None]
+    if len(missing) > 0:
+        for (i, result) in zip(missing, evaluate_net([gss[i] for i in missing], rules, outputs)):
+            results[i] = result
+            output_cache.put((keys[i], None if outputs is None else frozenset(outputs)), result)
+    return results
+
+def get_moves_and_probs(policy, board):
+    """Return (loc, prob) for each legal move of board.pla, including pass, given the policy over tensor positions"""
+    moves_and_probs = []
+    for i in range(len(policy)):
+        move = features.tensor_pos_to_loc(i,board)
+        if i == len(policy)-1:
+            moves_and_probs.append((Board.PASS_LOC,policy[i]))
+        elif board.would_be_legal(board.pla,move):
+            moves_and_probs.append((move,policy[i]))
+    return moves_and_probs
+
+def get_outputs(gs, rules, outputs=None):
+    """
+    outputs: which raw outputs of the net to compute, or None for all. Results computed from the others are None.
+    The net is run on every symmetry in symmetries as one batch, and the results are averaged over them.
+    """
+    postprocessed = get_net_outputs([gs], rules, outputs)[0]
+    with torch.no_grad():
         (
             policy_logits,      # N, num_policy_outputs, move
             value_logits,       # N, {win,loss,noresult}
@@ -114,132 +277,83 @@ def get_outputs(gs, rules):
             pred_shortterm_value_error, # N
             pred_shortterm_score_error, # N
             scorebelief_logits, # N, 2 * (self.pos_len*self.pos_len + EXTRA_SCORE_DISTR_RADIUS)
-        ) = (x[0] for x in outputs[0]) # N = 0
-
-        policy0 = torch.nn.functional.softmax(policy_logits[0,:],dim=0).cpu().numpy()
-        policy1 = torch.nn.functional.softmax(policy_logits[1,:],dim=0).cpu().numpy()
-        value = torch.nn.functional.softmax(value_logits,dim=0).cpu().numpy()
-        td_value = torch.nn.functional.softmax(td_value_logits[0,:],dim=0).cpu().numpy()
-        td_value2 = torch.nn.functional.softmax(td_value_logits[1,:],dim=0).cpu().numpy()
-        td_value3 = torch.nn.functional.softmax(td_value_logits[2,:],dim=0).cpu().numpy()
-        scoremean = pred_scoremean.cpu().item()
-        td_score = pred_td_score.cpu().numpy()
-        scorestdev = pred_scorestdev.cpu().item()
-        lead = pred_lead.cpu().item()
-        vtime = pred_variance_time.cpu().item()
-        estv = math.sqrt(pred_shortterm_value_error.cpu().item())
-        ests = math.sqrt(pred_shortterm_score_error.cpu().item())
-        ownership = torch.tanh(ownership_pretanh).cpu().numpy()
-        scoring = pred_scoring.cpu().numpy()
-        futurepos = torch.tanh(futurepos_pretanh).cpu().numpy()
-        seki_probs = torch.nn.functional.softmax(seki_logits[0:3,:,:],dim=0).cpu().numpy()
-        seki = seki_probs[1] - seki_probs[2]
-        seki2 = torch.sigmoid(seki_logits[3,:,:]).cpu().numpy()
-        scorebelief = torch.nn.functional.softmax(scorebelief_logits,dim=0).cpu().numpy()
+        ) = postprocessed # N = number of symmetries, averaged over below
+
+        policy0 = policy1 = value = td_value = td_value2 = td_value3 = None
+        scoremean = td_score = scorestdev = lead = vtime = estv = ests = None
+        ownership = scoring = futurepos = seki = seki2 = scorebelief = None
+        # Average probabilities rather than logits over the symmetries
+        if policy_logits is not None:
+            policy0 = torch.nn.functional.softmax(policy_logits[:,0,:],dim=1).mean(dim=0).cpu().numpy()
+            policy1 = torch.nn.functional.softmax(policy_logits[:,1,:],dim=1).mean(dim=0).cpu().numpy()
+        if value_logits is not None:
+            value = torch.nn.functional.softmax(value_logits,dim=1).mean(dim=0).cpu().numpy()
+        if td_value_logits is not None:
+            td_value = torch.nn.functional.softmax(td_value_logits[:,0,:],dim=1).mean(dim=0).cpu().numpy()
+            td_value2 = torch.nn.functional.softmax(td_value_logits[:,1,:],dim=1).mean(dim=0).cpu().numpy()
+            td_value3 = torch.nn.functional.softmax(td_value_logits[:,2,:],dim=1).mean(dim=0).cpu().numpy()
+        if pred_scoremean is not None:
+            scoremean = pred_scoremean.mean().cpu().item()
+            scorestdev = pred_scorestdev.mean().cpu().item()
+            lead = pred_lead.mean().cpu().item()
+            vtime = pred_variance_time.mean().cpu().item()
+        if pred_td_score is not None:
+            td_score = pred_td_score.mean(dim=0).cpu().numpy()
+            estv = math.sqrt(pred_shortterm_value_error.mean().cpu().item())
+            ests = math.sqrt(pred_shortterm_score_error.mean().cpu().item())
+        if ownership_pretanh is not None:
+            ownership = torch.tanh(ownership_pretanh).mean(dim=0).cpu().numpy()
+        if pred_scoring is not None:
+            scoring = pred_scoring.mean(dim=0).cpu().numpy()
+        if futurepos_pretanh is not None:
+            futurepos = torch.tanh(futurepos_pretanh).mean(dim=0).cpu().numpy()
+        if seki_logits is not None:
+            seki_probs = torch.nn.functional.softmax(seki_logits[:,0:3,:,:],dim=1).mean(dim=0).cpu().numpy()
+            seki = seki_probs[1] - seki_probs[2]
+            seki2 = torch.sigmoid(seki_logits[:,3,:,:]).mean(dim=0).cpu().numpy()
+        if scorebelief_logits is not None:
+            scorebelief = torch.nn.functional.softmax(scorebelief_logits,dim=1).mean(dim=0).cpu().numpy()
 
     board = gs.board
 
-    moves_and_probs0 = []
-    for i in range(len(policy0)):
-        move = features.tensor_pos_to_loc(i,board)
-        if i == len(policy0)-1:
-            moves_and_probs0.append((Board.PASS_LOC,policy0[i]))
-        elif board.would_be_legal(board.pla,move):
-            moves_and_probs0.append((move,policy0[i]))
-
-    moves_and_probs1 = []
-    for i in range(len(policy1)):
-        move = features.tensor_pos_to_loc(i,board)
-        if i == len(policy1)-1:
-            moves_and_probs1.append((Board.PASS_LOC,policy1[i]))
-        elif board.would_be_legal(board.pla,move):
-            moves_and_probs1.append((move,policy1[i]))
-
-    ownership_flat = ownership.reshape([features.pos_len * features.pos_len])
-    ownership_by_loc = []
-    board = gs.board
-    for y in range(board.size):
-        for x in range(board.size):
-            loc = board.loc(x,y)
-            pos = features.loc_to_tensor_pos(loc,board)
-            if board.pla == Board.WHITE:
-                ownership_by_loc.append((loc,ownership_flat[pos]))
-            else:
-                ownership_by_loc.append((loc,-ownership_flat[pos]))
-
-    scoring_flat = scoring.reshape([features.pos_len * features.pos_len])
-    scoring_by_loc = []
-    board = gs.board
-    for y in range(board.size):
-        for x in range(board.size):
-            loc = board.loc(x,y)
-            pos = features.loc_to_tensor_pos(loc,board)
-            if board.pla == Board.WHITE:
-                scoring_by_loc.append((loc,scoring_flat[pos]))
-            else:
-                scoring_by_loc.append((loc,-scoring_flat[pos]))
-
-    futurepos0_flat = futurepos[0,:,:].reshape([features.pos_len * features.pos_len])
-    futurepos0_by_loc = []
-    board = gs.board
-    for y in range(board.size):
-        for x in range(board.size):
-            loc = board.loc(x,y)
-            pos = features.loc_to_tensor_pos(loc,board)
-            if board.pla == Board.WHITE:
-                futurepos0_by_loc.append((loc,futurepos0_flat[pos]))
-            else:
-                futurepos0_by_loc.append((loc,-futurepos0_flat[pos]))
-
-    futurepos1_flat = futurepos[1,:,:].reshape([features.pos_len * features.pos_len])
-    futurepos1_by_loc = []
-    board = gs.board
-    for y in range(board.size):
-        for x in range(board.size):
-            loc = board.loc(x,y)
-            pos = features.loc_to_tensor_pos(loc,board)
-            if board.pla == Board.WHITE:
-                futurepos1_by_loc.append((loc,futurepos1_flat[pos]))
-            else:
-                futurepos1_by_loc.append((loc,-futurepos1_flat[pos]))
-
-    seki_flat = seki.reshape([features.pos_len * features.pos_len])
-    seki_by_loc = []
-    board = gs.board
-    for y in range(board.size):
-        for x in range(board.size):
-            loc = board.loc(x,y)
-            pos = features.loc_to_tensor_pos(loc,board)
-            if board.pla == Board.WHITE:
-                seki_by_loc.append((loc,seki_flat[pos]))
-            else:
-                seki_by_loc.append((loc,-seki_flat[pos]))
-
-    seki_flat2 = seki2.reshape([features.pos_len * features.pos_len])
-    seki_by_loc2 = []
-    board = gs.board
-    for y in range(board.size):
-        for x in range(board.size):
-            loc = board.loc(x,y)
-            pos = features.loc_to_tensor_pos(loc,board)
-            seki_by_loc2.append((loc,seki_flat2[pos]))
-
-    moves_and_probs = sorted(moves_and_probs0, key=lambda moveandprob: moveandprob[1], reverse=True)
-    # Generate a random number biased small and then find the appropriate move to make
-    # Interpolate from moving uniformly to choosing from the triangular distribution
-    alpha = 1
-    beta = 1 + math.sqrt(max(0,len(gs.moves)-20))
-    r = np.random.beta(alpha,beta)
-    probsum = 0.0
-    i = 0
-    genmove_result = Board.PASS_LOC
-    while True:
-        (move,prob) = moves_and_probs[i]
-        probsum += prob
-        if i >= len(moves_and_probs)-1 or probsum > r:
-            genmove_result = move
-            break
-        i += 1
+    moves_and_probs0 = None
+    moves_and_probs1 = None
+    genmove_result = None
+    if policy0 is not None:
+        moves_and_probs0 = get_moves_and_probs(policy0, board)
+        moves_and_probs1 = get_moves_and_probs(policy1, board)
+
+        moves_and_probs = sorted(moves_and_probs0, key=lambda moveandprob: moveandprob[1], reverse=True)
+        # Generate a random number biased small and then find the appropriate move to make
+        # Interpolate from moving uniformly to choosing from the triangular distribution
+        alpha = 1
+        beta = 1 + math.sqrt(max(0,len(gs.moves)-20))
+        r = np.random.beta(alpha,beta)
+        probsum = 0.0
+        i = 0
+        genmove_result = Board.PASS_LOC
+        while True:
+            (move,prob) = moves_and_probs[i]
+            probsum += prob
+            if i >= len(moves_and_probs)-1 or probsum > r:
+                genmove_result = move
+                break
+            i += 1
+
+    def get_by_loc(values, relative_to_pla):
+        if values is None:
+            return None
+        values_flat = values.reshape([features.pos_len * features.pos_len])
+        values_by_loc = []
+        for y in range(board.size):
+            for x in range(board.size):
+                loc = board.loc(x,y)
+                pos = features.loc_to_tensor_pos(loc,board)
+                if board.pla == Board.WHITE or not relative_to_pla:
+                    values_by_loc.append((loc,values_flat[pos]))
+                else:
+                    values_by_loc.append((loc,-values_flat[pos]))
+        return values_by_loc
 
     return {
         "policy0": policy0,
@@ -258,20 +372,172 @@ def get_outputs(gs, rules):
         "estv": estv,
         "ests": ests,
         "ownership": ownership,
-        "ownership_by_loc": ownership_by_loc,
+        "ownership_by_loc": get_by_loc(ownership, relative_to_pla=True),
         "scoring": scoring,
-        "scoring_by_loc": scoring_by_loc,
+        "scoring_by_loc": get_by_loc(scoring, relative_to_pla=True),
         "futurepos": futurepos,
-        "futurepos0_by_loc": futurepos0_by_loc,
-        "futurepos1_by_loc": futurepos1_by_loc,
+        "futurepos0_by_loc": get_by_loc(None if futurepos is None else futurepos[0,:,:], relative_to_pla=True),
+        "futurepos1_by_loc": get_by_loc(None if futurepos is None else futurepos[1,:,:], relative_to_pla=True),
         "seki": seki,
-        "seki_by_loc": seki_by_loc,
+        "seki_by_loc": get_by_loc(seki, relative_to_pla=True),
         "seki2": seki2,
-        "seki_by_loc2": seki_by_loc2,
+        "seki_by_loc2": get_by_loc(seki2, relative_to_pla=False),
         "scorebelief": scorebelief,
         "genmove_result": genmove_result
     }
 
+# Search ----------------------------------------------------------------
+
+class SearchNode:
+    def __init__(self, gs, prior):
+        self.gs = gs
+        self.prior = prior
+        # Children by move, None until the node has been evaluated by the net
+        self.children = None
+        self.visits = 0
+        # Sum of the utilities in [-1,1] of the visits, from the perspective of the player who moved into this node
+        self.utility_sum = 0.0
+        # Visits currently being evaluated through this node, each counted as a loss until backed up
+        self.virtual_losses = 0
+        # Utility for the player to move according to the net, once evaluated
+        self.net_utility = None
+        self.terminal_utility = None
+
+    def is_terminal(self):
+        moves = self.gs.moves
+        return len(moves) >= 2 and moves[-1][1] == Board.PASS_LOC and moves[-2][1] == Board.PASS_LOC
+
+    def get_terminal_utility(self, rules):
+        """Utility for the player to move of the finished game, scored by area"""
+        if self.terminal_utility is not None:
+            return self.terminal_utility
+        board = self.gs.board
+        area = [-1 for i in range(board.arrsize)]
+        board.calculateArea(area,True,True,True,rules["multiStoneSuicideLegal"])
+        white_score = rules["whiteKomi"]
+        for y in range(board.size):
+            for x in range(board.size):
+                loc = board.loc(x,y)
+                if area[loc] == Board.WHITE:
+                    white_score += 1
+                elif area[loc] == Board.BLACK:
+                    white_score -= 1
+        white_utility = 0.0 if white_score == 0 else (1.0 if white_score > 0 else -1.0)
+        self.terminal_utility = white_utility if board.pla == Board.WHITE else -white_utility
+        return self.terminal_utility
+
+    def expand(self, postprocessed):
+        """Create the children of this node from the outputs of the net, and return the utility for the player to move"""
+        (policy_logits, value_logits) = postprocessed[0:2]
+        policy = torch.nn.functional.softmax(policy_logits[:,0,:],dim=1).mean(dim=0).cpu().numpy()
+        value = torch.nn.functional.softmax(value_logits,dim=1).mean(dim=0).cpu().numpy()
+        moves_and_probs = get_moves_and_probs(policy, self.gs.board)
+        probsum = sum(prob for (move,prob) in moves_and_probs)
+        self.children = {}
+        for (move,prob) in moves_and_probs:
+            self.children[move] = SearchNode(None, prob / probsum)
+        self.net_utility = float(value[0] - value[1])
+        return self.net_utility
+
+    def select_child(self, cpuct, fpu_reduction):
+        # Unvisited children start at the net's value of this node less a reduction, rather than at the average
+        # of the visits so far, so that one refuted move doesn't make all the unexplored alternatives look just as bad
+        fpu_utility = self.net_utility - fpu_reduction
+        sqrt_total = math.sqrt(max(1, self.visits + self.virtual_losses))
+        best_move = None
+        best_score = None
+        for (move,child) in self.children.items():
+            child_visits = child.visits + child.virtual_losses
+            if child_visits > 0:
+                utility = (child.utility_sum - child.virtual_losses) / child_visits
+            else:
+                utility = fpu_utility
+            score = utility + cpuct * child.prior * sqrt_total / (1 + child_visits)
+            if best_score is None or score > best_score:
+                best_move = move
+                best_score = score
+        return (best_move, self.children[best_move])
+
+
+def run_search(gs, rules, max_visits, max_time, batch_size, cpuct=1.1, fpu_reduction=0.2):
+    """
+    PUCT search from gs, until the root has max_visits visits or max_time seconds have passed, either of which may be None.
+    Each round selects up to batch_size leaves, each path taking a virtual loss so that later paths in the round
+    spread out, then evaluates all the leaves with the net as one batch and backs up their values.
+    Returns the root node.
+    """
+    assert max_visits is not None or max_time is not None
+    start_time = time.time()
+    root = SearchNode(gs.copy(), 1.0)
+
+    def backup(path, utility):
+        # utility is for the player to move at the end of the path
+        utility = -utility
+        for node in reversed(path):
+            node.utility_sum += utility
+            node.visits += 1
+            utility = -utility
+
+    def remove_virtual_loss(path):
+        for node in path:
+            node.virtual_losses -= 1
+
+    if root.is_terminal():
+        # The game is already over, so every visit would just back up the same result again
+        backup([root], root.get_terminal_utility(rules))
+        return root
+
+    while True:
+        if max_visits is not None and root.visits >= max_visits:
+            break
+        if max_time is not None and time.time() - start_time >= max_time:
+            break
+
+        num_leaves = batch_size if max_visits is None else min(batch_size, max_visits - root.visits)
+        leaf_paths = []
+        for _ in range(num_leaves):
+            path = [root]
+            node = root
+            while node.children is not None and not node.is_terminal():
+                (move, child) = node.select_child(cpuct, fpu_reduction)
+                if child.gs is None:
+                    child.gs = node.gs.copy()
+                    child.gs.play(node.gs.board.pla, move)
+                path.append(child)
+                node = child
+            for path_node in path:
+                path_node.virtual_losses += 1
+
+            if node.is_terminal():
+                remove_virtual_loss(path)
+                backup(path, node.get_terminal_utility(rules))
+            elif any(leaf_path[-1] is node for leaf_path in leaf_paths):
+                # Already being evaluated in this round, so there is no other leaf left worth exploring right now
+                remove_virtual_loss(path)
+                break
+            else:
+                leaf_paths.append(path)
+
+        if len(leaf_paths) > 0:
+            results = get_net_outputs([path[-1].gs for path in leaf_paths], rules, GENMOVE_OUTPUTS)
+            for (path, postprocessed) in zip(leaf_paths, results):
+                remove_virtual_loss(path)
+                backup(path, path[-1].expand(postprocessed))
+
+    return root
+
+
+def get_search_summary(root, board):
+    """One line per child of the root that was visited, most visited first"""
+    lines = []
+    children = sorted(root.children.items(), key=lambda move_and_child: move_and_child[1].visits, reverse=True)
+    for (move,child) in children:
+        if child.visits <= 0:
+            break
+        lines.append("%s visits %d utility %+.3f prior %.3f" % (str_coord(move,board), child.visits, child.utility_sum / child.visits, child.prior))
+    return "\n".join(lines)
+
+
 def get_input_feature(gs, rules, feature_idx):
     board = gs.board
     bin_input_data = np.zeros(shape=[1]+model.bin_input_shape, dtype=np.float32)
@@ -658,19 +924,27 @@ while True:
     elif command[0] == "play":
         pla = (Board.BLACK if command[1] == "B" or command[1] == "b" else Board.WHITE)
         loc = parse_coord(command[2],gs.board)
-        gs.board.play(pla,loc)
-        gs.moves.append((pla,loc))
-        gs.boards.append(gs.board.copy())
+        gs.play(pla,loc)
     elif command[0] == "genmove":
-        outputs = get_outputs(gs, rules)
-        loc = outputs["genmove_result"]
+        root = None
+        if search_visits is not None or search_time is not None:
+            root = run_search(gs, rules, search_visits, search_time, search_batch_size)
+            if root.children is None:
+                # The game was already over
+                root = None
+        if root is not None:
+            logging.info("Search visits %d\n%s" % (root.visits, get_search_summary(root, gs.board)))
+            # Ties, including every child having no visits when the search stopped right after expanding the root,
+            # go to the higher prior
+            loc = max(root.children.items(), key=lambda move_and_child: (move_and_child[1].visits, move_and_child[1].prior))[0]
+        else:
+            outputs = get_outputs(gs, rules, outputs=GENMOVE_OUTPUTS)
+            loc = outputs["genmove_result"]
         pla = gs.board.pla
 
         if len(command) > 1:
             pla = (Board.BLACK if command[1] == "B" or command[1] == "b" else Board.WHITE)
-        gs.board.play(pla,loc)
-        gs.moves.append((pla,loc))
-        gs.boards.append(gs.board.copy())
+        gs.play(pla,loc)
         ret = str_coord(loc,gs.board)
 
     elif command[0] == "name":
@@ -0,0 +1,187 @@
+#!/usr/bin/python3
+"""
+Int8 quantization of a Model for inference on CPU.
+
+Convolutions in the trunk are statically quantized. Their weights are quantized per output channel and their
+inputs with a fixed scale and zero point, calibrated by running the model over some rows of training data.
+Each quantized convolution dequantizes its output again, so residual sums, norms, activations, pooling and masking
+all stay in float. The heads also stay in float since they are a small share of the cost and feed straight into
+the outputs. Linear layers are dynamically quantized, which needs no calibration.
+
+Run this file directly to quantize a checkpoint and report how far its outputs move from the float model.
+"""
+import sys
+import os
+import argparse
+import itertools
+import logging
+import time
+from typing import Dict
+
+import numpy as np
+import torch
+import torch.nn
+import torch.ao.quantization
+
+from model_pytorch import Model
+import data_processing_pytorch
+from load_model import load_model
+from fuse_model import fuse_model_for_inference
+
+class QuantizedConvWrapper(torch.ao.quantization.QuantWrapper):
+    def forward(self, x):
+        # Quantized convolutions return channels last, but the rest of the model views their outputs as NCHW
+        return super().forward(x).contiguous()
+
+
+def quantize_model_for_cpu(model: Model, calibration_batches, num_calibration_batches: int) -> Model:
+    """
+    Return an int8 copy of model for CPU inference, leaving model untouched.
+    calibration_batches: batches as yielded by data_processing_pytorch.read_npz_training_data on the cpu,
+    of which the first num_calibration_batches are used to calibrate the activation scales.
+    Like fuse_model_for_inference, the result is eval-only.
+    """
+    quantized = fuse_model_for_inference(model).cpu().to(torch.float32)
+    qconfig = torch.ao.quantization.get_default_qconfig(torch.backends.quantized.engine)
+    quantized.conv_spatial = wrap_conv_for_quantization(quantized.conv_spatial, qconfig)
+    wrap_convs_for_quantization(quantized.blocks, qconfig)
+
+    torch.ao.quantization.prepare(quantized, inplace=True)
+    num_batches = 0
+    with torch.no_grad():
+        for batch in itertools.islice(calibration_batches, num_calibration_batches):
+            quantized(batch["binaryInputNCHW"], batch["globalInputNC"], full_board=batch["fullBoard"])
+            num_batches += 1
+    assert num_batches > 0, "No calibration data"
+    torch.ao.quantization.convert(quantized, inplace=True)
+    torch.ao.quantization.quantize_dynamic(quantized, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    return quantized
+
+
+def wrap_conv_for_quantization(conv: torch.nn.Conv2d, qconfig) -> torch.nn.Module:
+    # Quantized convolutions only take explicit padding
+    if conv.padding == "same":
+        assert all(k % 2 == 1 for k in conv.kernel_size), "Cannot quantize even-sized convolution with same padding"
+        conv.padding = tuple(k // 2 for k in conv.kernel_size)
+    wrapped = QuantizedConvWrapper(conv)
+    wrapped.qconfig = qconfig
+    return wrapped
+
+
+def wrap_convs_for_quantization(module: torch.nn.Module, qconfig):
+    for (name, child) in module.named_children():
+        if isinstance(child, torch.nn.Conv2d):
+            setattr(module, name, wrap_conv_for_quantization(child, qconfig))
+        else:
+            wrap_convs_for_quantization(child, qconfig)
+
+
+# Outputs of the net that compare_to_float_model looks at, see Model.forward
+COMPARED_OUTPUTS = {"policy", "value", "miscvalue"}
+
+def compare_to_float_model(float_model: Model, quantized_model: Model, batches, num_batches: int) -> Dict[str,float]:
+    """
+    Run both models over the first num_batches of batches and return how far the quantized outputs are from the float ones:
+    the mean KL divergence of the quantized main policy from the float one, the mean and max absolute error of the
+    winloss value, the mean absolute error of the score mean, and the inference time of each model per 1000 rows.
+    """
+    sums = {
+        "policy_kl": 0.0,
+        "value_abs_err": 0.0,
+        "value_max_abs_err": 0.0,
+        "scoremean_abs_err": 0.0,
+        "float_time": 0.0,
+        "int8_time": 0.0,
+    }
+    num_rows = 0
+    with torch.no_grad():
+        for batch in itertools.islice(batches, num_batches):
+            outputs = []
+            for (model, time_key) in ((float_model, "float_time"), (quantized_model, "int8_time")):
+                start = time.perf_counter()
+                model_outputs = model(batch["binaryInputNCHW"], batch["globalInputNC"], full_board=batch["fullBoard"], outputs=COMPARED_OUTPUTS)
+                sums[time_key] += time.perf_counter() - start
+                outputs.append(model.postprocess_output(model_outputs)[0])
+            (float_outputs, quantized_outputs) = outputs
+
+            float_policy = torch.log_softmax(float_outputs[0][:,0,:].to(torch.float32), dim=1)
+            quantized_policy = torch.log_softmax(quantized_outputs[0][:,0,:].to(torch.float32), dim=1)
+            sums["policy_kl"] += torch.sum(torch.exp(float_policy) * (float_policy - quantized_policy)).item()
+
+            float_value = torch.softmax(float_outputs[1].to(torch.float32), dim=1)
+            quantized_value = torch.softmax(quantized_outputs[1].to(torch.float32), dim=1)
+            value_err = torch.abs((float_value[:,0] - float_value[:,1]) - (quantized_value[:,0] - quantized_value[:,1]))
+            sums["value_abs_err"] += torch.sum(value_err).item()
+            sums["value_max_abs_err"] = max(sums["value_max_abs_err"], torch.max(value_err).item())
+
+            sums["scoremean_abs_err"] += torch.sum(torch.abs(float_outputs[8] - quantized_outputs[8])).item()
+            num_rows += batch["binaryInputNCHW"].shape[0]
+
+    assert num_rows > 0, "No data to compare on"
+    return {
+        "policy_kl": sums["policy_kl"] / num_rows,
+        "value_abs_err": sums["value_abs_err"] / num_rows,
+        "value_max_abs_err": sums["value_max_abs_err"],
+        "scoremean_abs_err": sums["scoremean_abs_err"] / num_rows,
+        "float_time/1ksamp": sums["float_time"] / num_rows * 1000.0,
+        "int8_time/1ksamp": sums["int8_time"] / num_rows * 1000.0,
+    }
+
+
+def read_cpu_batches(npzdir: str, batch_size: int, pos_len: int, model_config):
+    files = [os.path.join(npzdir,fname) for fname in os.listdir(npzdir) if data_processing_pytorch.is_training_data_file(fname)]
+    if len(files) == 0:
+        raise Exception("No npz files in " + npzdir)
+    return data_processing_pytorch.read_npz_training_data(
+        files,
+        batch_size,
+        world_size=1,
+        rank=0,
+        pos_len=pos_len,
+        device="cpu",
+        randomize_symmetries=True,
+        model_config=model_config,
+    )
+
+
+if __name__ == "__main__":
+
+    description = """
+    Quantize a neural net to int8 for CPU inference, calibrating on npz files of batches from selfplay,
+    and report how far its outputs are from the float net on the rows following the calibration rows.
+    """
+
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-npzdir', help='Directory with npz data', required=True)
+    parser.add_argument('-checkpoint', help='Checkpoint to quantize', required=True)
+    parser.add_argument('-pos-len', help='Spatial length of expected training data', type=int, required=True)
+    parser.add_argument('-batch-size', help='Batch size to use for calibration and testing', type=int, required=True)
+    parser.add_argument('-use-swa', help='Use SWA model', action="store_true", required=False)
+    parser.add_argument('-calibration-batches', help='Number of batches to calibrate on', type=int, default=8, required=False)
+    parser.add_argument('-test-batches', help='Number of batches to compare the quantized and float models on', type=int, default=32, required=False)
+
+    args = vars(parser.parse_args())
+
+    logging.root.handlers = []
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(message)s",
+        handlers=[
+            logging.StreamHandler(stream=sys.stdout)
+        ],
+    )
+    np.set_printoptions(linewidth=150)
+
+    logging.info(str(sys.argv))
+    logging.info("Quantized engine: " + torch.backends.quantized.engine)
+
+    model, swa_model, _ = load_model(args["checkpoint"], args["use_swa"], device="cpu", pos_len=args["pos_len"], verbose=True)
+    if swa_model is not None:
+        model = swa_model.module
+    float_model = fuse_model_for_inference(model)
+
+    batches = read_cpu_batches(args["npzdir"], args["batch_size"], args["pos_len"], model.config)
+    quantized_model = quantize_model_for_cpu(model, batches, args["calibration_batches"])
+    # The same generator continues past the calibration batches, so the comparison is on different rows
+    stats = compare_to_float_model(float_model, quantized_model, batches, args["test_batches"])
+    logging.info("Int8 vs float: " + ", ".join(["%s = %f" % (key, stats[key]) for key in stats]))
@@ -20,6 +20,8 @@ import multiprocessing
 
 import numpy as np
 
+import npz_row_index
+
 keys = [
     "binaryInputNCHWPacked",
     "globalInputNC",
@@ -29,9 +31,35 @@ keys = [
     "valueTargetsNCHW"
 ]
 
+output_formats = ["npz", "uncompressed-npz", "npydir"]
+
 def is_temp_npz_like(filename):
     return "_" in filename
 
+def output_file_extension(output_format):
+    if output_format == "npydir":
+        return ".npydir"
+    return ".npz"
+
+def save_training_data(filename, output_format, **arrays):
+    """
+    Write arrays keyed by the names in keys, in one of output_formats:
+    npz - np.savez_compressed
+    uncompressed-npz - np.savez, no zlib decompression needed to read it back
+    npydir - a directory containing one raw KEY.npy per key, which readers can np.load with mmap_mode="r"
+    """
+    assert(set(arrays.keys()) == set(keys))
+    if output_format == "npz":
+        np.savez_compressed(filename, **arrays)
+    elif output_format == "uncompressed-npz":
+        np.savez(filename, **arrays)
+    elif output_format == "npydir":
+        os.mkdir(filename)
+        for key in keys:
+            np.save(os.path.join(filename, key + ".npy"), arrays[key])
+    else:
+        assert False, "Unknown output format: " + str(output_format)
+
 def joint_shuffle_take_first_n(n,arrs):
     for arr in arrs:
         assert(len(arr) == len(arrs[0]))
@@ -45,81 +73,30 @@ def joint_shuffle_take_first_n(n,arrs):
 def memusage_mb():
     return psutil.Process(os.getpid()).memory_info().rss // 1048576
 
-def shardify(input_idx, input_file_group, num_out_files, out_tmp_dirs, keep_prob):
-    np.random.seed([int.from_bytes(os.urandom(4), byteorder='little') for i in range(4)])
-
-    assert(len(input_file_group) > 0)
-    num_files_not_found = 0
-
-    if len(input_file_group) == 1:
-        try:
-            with np.load(input_file_group[0]) as npz:
-                assert(set(npz.keys()) == set(keys))
-                ###
-                #WARNING - if adding anything here, also add it to joint_shuffle below!
-                ###
-                binaryInputNCHWPacked = npz["binaryInputNCHWPacked"]
-                globalInputNC = npz["globalInputNC"]
-                policyTargetsNCMove = npz["policyTargetsNCMove"]
-                globalTargetsNC = npz["globalTargetsNC"]
-                scoreDistrN = npz["scoreDistrN"]
-                valueTargetsNCHW = npz["valueTargetsNCHW"]
-        except FileNotFoundError:
-            num_files_not_found += 1
-            print("WARNING: file not found by shardify: ", input_file_group[0])
-            return num_files_not_found # Early quit since we don't know shapes
-    else:
-        binaryInputNCHWPackedList = []
-        globalInputNCList = []
-        policyTargetsNCMoveList = []
-        globalTargetsNCList = []
-        scoreDistrNList = []
-        valueTargetsNCHWList = []
-
-        for input_file in input_file_group:
-            try:
-                with np.load(input_file) as npz:
-                    assert(set(npz.keys()) == set(keys))
-                    binaryInputNCHWPackedList.append(npz["binaryInputNCHWPacked"])
-                    globalInputNCList.append(npz["globalInputNC"])
-                    policyTargetsNCMoveList.append(npz["policyTargetsNCMove"])
-                    globalTargetsNCList.append(npz["globalTargetsNC"])
-                    scoreDistrNList.append(npz["scoreDistrN"])
-                    valueTargetsNCHWList.append(npz["valueTargetsNCHW"])
-            except FileNotFoundError:
-                num_files_not_found += 1
-                print("WARNING: file not found by shardify: ", input_file)
-                pass
-        if len(binaryInputNCHWPackedList) <= 0:
-            return num_files_not_found # Early quit since we don't know shapes
-
-        binaryInputNCHWPacked = np.concatenate(binaryInputNCHWPackedList,axis=0)
-        globalInputNC = np.concatenate(globalInputNCList,axis=0)
-        policyTargetsNCMove = np.concatenate(policyTargetsNCMoveList,axis=0)
-        globalTargetsNC = np.concatenate(globalTargetsNCList,axis=0)
-        scoreDistrN = np.concatenate(scoreDistrNList,axis=0)
-        valueTargetsNCHW = np.concatenate(valueTargetsNCHWList,axis=0)
-
-    num_rows_to_keep = binaryInputNCHWPacked.shape[0]
-    assert(globalInputNC.shape[0] == num_rows_to_keep)
-    assert(policyTargetsNCMove.shape[0] == num_rows_to_keep)
-    assert(globalTargetsNC.shape[0] == num_rows_to_keep)
-    assert(scoreDistrN.shape[0] == num_rows_to_keep)
-    assert(valueTargetsNCHW.shape[0] == num_rows_to_keep)
+def load_training_data(filename):
+    """Load the arrays for each of keys from an npz file or an npydir written by save_training_data"""
+    if os.path.isdir(filename):
+        return [np.load(os.path.join(filename, key + ".npy")) for key in keys]
+    with np.load(filename) as npz:
+        assert(set(npz.keys()) == set(keys))
+        return [npz[key] for key in keys]
+
+def write_temp_shards(shard_name, arrs, num_out_files, out_tmp_dirs, keep_prob):
+    """
+    Shuffle arrs (one per key in keys), keep about keep_prob of the rows, and split them randomly into num_out_files shards,
+    written as shard_name.npz in each of out_tmp_dirs.
+    """
+    num_rows_to_keep = arrs[0].shape[0]
+    for arr in arrs:
+        assert(arr.shape[0] == num_rows_to_keep)
 
     if keep_prob < 1.0:
         num_rows_to_keep = min(num_rows_to_keep,int(round(num_rows_to_keep * keep_prob)))
 
-    [binaryInputNCHWPacked,globalInputNC,policyTargetsNCMove,globalTargetsNC,scoreDistrN,valueTargetsNCHW] = (
-        joint_shuffle_take_first_n(num_rows_to_keep,[binaryInputNCHWPacked,globalInputNC,policyTargetsNCMove,globalTargetsNC,scoreDistrN,valueTargetsNCHW])
-    )
+    arrs = joint_shuffle_take_first_n(num_rows_to_keep,arrs)
 
-    assert(binaryInputNCHWPacked.shape[0] == num_rows_to_keep)
-    assert(globalInputNC.shape[0] == num_rows_to_keep)
-    assert(policyTargetsNCMove.shape[0] == num_rows_to_keep)
-    assert(globalTargetsNC.shape[0] == num_rows_to_keep)
-    assert(scoreDistrN.shape[0] == num_rows_to_keep)
-    assert(valueTargetsNCHW.shape[0] == num_rows_to_keep)
+    for arr in arrs:
+        assert(arr.shape[0] == num_rows_to_keep)
 
     rand_assts = np.random.randint(num_out_files,size=[num_rows_to_keep])
     counts = np.bincount(rand_assts,minlength=num_out_files)
@@ -133,17 +110,80 @@ def shardify(input_idx, input_file_group, num_out_files, out_tmp_dirs, keep_prob
         start = countsums[out_idx]-counts[out_idx]
         stop = countsums[out_idx]
         np.savez_compressed(
-            os.path.join(out_tmp_dirs[out_idx], str(input_idx) + ".npz"),
-            binaryInputNCHWPacked = binaryInputNCHWPacked[start:stop],
-            globalInputNC = globalInputNC[start:stop],
-            policyTargetsNCMove = policyTargetsNCMove[start:stop],
-            globalTargetsNC = globalTargetsNC[start:stop],
-            scoreDistrN = scoreDistrN[start:stop],
-            valueTargetsNCHW = valueTargetsNCHW[start:stop]
+            os.path.join(out_tmp_dirs[out_idx], shard_name + ".npz"),
+            **{key: arr[start:stop] for (key,arr) in zip(keys,arrs)}
         )
+
+def shardify(input_idx, input_file_group, destinations, memory_budget_bytes=None):
+    """
+    Read every file in input_file_group once and write its rows into temporary shards for each destination.
+    destinations is a list of (num_out_files, out_tmp_dirs, keep_prob, file_idxs), where file_idxs are the
+    indices within input_file_group of the files whose rows belong to that destination.
+
+    If memory_budget_bytes is specified, files are read and sharded a chunk at a time, each chunk holding roughly
+    that many bytes of rows, so a destination may receive several temporary shards from this group.
+    """
+    np.random.seed([int.from_bytes(os.urandom(4), byteorder='little') for i in range(4)])
+
+    assert(len(input_file_group) > 0)
+    num_files_not_found = 0
+
+    def write_chunk(arrs_by_file_idx, chunk_idx):
+        shard_name = "%d.%d" % (input_idx, chunk_idx)
+        for (num_out_files, out_tmp_dirs, keep_prob, file_idxs) in destinations:
+            arrs_list = [arrs_by_file_idx[file_idx] for file_idx in file_idxs if file_idx in arrs_by_file_idx]
+            if len(arrs_list) <= 0:
+                continue # Nothing for this destination, and we don't know shapes
+            if len(arrs_list) == 1:
+                arrs = arrs_list[0]
+            else:
+                arrs = [np.concatenate([file_arrs[i] for file_arrs in arrs_list],axis=0) for i in range(len(keys))]
+            write_temp_shards(shard_name, arrs, num_out_files, out_tmp_dirs, keep_prob)
+            del arrs
+            del arrs_list
+
+    arrs_by_file_idx = {}
+    chunk_bytes = 0
+    chunk_idx = 0
+    for (file_idx,input_file) in enumerate(input_file_group):
+        try:
+            arrs_by_file_idx[file_idx] = load_training_data(input_file)
+        except FileNotFoundError:
+            num_files_not_found += 1
+            print("WARNING: file not found by shardify: ", input_file)
+            continue
+        chunk_bytes += sum(arr.nbytes for arr in arrs_by_file_idx[file_idx])
+        if memory_budget_bytes is not None and chunk_bytes >= memory_budget_bytes:
+            write_chunk(arrs_by_file_idx, chunk_idx)
+            arrs_by_file_idx = {}
+            chunk_bytes = 0
+            chunk_idx += 1
+
+    if len(arrs_by_file_idx) > 0:
+        write_chunk(arrs_by_file_idx, chunk_idx)
+
     return num_files_not_found
 
-def merge_shards(filename, num_shards_to_merge, out_tmp_dir, batch_size, ensure_batch_multiple, output_npz):
+def get_shard_row_shapes_and_dtypes(shard_filename):
+    """From the npz headers of a shard, return (num_rows, [(row_shape, dtype) for each key in keys])"""
+    npheaders = get_numpy_npz_headers(shard_filename)
+    assert npheaders is not None, "Bad temporary shard: " + shard_filename
+    shapes_and_dtypes = []
+    for key in keys:
+        (shape, is_fortran, dtype) = npheaders[key + ".npy"]
+        shapes_and_dtypes.append((shape, dtype))
+    num_rows = shapes_and_dtypes[0][0][0]
+    return (num_rows, [(shape[1:], dtype) for (shape, dtype) in shapes_and_dtypes])
+
+def merge_shards(filename, out_tmp_dir, batch_size, ensure_batch_multiple, output_npz, output_format="npz", memory_budget_bytes=None):
+    """
+    Merge all the temporary shards in out_tmp_dir into one shuffled output file, truncated to a whole number of batches.
+
+    Only the shard headers are read up front, so that the output arrays can be allocated once at their final size and then
+    each shard's rows written straight into their randomly permuted slots, one shard at a time.
+    If memory_budget_bytes is specified and the output would be larger than that, the output arrays are disk-backed
+    np.memmap arrays in out_tmp_dir instead.
+    """
     np.random.seed([int.from_bytes(os.urandom(4), byteorder='little') for i in range(5)])
 
     if output_npz:
@@ -151,85 +191,58 @@ def merge_shards(filename, num_shards_to_merge, out_tmp_dir, batch_size, ensure_
     else:
         assert False, "No longer supports outputting tensorflow data"
 
-    binaryInputNCHWPackeds = []
-    globalInputNCs = []
-    policyTargetsNCMoves = []
-    globalTargetsNCs = []
-    scoreDistrNs = []
-    valueTargetsNCHWs = []
-
-    for input_idx in range(num_shards_to_merge):
-        shard_filename = os.path.join(out_tmp_dir, str(input_idx) + ".npz")
-        try:
-            with np.load(shard_filename) as npz:
-                assert(set(npz.keys()) == set(keys))
-
-                binaryInputNCHWPacked = npz["binaryInputNCHWPacked"]
-                globalInputNC = npz["globalInputNC"]
-                policyTargetsNCMove = npz["policyTargetsNCMove"]
-                globalTargetsNC = npz["globalTargetsNC"]
-                scoreDistrN = npz["scoreDistrN"]
-                valueTargetsNCHW = npz["valueTargetsNCHW"]
-
-                binaryInputNCHWPackeds.append(binaryInputNCHWPacked)
-                globalInputNCs.append(globalInputNC)
-                policyTargetsNCMoves.append(policyTargetsNCMove)
-                globalTargetsNCs.append(globalTargetsNC)
-                scoreDistrNs.append(scoreDistrN)
-                valueTargetsNCHWs.append(valueTargetsNCHW)
-        except FileNotFoundError:
-            print("WARNING: Empty shard in merge_shards for shard :", input_idx, filename)
-
-    if len(binaryInputNCHWPackeds) <= 0:
+    shard_filenames = sorted(os.path.join(out_tmp_dir, name) for name in os.listdir(out_tmp_dir) if name.endswith(".npz"))
+    if len(shard_filenames) <= 0:
         print("WARNING: empty merge file: ", filename)
         return 0
 
-    ###
-    #WARNING - if adding anything here, also add it to joint_shuffle below!
-    ###
-    binaryInputNCHWPacked = np.concatenate(binaryInputNCHWPackeds)
-    globalInputNC = np.concatenate(globalInputNCs)
-    policyTargetsNCMove = np.concatenate(policyTargetsNCMoves)
-    globalTargetsNC = np.concatenate(globalTargetsNCs)
-    scoreDistrN = np.concatenate(scoreDistrNs)
-    valueTargetsNCHW = np.concatenate(valueTargetsNCHWs)
-
-    num_rows = binaryInputNCHWPacked.shape[0]
-    assert(globalInputNC.shape[0] == num_rows)
-    assert(policyTargetsNCMove.shape[0] == num_rows)
-    assert(globalTargetsNC.shape[0] == num_rows)
-    assert(scoreDistrN.shape[0] == num_rows)
-    assert(valueTargetsNCHW.shape[0] == num_rows)
-
-    [binaryInputNCHWPacked,globalInputNC,policyTargetsNCMove,globalTargetsNC,scoreDistrN,valueTargetsNCHW] = (
-        joint_shuffle_take_first_n(num_rows,[binaryInputNCHWPacked,globalInputNC,policyTargetsNCMove,globalTargetsNC,scoreDistrN,valueTargetsNCHW])
-    )
+    shard_infos = [get_shard_row_shapes_and_dtypes(shard_filename) for shard_filename in shard_filenames]
+    num_rows = sum(num_shard_rows for (num_shard_rows,_) in shard_infos)
+    (_, row_shapes_and_dtypes) = shard_infos[0]
+    for (_, shard_row_shapes_and_dtypes) in shard_infos:
+        assert(shard_row_shapes_and_dtypes == row_shapes_and_dtypes)
 
-    assert(binaryInputNCHWPacked.shape[0] == num_rows)
-    assert(globalInputNC.shape[0] == num_rows)
-    assert(policyTargetsNCMove.shape[0] == num_rows)
-    assert(globalTargetsNC.shape[0] == num_rows)
-    assert(scoreDistrN.shape[0] == num_rows)
-    assert(valueTargetsNCHW.shape[0] == num_rows)
+    #Just truncate and lose the batch at the end, it's fine
+    num_batches = (num_rows // (batch_size * ensure_batch_multiple)) * ensure_batch_multiple
+    num_rows_to_write = num_batches * batch_size
+
+    out_bytes = sum(num_rows_to_write * int(np.prod(row_shape)) * dtype.itemsize for (row_shape, dtype) in row_shapes_and_dtypes)
+    memmap_filenames = None
+    if memory_budget_bytes is not None and out_bytes > memory_budget_bytes:
+        memmap_filenames = [os.path.join(out_tmp_dir, "merge." + key + ".npy") for key in keys]
+        out_arrs = [
+            np.lib.format.open_memmap(memmap_filename, mode="w+", dtype=dtype, shape=(num_rows_to_write,) + tuple(row_shape))
+            for (memmap_filename, (row_shape, dtype)) in zip(memmap_filenames, row_shapes_and_dtypes)
+        ]
+    else:
+        out_arrs = [np.empty((num_rows_to_write,) + tuple(row_shape), dtype=dtype) for (row_shape, dtype) in row_shapes_and_dtypes]
+
+    # A uniformly random destination for every row. Rows landing past the end are dropped, which is the same as
+    # shuffling everything and then truncating to a whole number of batches.
+    dest_idxs = np.random.permutation(num_rows)
+    start = 0
+    for (shard_filename, (num_shard_rows, _)) in zip(shard_filenames, shard_infos):
+        arrs = load_training_data(shard_filename)
+        for arr in arrs:
+            assert(arr.shape[0] == num_shard_rows)
+        shard_dest_idxs = dest_idxs[start:start+num_shard_rows]
+        kept = shard_dest_idxs < num_rows_to_write
+        for (out_arr, arr) in zip(out_arrs, arrs):
+            out_arr[shard_dest_idxs[kept]] = arr[kept]
+        start += num_shard_rows
+        del arrs
+    assert(start == num_rows)
 
     # print("%s: Merge writing... (mem usage %dMB)" % (str(datetime.datetime.now()),memusage_mb()), flush=True)
 
-    #Just truncate and lose the batch at the end, it's fine
-    num_batches = (num_rows // (batch_size * ensure_batch_multiple)) * ensure_batch_multiple
     if output_npz:
-        start = 0
-        stop = num_batches*batch_size
-        np.savez_compressed(
-            filename,
-            binaryInputNCHWPacked = binaryInputNCHWPacked[start:stop],
-            globalInputNC = globalInputNC[start:stop],
-            policyTargetsNCMove = policyTargetsNCMove[start:stop],
-            globalTargetsNC = globalTargetsNC[start:stop],
-            scoreDistrN = scoreDistrN[start:stop],
-            valueTargetsNCHW = valueTargetsNCHW[start:stop]
-        )
+        save_training_data(filename, output_format, **dict(zip(keys, out_arrs)))
     else:
         assert False, "No longer supports outputting tensorflow data"
+    del out_arrs
+    if memmap_filenames is not None:
+        for memmap_filename in memmap_filenames:
+            os.remove(memmap_filename)
 
     jsonfilename = os.path.splitext(filename)[0] + ".json"
     with open(jsonfilename,"w") as f:
@@ -259,25 +272,30 @@ def get_numpy_npz_headers(filename):
         return npzheaders
 
 
+# Returns (filename, num_rows, is_permanent), where is_permanent is False if the file could not be read for
+# a reason that may go away on a later run, so that its None should not be recorded in the row index
 def compute_num_rows(filename):
     try:
         npheaders = get_numpy_npz_headers(filename)
     except PermissionError:
         print("WARNING: No permissions for reading file: ", filename)
-        return (filename,None)
+        return (filename,None,False)
     except zipfile.BadZipFile:
         print("WARNING: Bad zip file: ", filename)
-        return (filename,None)
+        return (filename,None,True)
+    except OSError as e:
+        print("WARNING: Could not read file, skipping it for now: ", filename, str(e))
+        return (filename,None,False)
     if npheaders is None or len(npheaders) <= 0:
         print("WARNING: bad npz headers for file: ", filename)
-        return (filename,None)
+        return (filename,None,True)
 
     if "binaryInputNCHWPacked" in npheaders:
         (shape, is_fortran, dtype) = npheaders["binaryInputNCHWPacked"]
     else:
         (shape, is_fortran, dtype) = npheaders["binaryInputNCHWPacked.npy"]
     num_rows = shape[0]
-    return (filename,num_rows)
+    return (filename,num_rows,True)
 
 
 class TimeStuff(object):
@@ -353,8 +371,11 @@ if __name__ == '__main__':
     optional_args.add_argument('-add-to-data-rows', type=float, required=False, help='Compute the window size as if the number of data rows were this much larger/smaller')
     optional_args.add_argument('-add-to-window-size', type=float, required=False, help='DEPRECATED due to being misnamed name, use -add-to-data-rows')
     optional_args.add_argument('-summary-file', required=False, help='Summary json file for directory contents')
-    required_args.add_argument('-out-dir', required=True, help='Dir to output training files')
-    required_args.add_argument('-out-tmp-dir', required=True, help='Dir to use as scratch space')
+    optional_args.add_argument('-row-index-file', required=False, help='Sqlite file caching the row count of each npz file by path and mtime, shared with other scripts, created if needed')
+    optional_args.add_argument('-out-dir', required=False, help='Dir to output training files, required unless using -split')
+    optional_args.add_argument('-out-tmp-dir', required=False, help='Dir to use as scratch space, required unless using -split')
+    optional_args.add_argument('-split', nargs=5, action='append', required=False, metavar=('OUT_DIR','OUT_TMP_DIR','KEEP_TARGET_ROWS','MD5_LBOUND','MD5_UBOUND'),
+                               help='Instead of -out-dir, -out-tmp-dir, -keep-target-rows and -only-include-md5-path-prop-*, output to OUT_DIR using scratch OUT_TMP_DIR, keeping KEEP_TARGET_ROWS rows from filepaths hashing to float in [MD5_LBOUND,MD5_UBOUND). May be repeated, e.g. for train and val, to shuffle all of them in one pass over the data.')
     optional_args.add_argument('-approx-rows-per-out-file', type=int, required=False, default=70000, help='Number of rows per output file, default 70k')
     required_args.add_argument('-num-processes', type=int, required=True, help='Number of multiprocessing processes for shuffling in parallel')
     required_args.add_argument('-batch-size', type=int, required=True, help='Batch size to write training examples in')
@@ -365,7 +386,10 @@ if __name__ == '__main__':
     optional_args.add_argument('-exclude-basename', required=False, action="store_true", help='Consider an exclude to match if basename matches')
     optional_args.add_argument('-only-include-md5-path-prop-lbound', type=float, required=False, help='Just before sharding, include only filepaths hashing to float >= this')
     optional_args.add_argument('-only-include-md5-path-prop-ubound', type=float, required=False, help='Just before sharding, include only filepaths hashing to float < this')
+    optional_args.add_argument('-memory-budget-mb', type=float, required=False, help='Approximate memory per process for holding rows. Sharding reads input groups in chunks of this size, and merging larger than this streams through disk in the tmp dir. Default unbounded')
+    optional_args.add_argument('-incremental-from-dir', required=False, help='Dir containing the previous shuffle output for each out dir (by basename, e.g. the old shuffleddata/current). Only shard files that are new since then, and subsample the old output for the rest of the window')
     optional_args.add_argument('-output-npz', action="store_true", required=False, help='Output results as npz files')
+    optional_args.add_argument('-output-format', required=False, default="npz", choices=output_formats, help='Format of output files: npz (compressed, default), uncompressed-npz, or npydir (a dir of raw .npy arrays that train.py memory-maps)')
 
     args = parser.parse_args()
     dirs = args.dirs
@@ -383,6 +407,7 @@ if __name__ == '__main__':
         add_to_data_rows = args.add_to_window_size
 
     summary_file = args.summary_file
+    row_index_file = args.row_index_file
     out_dir = args.out_dir
     out_tmp_dir = args.out_tmp_dir
     approx_rows_per_out_file = args.approx_rows_per_out_file
@@ -400,14 +425,43 @@ if __name__ == '__main__':
     only_include_md5_path_prop_lbound = args.only_include_md5_path_prop_lbound
     only_include_md5_path_prop_ubound = args.only_include_md5_path_prop_ubound
     output_npz = args.output_npz
+    output_format = args.output_format
+    incremental_from_dir = args.incremental_from_dir
+    memory_budget_bytes = None
+    if args.memory_budget_mb is not None:
+        memory_budget_bytes = int(args.memory_budget_mb * 1048576)
 
     if min_rows is None:
         print("NOTE: -min-rows was not specified, defaulting to requiring 250K rows before shuffling.")
         min_rows = 250000
-    if keep_target_rows is None:
+    splits = []
+    if args.split is not None:
+        if out_dir is not None or out_tmp_dir is not None or keep_target_rows is not None or only_include_md5_path_prop_lbound is not None or only_include_md5_path_prop_ubound is not None:
+            raise Exception("Cannot specify -split together with -out-dir, -out-tmp-dir, -keep-target-rows, or -only-include-md5-path-prop-*")
+        for (split_out_dir,split_out_tmp_dir,split_keep_target_rows,split_lbound,split_ubound) in args.split:
+            splits.append(dict(
+                out_dir=split_out_dir,
+                out_tmp_dir=split_out_tmp_dir,
+                keep_target_rows=int(split_keep_target_rows),
+                md5_lbound=float(split_lbound),
+                md5_ubound=float(split_ubound),
+            ))
+        if len(set(split["out_tmp_dir"] for split in splits)) != len(splits):
+            raise Exception("Each -split must use a different OUT_TMP_DIR")
+    elif out_dir is None or out_tmp_dir is None:
+        raise Exception("Must specify either -split or both -out-dir and -out-tmp-dir")
+    elif keep_target_rows is None:
         print("NOTE: -keep-target-rows was not specified, defaulting to sampling a random 20M rows out of the computed window.")
         print("If you intended to shuffle the whole dataset instead, pass in -keep-target-rows <very large number>")
         keep_target_rows = 20000000
+    if len(splits) <= 0:
+        splits.append(dict(
+            out_dir=out_dir,
+            out_tmp_dir=out_tmp_dir,
+            keep_target_rows=keep_target_rows,
+            md5_lbound=only_include_md5_path_prop_lbound,
+            md5_ubound=only_include_md5_path_prop_ubound,
+        ))
     if add_to_data_rows is None:
         add_to_data_rows = 0
 
@@ -541,8 +595,9 @@ if __name__ == '__main__':
 
     with TimeStuff("Computing rows for unsummarized files"):
         with multiprocessing.Pool(num_processes) as pool:
-            results = pool.map(compute_num_rows,files_with_unknown_num_rows)
-            results = dict(results)
+            results = npz_row_index.compute_num_rows_using_index(
+                row_index_file, [info for info in all_files if len(info) < 3], compute_num_rows, pool
+            )
             for i in range(len(all_files)):
                 info = all_files[i]
                 if len(info) < 3:
@@ -587,9 +642,10 @@ if __name__ == '__main__':
             else:
                 num_random_rows_capped = min(num_random_rows_capped + num_rows, min_rows)
 
-    if os.path.exists(out_dir):
-        raise Exception(out_dir + " already exists")
-    os.mkdir(out_dir)
+    for split in splits:
+        if os.path.exists(split["out_dir"]):
+            raise Exception(split["out_dir"] + " already exists")
+        os.mkdir(split["out_dir"])
 
     if num_rows_total <= 0:
         print("No rows found")
@@ -649,51 +705,64 @@ if __name__ == '__main__':
     np.random.seed()
     np.random.shuffle(desired_input_files)
 
-    approx_rows_to_keep = num_rows_used
-    if keep_target_rows is not None:
-        approx_rows_to_keep = min(approx_rows_to_keep, keep_target_rows)
-    keep_prob = approx_rows_to_keep / num_rows_used
+    def md5_path_prop(input_file):
+        input_file_base = os.path.basename(input_file)
+        return int("0x"+hashlib.md5(str(input_file_base).encode('utf-8')).hexdigest()[:13],16) / 2 ** 52
 
-    num_out_files = int(round(approx_rows_to_keep / approx_rows_per_out_file))
-    num_out_files = max(num_out_files,1)
+    for split in splits:
+        split_out_dir = split["out_dir"]
+        approx_rows_to_keep = num_rows_used
+        if split["keep_target_rows"] is not None:
+            approx_rows_to_keep = min(approx_rows_to_keep, split["keep_target_rows"])
+        split["keep_prob"] = approx_rows_to_keep / num_rows_used
 
-    if output_npz:
-        out_files = [os.path.join(out_dir, "data%d.npz" % i) for i in range(num_out_files)]
-    else:
-        assert False, "No longer supports outputting tensorflow data"
+        num_out_files = int(round(approx_rows_to_keep / approx_rows_per_out_file))
+        num_out_files = max(num_out_files,1)
+
+        if output_npz:
+            split["out_files"] = [os.path.join(split_out_dir, "data%d%s" % (i, output_file_extension(output_format))) for i in range(num_out_files)]
+        else:
+            assert False, "No longer supports outputting tensorflow data"
 
-    out_tmp_dirs = [os.path.join(out_tmp_dir, "tmp.shuf%d" % i) for i in range(num_out_files)]
-    print("Writing %d output files with %d kept / %d desired rows" % (num_out_files, approx_rows_to_keep, desired_num_rows), flush=True)
+        split["out_tmp_dirs"] = [os.path.join(split["out_tmp_dir"], "tmp.shuf%d" % i) for i in range(num_out_files)]
+        print("%s: Writing %d output files with %d kept / %d desired rows" % (split_out_dir, num_out_files, approx_rows_to_keep, desired_num_rows), flush=True)
 
     def clean_tmp_dirs():
-        for tmp_dir in out_tmp_dirs:
-            if os.path.exists(tmp_dir):
-                print("Cleaning up tmp dir: " + tmp_dir)
-                shutil.rmtree(tmp_dir)
+        for split in splits:
+            for tmp_dir in split["out_tmp_dirs"]:
+                if os.path.exists(tmp_dir):
+                    print("Cleaning up tmp dir: " + tmp_dir)
+                    shutil.rmtree(tmp_dir)
 
     clean_tmp_dirs()
-    for tmp_dir in out_tmp_dirs:
-        os.mkdir(tmp_dir)
-
-    num_rows_in_desired_files = 0
-    if only_include_md5_path_prop_lbound is not None or only_include_md5_path_prop_ubound is not None:
-        new_desired_input_files = []
-        for (input_file,num_rows_in_file) in desired_input_files:
-            input_file_base = os.path.basename(input_file)
-            hashfloat = int("0x"+hashlib.md5(str(input_file_base).encode('utf-8')).hexdigest()[:13],16) / 2 ** 52
-            ok = True
-            if only_include_md5_path_prop_lbound is not None and hashfloat < only_include_md5_path_prop_lbound:
-                ok = False
-            if only_include_md5_path_prop_ubound is not None and hashfloat >= only_include_md5_path_prop_ubound:
-                ok = False
-            if ok:
-                new_desired_input_files.append((input_file,num_rows_in_file))
-                num_rows_in_desired_files += num_rows_in_file
-        print("Due to only_include_md5, filtering down to %d/%d files" % (len(new_desired_input_files),len(desired_input_files)))
-        desired_input_files = new_desired_input_files
-    else:
+    for split in splits:
+        for tmp_dir in split["out_tmp_dirs"]:
+            os.mkdir(tmp_dir)
+
+    # Route each file to every split whose md5 path range it falls in
+    split_idxs_by_file = {}
+    for (split_idx,split) in enumerate(splits):
+        num_files_in_split = 0
+        num_rows_in_split = 0
         for (input_file,num_rows_in_file) in desired_input_files:
-            num_rows_in_desired_files += num_rows_in_file
+            if split["md5_lbound"] is not None or split["md5_ubound"] is not None:
+                hashfloat = md5_path_prop(input_file)
+                if split["md5_lbound"] is not None and hashfloat < split["md5_lbound"]:
+                    continue
+                if split["md5_ubound"] is not None and hashfloat >= split["md5_ubound"]:
+                    continue
+            split_idxs_by_file.setdefault(input_file,[]).append(split_idx)
+            num_files_in_split += 1
+            num_rows_in_split += num_rows_in_file
+        if split["md5_lbound"] is not None or split["md5_ubound"] is not None:
+            print("%s: Due to only_include_md5, filtering down to %d/%d files" % (split["out_dir"],num_files_in_split,len(desired_input_files)))
+        if num_files_in_split <= 0:
+            print("%s: No files after filtering for desired range" % split["out_dir"])
+        elif num_rows_in_split <= 0:
+            print("%s: No rows in desired files" % split["out_dir"])
+
+    desired_input_files = [(input_file,num_rows_in_file) for (input_file,num_rows_in_file) in desired_input_files if input_file in split_idxs_by_file]
+    num_rows_in_desired_files = sum(num_rows_in_file for (input_file,num_rows_in_file) in desired_input_files)
 
     if len(desired_input_files) <= 0:
         print("No files after filtering for desired range")
@@ -702,6 +771,53 @@ if __name__ == '__main__':
         print("No rows in desired files")
         sys.exit(0)
 
+    for (split_idx,split) in enumerate(splits):
+        split["input_files"] = [input_file for (input_file,num_rows_in_file) in desired_input_files if split_idx in split_idxs_by_file[input_file]]
+        split["prev_output_files"] = []
+
+    # Incremental mode - files already shuffled into the previous output don't need to be read again.
+    # Instead, take a uniform subsample of the previous output rows, sized so that those old files are still represented
+    # at the current keep_prob. Rows from files that have since left the window are diluted among them, which is fine
+    # since the window only moves a little between runs.
+    if incremental_from_dir is not None:
+        for (split_idx,split) in enumerate(splits):
+            prev_out_dir = os.path.join(incremental_from_dir, os.path.basename(os.path.normpath(split["out_dir"])))
+            prev_manifest = None
+            try:
+                with open(prev_out_dir + ".json") as f:
+                    prev_manifest = json.load(f)
+            except (OSError, ValueError):
+                pass
+            if prev_manifest is None or "input_files" not in prev_manifest or "output_files" not in prev_manifest:
+                print("%s: No usable previous shuffle at %s, shuffling from scratch" % (split["out_dir"],prev_out_dir), flush=True)
+                continue
+
+            prev_input_files = set(prev_manifest["input_files"])
+            num_rows_by_file = dict(desired_input_files)
+            old_input_files = [input_file for input_file in split["input_files"] if input_file in prev_input_files]
+            num_old_rows = sum(num_rows_by_file[input_file] for input_file in old_input_files)
+            num_prev_output_rows = sum(num_rows for (out_file_base,num_rows) in prev_manifest["output_files"])
+            num_old_rows_to_keep = num_old_rows * split["keep_prob"]
+            # Merging truncates each output file to a whole number of batches, so tolerate that much shortfall
+            max_truncated_rows = len(prev_manifest["output_files"]) * batch_size * ensure_batch_multiple
+            if num_old_rows <= 0 or num_prev_output_rows <= 0 or num_old_rows_to_keep > num_prev_output_rows + max_truncated_rows:
+                print("%s: Previous shuffle has %d rows, not enough to stand in for %d old rows, shuffling from scratch" % (
+                    split["out_dir"],num_prev_output_rows,num_old_rows_to_keep
+                ), flush=True)
+                continue
+
+            for input_file in old_input_files:
+                split_idxs_by_file[input_file].remove(split_idx)
+            split["prev_output_keep_prob"] = min(1.0, num_old_rows_to_keep / num_prev_output_rows)
+            split["prev_output_files"] = [
+                os.path.join(prev_out_dir,out_file_base) for (out_file_base,num_rows) in prev_manifest["output_files"] if num_rows > 0
+            ]
+            print("%s: Incremental, sharding %d new files and keeping %d/%d rows of previous shuffle for %d old files" % (
+                split["out_dir"],len(split["input_files"])-len(old_input_files),num_old_rows_to_keep,num_prev_output_rows,len(old_input_files)
+            ), flush=True)
+
+        desired_input_files = [(input_file,num_rows_in_file) for (input_file,num_rows_in_file) in desired_input_files if len(split_idxs_by_file[input_file]) > 0]
+
     # Clump files into sharding groups. More efficient if shuffling a ton of small npz files
     # since we aren't doing separate tasks for every individual file but rather handling a bunch
     # of files at once, and also makes chunkier shards on disk when it comes time to shuffle.
@@ -723,26 +839,43 @@ if __name__ == '__main__':
         group_size_so_far = 0
     print("Grouping %d input files into %d sharding groups" % (len(desired_input_files),len(desired_input_file_groups)),flush=True)
 
+    shardify_args = []
+    for input_file_group in desired_input_file_groups:
+        destinations = []
+        for (split_idx,split) in enumerate(splits):
+            file_idxs = [file_idx for (file_idx,input_file) in enumerate(input_file_group) if split_idx in split_idxs_by_file[input_file]]
+            destinations.append((len(split["out_files"]), split["out_tmp_dirs"], split["keep_prob"], file_idxs))
+        shardify_args.append((len(shardify_args), input_file_group, destinations, memory_budget_bytes))
+    # Each previous output file is its own sharding group, going only to its own split
+    for split in splits:
+        for prev_output_file in split["prev_output_files"]:
+            destinations = [(len(split["out_files"]), split["out_tmp_dirs"], split["prev_output_keep_prob"], [0])]
+            shardify_args.append((len(shardify_args), [prev_output_file], destinations, memory_budget_bytes))
+
     with multiprocessing.Pool(num_processes) as pool:
         with TimeStuff("Sharding"):
-            shard_results = pool.starmap(shardify, [
-                (input_idx, desired_input_file_groups[input_idx], num_out_files, out_tmp_dirs, keep_prob) for input_idx in range(len(desired_input_file_groups))
-            ])
+            shard_results = pool.starmap(shardify, shardify_args)
 
         with TimeStuff("Merging"):
-            num_shards_to_merge = len(desired_input_file_groups)
-            merge_results = pool.starmap(merge_shards, [
-                (out_files[idx],num_shards_to_merge,out_tmp_dirs[idx],batch_size,ensure_batch_multiple,output_npz) for idx in range(len(out_files))
-            ])
+            merge_args = []
+            for split in splits:
+                for idx in range(len(split["out_files"])):
+                    merge_args.append((split["out_files"][idx],split["out_tmp_dirs"][idx],batch_size,ensure_batch_multiple,output_npz,output_format,memory_budget_bytes))
+            merge_results = pool.starmap(merge_shards, merge_args)
         print("Number of rows by output file:",flush=True)
-        print(list(zip(out_files,merge_results)),flush=True)
+        print(list(zip([merge_arg[0] for merge_arg in merge_args],merge_results)),flush=True)
         sys.stdout.flush()
 
     clean_tmp_dirs()
 
-    dump_value = {
-        "range": (min_start_row, max_end_row)
-    }
-
-    with open(out_dir + ".json", 'w') as f:
-        json.dump(dump_value, f)
+    num_rows_by_out_file = dict(zip([merge_arg[0] for merge_arg in merge_args],merge_results))
+    for split in splits:
+        # Record what went into this output so that a later -incremental-from-dir run can reuse it
+        dump_value = {
+            "range": (min_start_row, max_end_row),
+            "keep_prob": split["keep_prob"],
+            "input_files": split["input_files"],
+            "output_files": [(os.path.basename(out_file), num_rows_by_out_file[out_file]) for out_file in split["out_files"]],
+        }
+        with open(split["out_dir"] + ".json", 'w') as f:
+            json.dump(dump_value, f)
@@ -41,38 +41,16 @@ echo "Beginning shuffle at" $(date "+%Y-%m-%d %H:%M:%S")
          "$BASEDIR"/selfplay/ \
          -expand-window-per-row 0.3 \
          -taper-window-exponent 0.8 \
-         -out-dir "$BASEDIR"/shuffleddata/$OUTDIRTRAIN \
-         -out-tmp-dir "$TMPDIR"/train \
+         -split "$BASEDIR"/shuffleddata/$OUTDIRTRAIN "$TMPDIR"/train 2100000 0.00 0.97 \
+         -split "$BASEDIR"/shuffleddata/$OUTDIRVAL "$TMPDIR"/val 51200 0.97 1.00 \
+         -row-index-file "$BASEDIR"/selfplay_row_index.sqlite \
          -approx-rows-per-out-file 50000 \
          -num-processes "$NTHREADS" \
          -batch-size "$BATCHSIZE" \
          -min-rows 150000 \
-         -keep-target-rows 2100000 \
-         -only-include-md5-path-prop-lbound 0.00 \
-         -only-include-md5-path-prop-ubound 0.97 \
          -output-npz \
          "$@" \
-         2>&1 | tee "$BASEDIR"/shuffleddata/$OUTDIR/outtrain.txt &
-
-    wait
-)
-(
-    time python ./shuffle.py \
-         "$BASEDIR"/selfplay/ \
-         -expand-window-per-row 0.3 \
-         -taper-window-exponent 0.8 \
-         -out-dir "$BASEDIR"/shuffleddata/$OUTDIRVAL \
-         -out-tmp-dir "$TMPDIR"/val \
-         -approx-rows-per-out-file 50000 \
-         -num-processes "$NTHREADS" \
-         -batch-size "$BATCHSIZE" \
-         -min-rows 150000 \
-         -keep-target-rows 51200 \
-         -only-include-md5-path-prop-lbound 0.97 \
-         -only-include-md5-path-prop-ubound 1.00 \
-         -output-npz \
-         "$@" \
-         2>&1 | tee "$BASEDIR"/shuffleddata/$OUTDIR/outval.txt &
+         2>&1 | tee "$BASEDIR"/shuffleddata/$OUTDIR/outshuffle.txt &
 
     wait
 )
@@ -15,6 +15,8 @@ import multiprocessing
 
 import numpy as np
 
+import npz_row_index
+
 def get_numpy_npz_headers(filename):
     with zipfile.ZipFile(filename) as z:
         wasbad = False
@@ -37,9 +39,19 @@ def get_numpy_npz_headers(filename):
 def is_temp_npz_like(filename):
     return "_" in filename
 
-def summarize_dir(dirpath):
+def summarize_dir(dirpath, row_index_file=None):
     filenames = [filename for filename in os.listdir(dirpath) if filename.endswith('.npz')]
 
+    index = None
+    indexed_num_rows = {}
+    new_filepath_mtime_num_rowss = []
+    if row_index_file is not None:
+        index = npz_row_index.NpzRowIndex(row_index_file)
+        indexed_num_rows = index.lookup([
+            (os.path.join(dirpath,filename), os.path.getmtime(os.path.join(dirpath,filename)))
+            for filename in filenames if not is_temp_npz_like(filename)
+        ])
+
     num_rows_this_dir = 0
     filename_mtime_num_rowss = []
     for filename in filenames:
@@ -52,6 +64,15 @@ def summarize_dir(dirpath):
             filename_mtime_num_rowss.append((filename,mtime,None))
             continue
 
+        if filepath in indexed_num_rows:
+            num_rows = indexed_num_rows[filepath]
+            if num_rows is not None:
+                num_rows_this_dir += num_rows
+            filename_mtime_num_rowss.append((filename,mtime,num_rows))
+            continue
+
+        # Permanently bad files are recorded in the index too, so that we don't keep rereading them.
+        # Files we merely failed to read this time are left out of the index so that the next run retries them.
         try:
             npheaders = get_numpy_npz_headers(filepath)
         except PermissionError:
@@ -61,11 +82,17 @@ def summarize_dir(dirpath):
         except zipfile.BadZipFile:
             print("WARNING: Bad zip file: ", filepath)
             filename_mtime_num_rowss.append((filename,mtime,None))
+            new_filepath_mtime_num_rowss.append((filepath,mtime,None))
+            continue
+        except OSError as e:
+            print("WARNING: Could not read file, skipping it for now: ", filepath, str(e))
+            filename_mtime_num_rowss.append((filename,mtime,None))
             continue
 
         if npheaders is None or len(npheaders) <= 0:
             print("WARNING: bad npz headers for file: ", filepath)
             filename_mtime_num_rowss.append((filename,mtime,None))
+            new_filepath_mtime_num_rowss.append((filepath,mtime,None))
             continue
 
         if "binaryInputNCHWPacked" in npheaders:
@@ -76,6 +103,11 @@ def summarize_dir(dirpath):
         num_rows_this_dir += num_rows
 
         filename_mtime_num_rowss.append((filename,mtime,num_rows))
+        new_filepath_mtime_num_rowss.append((filepath,mtime,num_rows))
+
+    if index is not None:
+        index.record(new_filepath_mtime_num_rowss)
+        index.close()
 
     print("Summarizing new dir with %d rows: %s" % (num_rows_this_dir,dirpath),flush=True)
     return (dirpath, filename_mtime_num_rowss, num_rows_this_dir)
@@ -101,12 +133,14 @@ if __name__ == '__main__':
     parser.add_argument('dirs', metavar='DIR', nargs='+', help='Directories of training data files')
     parser.add_argument('-old-summary-file-to-assume-correct', required=False, help='Summary json file for directory contents')
     parser.add_argument('-new-summary-file', required=True, help='Summary json file for directory contents')
+    parser.add_argument('-row-index-file', required=False, help='Sqlite file caching the row count of each npz file by path and mtime, shared with shuffle.py and count_data_and_wait.py')
     parser.add_argument('-num-parallel-processes', required=False, type=int, help='Number of parallel processes to use, default 4')
 
     args = parser.parse_args()
     dirs = args.dirs
     old_summary_file_to_assume_correct = args.old_summary_file_to_assume_correct
     new_summary_file = args.new_summary_file
+    row_index_file = args.row_index_file
 
     num_processes = 4
     if args.num_parallel_processes is not None:
@@ -167,7 +201,7 @@ if __name__ == '__main__':
 
     with TimeStuff("Parallel summarizing %d dirs" % len(dirs_to_handle)):
         with multiprocessing.Pool(num_processes) as pool:
-            results = pool.map(summarize_dir,dirs_to_handle)
+            results = pool.starmap(summarize_dir,[(dirpath,row_index_file) for dirpath in dirs_to_handle])
 
     num_total_rows = 0
     with TimeStuff("Merging %d results" % len(results)):
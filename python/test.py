@@ -21,6 +21,7 @@ from model_pytorch import Model
 from metrics_pytorch import Metrics
 import data_processing_pytorch
 from load_model import load_model
+from fuse_model import fuse_model_for_inference
 
 # HANDLE COMMAND AND ARGS -------------------------------------------------------------------
 
@@ -103,11 +104,14 @@ def main(args):
         model = Model(model_config,pos_len)
         model.initialize()
         model.to(device)
+        swa_model = None
     else:
         model, swa_model, _ = load_model(checkpoint_file, use_swa, device=device, pos_len=pos_len, verbose=True)
         model_config = model.config
 
     metrics_obj = Metrics(batch_size,world_size,model)
+    # Metrics reads weight norms from the unfused model, the fused one is only used for the forward pass
+    inference_model = fuse_model_for_inference(swa_model.module if swa_model is not None else model)
 
     # METRICS -----------------------------------------------------------------------------------
     def detensorify_metrics(metrics):
@@ -158,7 +162,7 @@ def main(args):
 
     # Validate
     logging.info("Beginning test!")
-    val_files = [os.path.join(npzdir,fname) for fname in os.listdir(npzdir) if fname.endswith(".npz")]
+    val_files = [os.path.join(npzdir,fname) for fname in os.listdir(npzdir) if data_processing_pytorch.is_training_data_file(fname)]
     if len(val_files) == 0:
         raise Exception("No npz files in " + npzdir)
 
@@ -189,10 +193,7 @@ def main(args):
             end = torch.cuda.Event(enable_timing=True)
 
             start.record()
-            if swa_model is not None:
-                model_outputs = swa_model(batch["binaryInputNCHW"],batch["globalInputNC"])
-            else:
-                model_outputs = model(batch["binaryInputNCHW"],batch["globalInputNC"])
+            model_outputs = inference_model(batch["binaryInputNCHW"],batch["globalInputNC"],full_board=batch["fullBoard"])
             end.record()
             torch.cuda.synchronize()
             time_elapsed = start.elapsed_time(end) / 1000.0
@@ -0,0 +1,79 @@
+import copy
+
+import pytest
+import torch
+
+import modelconfigs
+from model_pytorch import Model
+
+POS_LEN = 7
+
+def make_batch(config, seed):
+    gen = torch.Generator().manual_seed(seed)
+    n = 4
+    num_bin_features = modelconfigs.get_num_bin_input_features(config)
+    num_global_features = modelconfigs.get_num_global_input_features(config)
+    input_spatial = (torch.rand((n, num_bin_features, POS_LEN, POS_LEN), generator=gen) < 0.3).to(torch.float32)
+    # Mix full boards with smaller ones, so that masking is exercised too
+    on_board = torch.ones((n, 1, POS_LEN, POS_LEN))
+    on_board[2:, :, 5:, :] = 0.0
+    on_board[2:, :, :, 5:] = 0.0
+    input_spatial = input_spatial * on_board
+    input_spatial[:, 0:1] = on_board
+    input_global = torch.rand((n, num_global_features), generator=gen)
+    return (input_spatial, input_global)
+
+def loss_of_outputs(outputs_byheads):
+    gen = torch.Generator().manual_seed(12345)
+    loss = 0.0
+    for out in outputs_byheads[0]:
+        loss = loss + torch.sum(out * torch.randn(out.shape, generator=gen))
+    return loss
+
+def make_models(model_kind, checkpoint_every):
+    config = modelconfigs.config_of_name[model_kind]
+    torch.manual_seed(0)
+    model = Model(config, POS_LEN)
+    model.initialize()
+    if config["norm_kind"] == "brenorm":
+        # Loose enough that r and d actually change the outputs
+        model.set_brenorm_params(0.01, 2.0, 1.0)
+    model.train()
+    checkpointed_model = copy.deepcopy(model)
+    checkpointed_model.set_activation_checkpointing(checkpoint_every)
+    return (config, model, checkpointed_model)
+
+def train_step(model, batch):
+    model.zero_grad(set_to_none=True)
+    loss_of_outputs(model(*batch)).backward()
+
+def assert_same_grads_and_buffers(model, checkpointed_model):
+    for ((name, param), (_, checkpointed_param)) in zip(model.named_parameters(), checkpointed_model.named_parameters()):
+        assert torch.allclose(param.grad, checkpointed_param.grad, rtol=1e-4, atol=1e-6), name
+    for ((name, buf), (_, checkpointed_buf)) in zip(model.named_buffers(), checkpointed_model.named_buffers()):
+        assert torch.allclose(buf, checkpointed_buf, rtol=1e-5, atol=1e-7), name
+
+@pytest.mark.parametrize("model_kind", ["b6c96-bn", "b6c96-brn"])
+@pytest.mark.parametrize("checkpoint_every", [1, 2])
+def test_checkpointing_matches_gradients_and_running_stats(model_kind, checkpoint_every):
+    (config, model, checkpointed_model) = make_models(model_kind, checkpoint_every)
+    initial_buffers = [buf.clone() for buf in model.buffers()]
+
+    for seed in range(2):
+        batch = make_batch(config, seed)
+        train_step(model, batch)
+        train_step(checkpointed_model, batch)
+        # Running stats of the norms must have been updated exactly as often as without checkpointing
+        assert_same_grads_and_buffers(model, checkpointed_model)
+
+    assert any(not torch.equal(initial, buf) for (initial, buf) in zip(initial_buffers, model.buffers()))
+
+@pytest.mark.parametrize("model_kind", ["b6c96-brn"])
+def test_forward_without_backward_does_not_affect_later_steps(model_kind):
+    (config, model, checkpointed_model) = make_models(model_kind, 1)
+
+    # A training forward pass whose loss is dropped, such as a skipped step, then a normal step
+    for m in (model, checkpointed_model):
+        m(*make_batch(config, 100))
+        train_step(m, make_batch(config, 101))
+    assert_same_grads_and_buffers(model, checkpointed_model)
@@ -0,0 +1,20 @@
+import numpy as np
+import pytest
+import torch
+
+from data_processing_pytorch import unpack_binary_input_numpy, unpack_binary_input_torch
+
+# 19*19 and 9*9 bits are not a multiple of 8, so the last byte of each channel is only partly used
+@pytest.mark.parametrize("pos_len", [19, 9, 8, 7])
+def test_torch_unpack_matches_numpy(pos_len):
+    rand = np.random.default_rng(seed=pos_len)
+    num_bytes = (pos_len * pos_len + 7) // 8
+    # Random bytes everywhere, including the padding bits past pos_len*pos_len that both paths should drop
+    packed = rand.integers(0, 256, size=(5, 22, num_bytes), dtype=np.uint8)
+
+    expected = unpack_binary_input_numpy(packed, pos_len)
+    actual = unpack_binary_input_torch(torch.from_numpy(packed), pos_len)
+
+    assert actual.dtype == torch.float32
+    assert actual.shape == (5, 22, pos_len, pos_len)
+    assert np.array_equal(actual.numpy(), expected)
@@ -18,6 +18,7 @@ import numpy as np
 import itertools
 import copy
 import atexit
+import threading
 from collections import defaultdict
 from typing import Dict, List
 
@@ -91,6 +92,12 @@ if __name__ == "__main__":
     optional_args.add_argument('-no-export', help='Do not export models', required=False, action='store_true')
     optional_args.add_argument('-no-repeat-files', help='Track what shuffled data was used and do not repeat, even when killed and resumed', required=False, action='store_true')
     optional_args.add_argument('-quit-if-no-data', help='If no data, quit instead of waiting for data', required=False, action='store_true')
+    optional_args.add_argument('-per-row-symmetries', help='Apply an independent random symmetry to every row of a batch rather than one per batch', required=False, action='store_true')
+    optional_args.add_argument('-num-prefetch-files', help='Number of npz files to load ahead in the background while training, default 2', type=int, default=2, required=False)
+    optional_args.add_argument('-micro-batches', help='Accumulate gradients over this many loader batches of batch-size/micro-batches rows per optimizer step, default 1', type=int, default=1, required=False)
+    optional_args.add_argument('-activation-checkpoint-every', help='Recompute activations of every Nth trunk block during backward to save memory, default 0 (off)', type=int, default=0, required=False)
+    optional_args.add_argument('-crop-to-boards', help='Run the net only on the smallest box containing every board in each batch, for data with boards smaller than pos-len', required=False, action='store_true')
+    optional_args.add_argument('-checkpoint-every-samples', help='Also checkpoint partway through epochs this often, in samples, recording the data position so a restart resumes at the next batch', type=float, required=False)
 
     optional_args.add_argument('-gnorm-stats-debug', required=False, action='store_true')
 
@@ -172,6 +179,12 @@ def main(rank: int, world_size: int, args, multi_gpu_device_ids, readpipes, writ
     no_export = args["no_export"]
     no_repeat_files = args["no_repeat_files"]
     quit_if_no_data = args["quit_if_no_data"]
+    num_prefetch_files = args["num_prefetch_files"]
+    per_row_symmetries = args["per_row_symmetries"]
+    checkpoint_every_samples = args["checkpoint_every_samples"]
+    activation_checkpoint_every = args["activation_checkpoint_every"]
+    micro_batches = args["micro_batches"]
+    crop_to_boards = args["crop_to_boards"]
 
     gnorm_stats_debug = args["gnorm_stats_debug"]
 
@@ -213,6 +226,12 @@ def main(rank: int, world_size: int, args, multi_gpu_device_ids, readpipes, writ
     assert (swa_period_samples is None) == (swa_scale is None)
     assert (lookahead_k is None) == (lookahead_alpha is None)
 
+    # batch_size is what an optimizer step trains on and what hyperparameters are in terms of,
+    # micro_batch_size is how much goes through the model at once
+    assert micro_batches >= 1
+    assert batch_size % micro_batches == 0, "batch_size must be a multiple of micro_batches"
+    micro_batch_size = batch_size // micro_batches
+
     # SET UP LOGGING -------------------------------------------------------------
 
     logging.root.handlers = []
@@ -274,11 +293,88 @@ def main(rank: int, world_size: int, args, multi_gpu_device_ids, readpipes, writ
         return os.path.join(traindir,f"checkpoint_prev{i}.ckpt")
 
     NUM_SHORTTERM_CHECKPOINTS_TO_KEEP = 4
-    def save(ddp_model, swa_model, optimizer, metrics_obj, running_metrics, train_state, last_val_metrics, path=None):
+
+    # Checkpoints are written to disk by a background thread so that training doesn't stall on the write.
+    # save() snapshots everything to host memory first, and at most one write is in flight at a time.
+    checkpoint_writer = { "thread": None, "error": None }
+
+    def wait_for_checkpoint_write():
+        thread = checkpoint_writer["thread"]
+        if thread is not None:
+            thread.join()
+            checkpoint_writer["thread"] = None
+        error = checkpoint_writer["error"]
+        if error is not None:
+            checkpoint_writer["error"] = None
+            raise RuntimeError("Writing checkpoint failed") from error
+
+    def snapshot_to_host(obj):
+        if isinstance(obj, torch.Tensor):
+            return obj.detach().to("cpu", copy=True)
+        if isinstance(obj, dict):
+            # Shallow copy first to keep the dict type and attributes, such as the _metadata of module state dicts
+            ret = copy.copy(obj)
+            for key in ret:
+                ret[key] = snapshot_to_host(ret[key])
+            return ret
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(snapshot_to_host(x) for x in obj)
+        return copy.deepcopy(obj)
+
+    def fsync_dir(dirpath):
+        try:
+            fd = os.open(dirpath, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def write_checkpoint_file(state_dict, path):
+        with open(path + ".tmp", "wb") as f:
+            torch.save(state_dict, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        fsync_dir(os.path.dirname(os.path.abspath(path)))
+
+    def rotate_checkpoints():
+        for i in reversed(range(NUM_SHORTTERM_CHECKPOINTS_TO_KEEP-1)):
+            if os.path.exists(get_checkpoint_prev_path(i)):
+                os.replace(get_checkpoint_prev_path(i), get_checkpoint_prev_path(i+1))
+        if os.path.exists(get_checkpoint_path()):
+            # Checkpoints are only ever replaced, never modified in place, so a hardlink is as good as a copy
+            try:
+                os.link(get_checkpoint_path(), get_checkpoint_prev_path(0))
+            except OSError as e:
+                logging.warning("Could not hardlink previous checkpoint, copying instead: " + str(e))
+                shutil.copy(get_checkpoint_path(), get_checkpoint_prev_path(0))
+
+    def write_checkpoint(state_dict, path):
+        try:
+            t0 = time.perf_counter()
+            if path is not None:
+                write_checkpoint_file(state_dict, path)
+                time.sleep(1)
+            else:
+                path = get_checkpoint_path()
+                rotate_checkpoints()
+                write_checkpoint_file(state_dict, path)
+            logging.info("Finished writing checkpoint %s in %.1f seconds" % (path, time.perf_counter() - t0))
+        except BaseException as e:
+            logging.error("Failed writing checkpoint: " + str(e))
+            checkpoint_writer["error"] = e
+
+    def save(ddp_model, swa_model, optimizer, metrics_obj, running_metrics, train_state, last_val_metrics, path=None, wait=False):
         if gnorm_stats_debug:
             logging.warning("Skipping save since debugging gnorm stats")
             return
         if rank == 0:
+            wait_for_checkpoint_write()
+
             state_dict = {}
             state_dict["model"] = ddp_model.state_dict()
             state_dict["optimizer"] = optimizer.state_dict()
@@ -291,20 +387,15 @@ def main(rank: int, world_size: int, args, multi_gpu_device_ids, readpipes, writ
             if swa_model is not None:
                 state_dict["swa_model"] = swa_model.state_dict()
 
-            if path is not None:
-                logging.info("Saving checkpoint: " + path)
-                torch.save(state_dict, path + ".tmp")
-                time.sleep(1)
-                os.replace(path + ".tmp", path)
-            else:
-                logging.info("Saving checkpoint: " + get_checkpoint_path())
-                for i in reversed(range(NUM_SHORTTERM_CHECKPOINTS_TO_KEEP-1)):
-                    if os.path.exists(get_checkpoint_prev_path(i)):
-                        os.replace(get_checkpoint_prev_path(i), get_checkpoint_prev_path(i+1))
-                if os.path.exists(get_checkpoint_path()):
-                    shutil.copy(get_checkpoint_path(), get_checkpoint_prev_path(0))
-                torch.save(state_dict, get_checkpoint_path() + ".tmp")
-                os.replace(get_checkpoint_path() + ".tmp", get_checkpoint_path())
+            state_dict = snapshot_to_host(state_dict)
+
+            logging.info("Saving checkpoint: " + (path if path is not None else get_checkpoint_path()))
+            # Not a daemon thread, so that exiting still lets the write finish
+            thread = threading.Thread(target=write_checkpoint, args=(state_dict, path), name="checkpoint_writer")
+            checkpoint_writer["thread"] = thread
+            thread.start()
+            if wait:
+                wait_for_checkpoint_write()
 
     def get_weight_decay(raw_model, lr_scale, warmup_scale, train_state, running_metrics, group_name):
         lr_scale *= lr_scale_auto_factor(train_state)
@@ -426,10 +517,11 @@ def main(rank: int, world_size: int, args, multi_gpu_device_ids, readpipes, writ
             swa_model = None
             if rank == 0 and swa_scale is not None:
                 new_factor = 1.0 / swa_scale
-                ema_avg = lambda avg_param, cur_param, num_averaged: avg_param + new_factor * (cur_param - avg_param)
-                swa_model = AveragedModel(raw_model, avg_fn=ema_avg)
+                # avg_params += new_factor * (cur_params - avg_params), for all params at once
+                ema_multi_avg = lambda avg_params, cur_params, num_averaged: torch._foreach_lerp_(avg_params, cur_params, new_factor)
+                swa_model = AveragedModel(raw_model, multi_avg_fn=ema_multi_avg)
 
-            metrics_obj = Metrics(batch_size,world_size,raw_model)
+            metrics_obj = Metrics(micro_batch_size,world_size,raw_model)
             running_metrics = {}
             train_state = {}
             last_val_metrics = {}
@@ -480,13 +572,14 @@ def main(rank: int, world_size: int, args, multi_gpu_device_ids, readpipes, writ
             swa_model = None
             if rank == 0 and swa_scale is not None:
                 new_factor = 1.0 / swa_scale
-                ema_avg = lambda avg_param, cur_param, num_averaged: avg_param + new_factor * (cur_param - avg_param)
-                swa_model = AveragedModel(raw_model, avg_fn=ema_avg)
+                # avg_params += new_factor * (cur_params - avg_params), for all params at once
+                ema_multi_avg = lambda avg_params, cur_params, num_averaged: torch._foreach_lerp_(avg_params, cur_params, new_factor)
+                swa_model = AveragedModel(raw_model, multi_avg_fn=ema_multi_avg)
                 swa_model_state_dict = load_model.load_swa_model_state_dict(state_dict)
                 if swa_model_state_dict is not None:
                     swa_model.load_state_dict(swa_model_state_dict)
 
-            metrics_obj = Metrics(batch_size,world_size,raw_model)
+            metrics_obj = Metrics(micro_batch_size,world_size,raw_model)
             if "metrics" in state_dict:
                 metrics_obj.load_state_dict(state_dict["metrics"])
             else:
@@ -513,6 +606,11 @@ def main(rank: int, world_size: int, args, multi_gpu_device_ids, readpipes, writ
             return (model_config, ddp_model, raw_model, swa_model, optimizer, metrics_obj, running_metrics, train_state, last_val_metrics)
 
     (model_config, ddp_model, raw_model, swa_model, optimizer, metrics_obj, running_metrics, train_state, last_val_metrics) = load()
+    if crop_to_boards:
+        logging.info("Cropping each batch to the boards it contains")
+    if activation_checkpoint_every > 0:
+        logging.info(f"Using activation checkpointing every {activation_checkpoint_every} trunk blocks")
+        raw_model.set_activation_checkpointing(activation_checkpoint_every)
 
 
     if "global_step_samples" not in train_state:
@@ -552,6 +650,7 @@ def main(rank: int, world_size: int, args, multi_gpu_device_ids, readpipes, writ
             assert False, "Please specify both of main_loss_scale and intermediate_loss_scale or neither when using an architecture with an intermediate head."
 
 
+    logging.info(f"micro_batches {micro_batches}, micro_batch_size {micro_batch_size}")
     logging.info(f"swa_period_samples {swa_period_samples}")
     logging.info(f"swa_scale {swa_scale}")
     logging.info(f"lookahead_alpha {lookahead_alpha}")
@@ -584,6 +683,22 @@ def main(rank: int, world_size: int, args, multi_gpu_device_ids, readpipes, writ
                 lookahead_cache[param] = torch.zeros_like(param.data)
                 lookahead_cache[param] = lookahead_cache[param].copy_(param.data)
         logging.info(f"Using lookahead optimizer {lookahead_alpha} {lookahead_k}")
+    # Same params as lists, for updating them all at once with multi-tensor foreach ops
+    lookahead_fast_params = list(lookahead_cache.keys())
+    lookahead_slow_params = list(lookahead_cache.values())
+
+    # 3x3 conv weights whose center tap gets double the learning rate, by doubling its gradient.
+    # Each gets a full-size scale tensor, 2 at the center tap and 1 elsewhere, since the multi-tensor kernels
+    # need every tensor in the list to be contiguous and the same shape as the gradient it multiplies.
+    repvgg_conv_params = []
+    repvgg_grad_scales = []
+    if "use_repvgg_learning_rate" in model_config and model_config["use_repvgg_learning_rate"]:
+        for name, param in ddp_model.named_parameters():
+            if "normactconv" in name and ".conv.weight" in name and len(param.shape) == 4 and param.shape[2] == 3 and param.shape[3] == 3:
+                repvgg_conv_params.append(param)
+                grad_scale = torch.ones_like(param.data)
+                grad_scale[:,:,1,1] = 2.0
+                repvgg_grad_scales.append(grad_scale)
 
     # EPOCHS AND LR ---------------------------------------------------------------------
 
@@ -754,7 +869,7 @@ def main(rank: int, world_size: int, args, multi_gpu_device_ids, readpipes, writ
 
                 # Load training data files
                 tdatadir = os.path.join(curdatadir,"train")
-                train_files = [os.path.join(tdatadir,fname) for fname in os.listdir(tdatadir) if fname.endswith(".npz")]
+                train_files = [os.path.join(tdatadir,fname) for fname in os.listdir(tdatadir) if data_processing_pytorch.is_training_data_file(fname)]
 
                 # Make sure we're not repeating stuff if we're not supposed to repeat stuff
                 if no_repeat_files:
@@ -812,6 +927,28 @@ def main(rank: int, world_size: int, args, multi_gpu_device_ids, readpipes, writ
 
             break
 
+    # Record where in the current subepoch we are, for checkpoints saved partway through an epoch.
+    # The subepoch's files are consumed as one concatenated stream of rows in whole global batches, so resuming
+    # from a file index and row offset in that stream continues with exactly the next batch.
+    def make_data_cursor(subepoch_idx, batch_count_this_epoch, train_files_to_use, num_rows_consumed, symmetry_rand):
+        file_idx = 0
+        row_offset = num_rows_consumed
+        while file_idx < len(train_files_to_use):
+            num_rows = data_processing_pytorch.get_num_rows_of_training_file(train_files_to_use[file_idx])
+            if row_offset < num_rows:
+                break
+            row_offset -= num_rows
+            file_idx += 1
+        return {
+            "subepoch_idx": subepoch_idx,
+            "batch_count_this_epoch": batch_count_this_epoch,
+            "files": list(train_files_to_use),
+            "num_rows_consumed": num_rows_consumed,
+            "file_idx": file_idx,
+            "row_offset": row_offset,
+            "symmetry_rng_state": copy.deepcopy(symmetry_rand.bit_generator.state),
+        }
+
     # Load all the files we should train on during a subepoch
     def get_files_for_subepoch():
         nonlocal trainfilegenerator
@@ -863,11 +1000,27 @@ def main(rank: int, world_size: int, args, multi_gpu_device_ids, readpipes, writ
                 ret[key] = metrics[key]
         return ret
 
+    def get_forward_hints(batch):
+        if crop_to_boards:
+            return dict(full_board=batch["fullBoardBounds"], board_bounds=batch["boardBounds"])
+        return dict(full_board=batch["fullBoard"])
+
+    def detach_metrics(metrics):
+        ret = {}
+        for key in metrics:
+            if isinstance(metrics[key], torch.Tensor):
+                ret[key] = metrics[key].detach()
+            else:
+                ret[key] = metrics[key]
+        return ret
+
     # _sum metrics dict entries will get reported as a moving average of their values
     # _batch metrics dict entries will reported as the average per-batch value over the time since the last log
     # All other values will get reported as a total sum across the entire run so far.
 
-    def accumulate_metrics(metric_sums, metric_weights, metrics, batch_size, decay, new_weight):
+    # Metric values and metric_weight_scales may be tensors, in which case the sums are accumulated on the device.
+    # metric_weight_scales optionally scales the weight of a metric for this batch, e.g. 0 to exclude it.
+    def accumulate_metrics(metric_sums, metric_weights, metrics, batch_size, decay, new_weight, metric_weight_scales=None):
         if decay != 1.0:
             for metric in metric_sums:
                 if metric.endswith("_sum"):
@@ -875,15 +1028,54 @@ def main(rank: int, world_size: int, args, multi_gpu_device_ids, readpipes, writ
                     metric_weights[metric] *= decay
 
         for metric in metrics:
+            weight_scale = 1.0 if metric_weight_scales is None else metric_weight_scales.get(metric, 1.0)
             if metric.endswith("_sum"):
                 metric_sums[metric] += metrics[metric] * new_weight
-                metric_weights[metric] += batch_size * new_weight
+                metric_weights[metric] += batch_size * new_weight * weight_scale
             elif metric.endswith("_batch"):
                 metric_sums[metric] += metrics[metric] * new_weight
-                metric_weights[metric] += 1 * new_weight
+                metric_weights[metric] += 1 * new_weight * weight_scale
             else:
                 metric_sums[metric] += metrics[metric]
-                metric_weights[metric] += batch_size
+                metric_weights[metric] += batch_size * weight_scale
+
+    # Training metrics are accumulated on the device into pending_metrics and only brought back to the host
+    # in flush_pending_metrics, once per print and before saving, so that the training loop never has to wait on the device.
+    # pending_metrics["decay"] is the total decay since the last flush that still needs applying to the _sum
+    # metrics already in running_metrics.
+    def new_pending_metrics():
+        return {"sums": defaultdict(float), "weights": defaultdict(float), "decay": 1.0}
+
+    def accumulate_pending_metrics(pending_metrics, metrics, batch_size, decay, new_weight, metric_weight_scales=None):
+        accumulate_metrics(pending_metrics["sums"], pending_metrics["weights"], metrics, batch_size, decay, new_weight, metric_weight_scales)
+        pending_metrics["decay"] *= decay
+
+    def flush_pending_metrics(pending_metrics, running_metrics):
+        # Copy every pending tensor to the host in a single transfer
+        tensor_entries = []
+        for entries in (pending_metrics["sums"], pending_metrics["weights"]):
+            for metric in entries:
+                if isinstance(entries[metric], torch.Tensor):
+                    tensor_entries.append((entries, metric))
+        if len(tensor_entries) > 0:
+            values = torch.stack([entries[metric].detach().to(torch.float64).reshape(()) for (entries, metric) in tensor_entries]).cpu().tolist()
+            for ((entries, metric), value) in zip(tensor_entries, values):
+                entries[metric] = value
+
+        decay = pending_metrics["decay"]
+        if decay != 1.0:
+            for metric in running_metrics["sums"]:
+                if metric.endswith("_sum"):
+                    running_metrics["sums"][metric] *= decay
+                    running_metrics["weights"][metric] *= decay
+        for metric in pending_metrics["sums"]:
+            running_metrics["sums"][metric] += pending_metrics["sums"][metric]
+        for metric in pending_metrics["weights"]:
+            running_metrics["weights"][metric] += pending_metrics["weights"][metric]
+
+        pending_metrics["sums"] = defaultdict(float)
+        pending_metrics["weights"] = defaultdict(float)
+        pending_metrics["decay"] = 1.0
 
     def log_metrics(metric_sums, metric_weights, metrics, metrics_out):
         metrics_to_print = {}
@@ -928,6 +1120,7 @@ def main(rank: int, world_size: int, args, multi_gpu_device_ids, readpipes, writ
         running_metrics["weights"] = defaultdict(float)
     else:
         running_metrics["weights"] = defaultdict(float,running_metrics["weights"])
+    pending_metrics = new_pending_metrics()
 
     torch.backends.cudnn.benchmark = True
 
@@ -937,6 +1130,19 @@ def main(rank: int, world_size: int, args, multi_gpu_device_ids, readpipes, writ
     else:
         logging.info("Training in FP32.")
 
+    # If the checkpoint was saved partway through an epoch, pick up that epoch where it left off
+    resume_cursor = train_state.pop("data_cursor", None)
+    if resume_cursor is not None and rank == 0:
+        # shuffle.sh prunes old shuffled data, so the interrupted subepoch's files may be gone by now.
+        # Then we still resume the epoch, but redo that subepoch from the start with fresh files.
+        missing_files = [filename for filename in resume_cursor["files"] if not os.path.exists(filename)]
+        if len(missing_files) > 0:
+            logging.warning("WARNING: %d of the %d files of the interrupted subepoch no longer exist, e.g. %s, starting the subepoch fresh" % (
+                len(missing_files), len(resume_cursor["files"]), missing_files[0]
+            ))
+            resume_cursor["files"] = None
+    samples_since_last_checkpoint = 0
+
     # All ddp threads should be lined up at this point before continuing
     if barrier is not None:
         barrier.wait()
@@ -945,7 +1151,8 @@ def main(rank: int, world_size: int, args, multi_gpu_device_ids, readpipes, writ
         if rank == 0:
             maybe_reload_training_data()
 
-            if max_train_bucket_per_new_data is not None:
+            # A resumed epoch already took its rows from the bucket before it was interrupted
+            if max_train_bucket_per_new_data is not None and resume_cursor is None:
                 if train_state["train_bucket_level"] > 0.99 * samples_per_epoch:
                     logging.info("Consuming %.0f rows from train bucket (%.0f -> %.0f)" % (
                         samples_per_epoch, train_state["train_bucket_level"], train_state["train_bucket_level"]-samples_per_epoch
@@ -989,21 +1196,32 @@ def main(rank: int, world_size: int, args, multi_gpu_device_ids, readpipes, writ
 
         # SUB EPOCH LOOP -----------
         batch_count_this_epoch = 0
+        first_subepoch_idx = 0
+        if resume_cursor is not None:
+            batch_count_this_epoch = resume_cursor["batch_count_this_epoch"]
+            first_subepoch_idx = resume_cursor["subepoch_idx"]
+            if resume_cursor["files"] is not None:
+                logging.info("Resuming subepoch %d at file %d of %d, row %d" % (
+                    first_subepoch_idx, resume_cursor["file_idx"], len(resume_cursor["files"]), resume_cursor["row_offset"]
+                ))
         last_train_stats_time = time.perf_counter()
-        for i in range(sub_epochs):
+        for i in range(first_subepoch_idx, sub_epochs):
 
             if rank == 0:
-                if i != 0:
-                    maybe_reload_training_data()
-                train_files_to_use = get_files_for_subepoch()
-                while train_files_to_use is None or len(train_files_to_use) <= 0:
-                    if quit_if_no_data:
-                        logging.info("Not enough data files to fill a subepoch! Quitting.")
-                        sys.exit(0)
-                    logging.info("Not enough data files to fill a subepoch! Waiting 5m before retrying.")
-                    time.sleep(300)
-                    maybe_reload_training_data()
+                if resume_cursor is not None and resume_cursor["files"] is not None:
+                    train_files_to_use = resume_cursor["files"]
+                else:
+                    if i != 0:
+                        maybe_reload_training_data()
                     train_files_to_use = get_files_for_subepoch()
+                    while train_files_to_use is None or len(train_files_to_use) <= 0:
+                        if quit_if_no_data:
+                            logging.info("Not enough data files to fill a subepoch! Quitting.")
+                            sys.exit(0)
+                        logging.info("Not enough data files to fill a subepoch! Waiting 5m before retrying.")
+                        time.sleep(300)
+                        maybe_reload_training_data()
+                        train_files_to_use = get_files_for_subepoch()
 
                 if barrier is not None:
                     barrier.wait()
@@ -1020,50 +1238,111 @@ def main(rank: int, world_size: int, args, multi_gpu_device_ids, readpipes, writ
             if barrier is not None:
                 barrier.wait()
 
+            symmetry_rand = np.random.default_rng(seed=list(os.urandom(12)))
+            # Every rank loaded the same checkpoint, so they all skip ahead the same way, unless rank 0 picked fresh files
+            # because the cursor's files were gone.
+            # Only rank 0's symmetry rng state is recorded, the other ranks continue with fresh ones.
+            if resume_cursor is not None and train_files_to_use == resume_cursor["files"]:
+                start_file_idx = resume_cursor["file_idx"]
+                start_row = resume_cursor["row_offset"]
+                num_rows_consumed = resume_cursor["num_rows_consumed"]
+                if rank == 0:
+                    symmetry_rand.bit_generator.state = resume_cursor["symmetry_rng_state"]
+            else:
+                start_file_idx = 0
+                start_row = 0
+                num_rows_consumed = 0
+            resume_cursor = None
+
             logging.info("Beginning training subepoch!")
             logging.info("This subepoch, using files: " + str(train_files_to_use))
             logging.info("Currently up to data row " + str(train_state["total_num_data_rows"]))
             lookahead_counter = 0
-            for batch in data_processing_pytorch.read_npz_training_data(
-                train_files_to_use,
-                batch_size,
+            micro_batch_idx = 0
+
+            # Stop the loader after the last whole optimizer step. Micro-batches left over after it would never be stepped,
+            # but would still have counted in the metrics and updated the running statistics of the norms.
+            num_subepoch_rows = sum(
+                data_processing_pytorch.get_num_rows_of_training_file(filename) for filename in train_files_to_use[start_file_idx:]
+            ) - start_row
+            num_subepoch_loader_batches = num_subepoch_rows // (micro_batch_size * world_size)
+            num_subepoch_micro_batches = num_subepoch_loader_batches - num_subepoch_loader_batches % micro_batches
+            if num_subepoch_micro_batches < num_subepoch_loader_batches:
+                logging.info("Skipping the last %d rows of the subepoch, which don't fill a whole optimizer step" % (
+                    (num_subepoch_loader_batches - num_subepoch_micro_batches) * micro_batch_size * world_size
+                ))
+
+            for batch in itertools.islice(data_processing_pytorch.read_npz_training_data(
+                train_files_to_use[start_file_idx:],
+                micro_batch_size,
                 world_size,
                 rank,
                 pos_len=pos_len,
                 device=device,
-                randomize_symmetries=True,
-                model_config=model_config
-            ):
-                optimizer.zero_grad(set_to_none=True)
-                if use_fp16:
-                    with autocast():
-                        model_outputs = ddp_model(batch["binaryInputNCHW"],batch["globalInputNC"])
-                    model_outputs = raw_model.float32ify_output(model_outputs)
+                randomize_symmetries=("row" if per_row_symmetries else "batch"),
+                model_config=model_config,
+                num_prefetch_files=num_prefetch_files,
+                start_row=start_row,
+                rand=symmetry_rand,
+            ), num_subepoch_micro_batches):
+                # Each optimizer step accumulates gradients over micro_batches loader batches of micro_batch_size rows.
+                # Losses are sums over rows, so the accumulated gradient is the same as for a single batch of batch_size.
+                is_first_micro_batch = micro_batch_idx == 0
+                is_last_micro_batch = micro_batch_idx == micro_batches - 1
+                micro_batch_idx = 0 if is_last_micro_batch else micro_batch_idx + 1
+
+                if is_first_micro_batch:
+                    optimizer.zero_grad(set_to_none=True)
+
+                # Only all-reduce gradients across DDP on the last micro-batch of the step
+                with (ddp_model.no_sync() if world_size > 1 and not is_last_micro_batch else contextlib.nullcontext()):
+                    if use_fp16:
+                        with autocast():
+                            model_outputs = ddp_model(batch["binaryInputNCHW"],batch["globalInputNC"],**get_forward_hints(batch))
+                        model_outputs = raw_model.float32ify_output(model_outputs)
+                    else:
+                        model_outputs = ddp_model(batch["binaryInputNCHW"],batch["globalInputNC"],**get_forward_hints(batch))
+
+                    postprocessed = raw_model.postprocess_output(model_outputs)
+                    metrics = metrics_obj.metrics_dict_batchwise(
+                        raw_model,
+                        postprocessed,
+                        batch,
+                        is_training=True,
+                        soft_policy_weight_scale=soft_policy_weight_scale,
+                        value_loss_scale=value_loss_scale,
+                        td_value_loss_scales=td_value_loss_scales,
+                        main_loss_scale=main_loss_scale,
+                        intermediate_loss_scale=intermediate_loss_scale,
+                        moving_update_fraction=1.0 / micro_batches,
+                    )
+
+                    # DDP averages loss across instances, so to preserve LR as per-sample lr, we scale by world size.
+                    loss = metrics["loss_sum"] * world_size
+
+                    if use_fp16:
+                        scaler.scale(loss).backward()
+                    else:
+                        loss.backward()
+
+                # Metrics of this micro-batch. The moving averages decay once per optimizer step.
+                if lookahead_k is not None and lookahead_print:
+                    # Only accumulate metrics when lookahead is synced if lookahead_print is True
+                    metrics_decay = math.exp(-0.001 * lookahead_k) if lookahead_counter == 0 else 1.0
+                    metrics_new_weight = 1.0 if lookahead_counter == 0 else 0.0
                 else:
-                    model_outputs = ddp_model(batch["binaryInputNCHW"],batch["globalInputNC"])
-
-                postprocessed = raw_model.postprocess_output(model_outputs)
-                metrics = metrics_obj.metrics_dict_batchwise(
-                    raw_model,
-                    postprocessed,
-                    batch,
-                    is_training=True,
-                    soft_policy_weight_scale=soft_policy_weight_scale,
-                    value_loss_scale=value_loss_scale,
-                    td_value_loss_scales=td_value_loss_scales,
-                    main_loss_scale=main_loss_scale,
-                    intermediate_loss_scale=intermediate_loss_scale,
-                )
+                    metrics_decay = 0.999
+                    metrics_new_weight = 1.0
+                accumulate_pending_metrics(pending_metrics, detach_metrics(metrics), micro_batch_size, decay=(metrics_decay if is_first_micro_batch else 1.0), new_weight=metrics_new_weight)
 
-                # DDP averages loss across instances, so to preserve LR as per-sample lr, we scale by world size.
-                loss = metrics["loss_sum"] * world_size
+                if not is_last_micro_batch:
+                    continue
+
+                # Metrics of the whole optimizer step
+                metrics = {}
 
-                # Reduce gradients across DDP
                 if use_fp16:
-                    scaler.scale(loss).backward()
                     scaler.unscale_(optimizer)
-                else:
-                    loss.backward()
 
                 if model_config["norm_kind"] == "fixup" or model_config["norm_kind"] == "fixscale" or model_config["norm_kind"] == "fixscaleonenorm":
                     gnorm_cap = 2500.0 * (1.0 if gnorm_clip_scale is None else gnorm_clip_scale)
@@ -1077,21 +1356,21 @@ def main(rank: int, world_size: int, args, multi_gpu_device_ids, readpipes, writ
                     for stat, value in stats.items():
                         metrics[stat] = value
 
-                if "use_repvgg_learning_rate" in model_config and model_config["use_repvgg_learning_rate"]:
-                    gradscale_constant = torch.tensor([[1.0,1.0,1.0],[1.0,2.0,1.0],[1.0,1.0,1.0]],dtype=torch.float32,device=device,requires_grad=False).view(1,1,3,3)
-                    for name, param in ddp_model.named_parameters():
-                        if "normactconv" in name and ".conv.weight" in name and len(param.shape) == 4 and param.shape[2] == 3 and param.shape[3] == 3:
-                            param.grad *= gradscale_constant
+                if len(repvgg_conv_params) > 0:
+                    torch._foreach_mul_([param.grad for param in repvgg_conv_params], repvgg_grad_scales)
 
                 # Loosen gradient clipping as we shift to smaller learning rates
                 gnorm_cap = gnorm_cap / math.sqrt(max(0.0000001,lr_scale * lr_scale_auto_factor(train_state)))
 
-                gnorm = torch.nn.utils.clip_grad_norm_(ddp_model.parameters(), gnorm_cap).detach().cpu().item()
+                gnorm = torch.nn.utils.clip_grad_norm_(ddp_model.parameters(), gnorm_cap).detach()
 
-                if math.isfinite(gnorm) and abs(gnorm < 1e30):
-                    metrics["gnorm_batch"] = gnorm
-                    exgnorm = max(0.0, gnorm - gnorm_cap)
-                    metrics["exgnorm_sum"] = exgnorm * batch_size
+                # Stay on the device, and give gnorm zero weight in the metrics on batches where it isn't finite
+                gnorm_is_finite = torch.isfinite(gnorm) & (gnorm < 1e30)
+                gnorm = torch.where(gnorm_is_finite, gnorm, torch.zeros_like(gnorm))
+                metrics["gnorm_batch"] = gnorm
+                metrics["exgnorm_sum"] = torch.clamp(gnorm - gnorm_cap, min=0.0) * batch_size
+                gnorm_weight_scale = gnorm_is_finite.to(torch.float32)
+                metric_weight_scales = { "gnorm_batch": gnorm_weight_scale, "exgnorm_sum": gnorm_weight_scale }
 
                 metrics["pslr_batch"] = lr_right_now
                 metrics["wdnormal_batch"] = normal_weight_decay_right_now
@@ -1103,22 +1382,18 @@ def main(rank: int, world_size: int, args, multi_gpu_device_ids, readpipes, writ
                     optimizer.step()
 
                 batch_count_this_epoch += 1
+                num_rows_consumed += batch_size * world_size
+                samples_since_last_checkpoint += batch_size * world_size
                 train_state["train_steps_since_last_reload"] += batch_size * world_size
                 train_state["global_step_samples"] += batch_size * world_size
 
-                metrics = detensorify_metrics(metrics)
-
-                if lookahead_k is not None and lookahead_print:
-                    # Only accumulate metrics when lookahead is synced if lookahead_print is True
-                    if lookahead_counter == 0:
-                        accumulate_metrics(running_metrics["sums"], running_metrics["weights"], metrics, batch_size, decay=math.exp(-0.001 * lookahead_k), new_weight=1.0)
-                    else:
-                        accumulate_metrics(running_metrics["sums"], running_metrics["weights"], metrics, batch_size, decay=1.0, new_weight=0.0)
-                else:
-                    accumulate_metrics(running_metrics["sums"], running_metrics["weights"], metrics, batch_size, decay=0.999, new_weight=1.0)
+                metrics = detach_metrics(metrics)
+                accumulate_pending_metrics(pending_metrics, metrics, batch_size, decay=1.0, new_weight=metrics_new_weight, metric_weight_scales=metric_weight_scales)
 
 
                 if batch_count_this_epoch % print_train_loss_every_batches == 0:
+                    flush_pending_metrics(pending_metrics, running_metrics)
+                    metrics = detensorify_metrics(metrics)
 
                     if model_config["norm_kind"] == "brenorm" or model_config["norm_kind"] == "fixbrenorm":
                         metrics["brn_rmax"] = train_state["brenorm_rmax"]
@@ -1151,11 +1426,9 @@ def main(rank: int, world_size: int, args, multi_gpu_device_ids, readpipes, writ
                 if lookahead_k is not None:
                     lookahead_counter += 1
                     if lookahead_counter >= lookahead_k:
-                        for param_group in optimizer.param_groups:
-                            for param in param_group["params"]:
-                                slow_param_data = lookahead_cache[param]
-                                slow_param_data.add_(param.data.detach() - slow_param_data, alpha=lookahead_alpha)
-                                param.data.copy_(slow_param_data)
+                        with torch.no_grad():
+                            torch._foreach_lerp_(lookahead_slow_params, lookahead_fast_params, lookahead_alpha)
+                            torch._foreach_copy_(lookahead_fast_params, lookahead_slow_params)
                         lookahead_counter = 0
                         in_between_lookaheads = False
                     else:
@@ -1170,6 +1443,14 @@ def main(rank: int, world_size: int, args, multi_gpu_device_ids, readpipes, writ
                         logging.info("Accumulating SWA")
                         swa_model.update_parameters(raw_model)
 
+                # Checkpoint partway through the epoch, only when lookahead is in sync since its slow params aren't saved
+                if checkpoint_every_samples is not None and samples_since_last_checkpoint >= checkpoint_every_samples and not in_between_lookaheads:
+                    samples_since_last_checkpoint = 0
+                    flush_pending_metrics(pending_metrics, running_metrics)
+                    train_state["data_cursor"] = make_data_cursor(i, batch_count_this_epoch, train_files_to_use, num_rows_consumed, symmetry_rand) if rank == 0 else None
+                    save(ddp_model, swa_model, optimizer, metrics_obj, running_metrics, train_state, last_val_metrics)
+                    del train_state["data_cursor"]
+
             logging.info("Finished training subepoch!")
 
         # END SUB EPOCH LOOP ------------
@@ -1177,12 +1458,12 @@ def main(rank: int, world_size: int, args, multi_gpu_device_ids, readpipes, writ
         # Discard the gradient updates from the leftover batches in the sub epoch from lookahead.
         # This wastes a very tiny bit, but makes it so that we can be in sync and deterministic on ends of subepochs/epochs.
         if lookahead_k is not None:
-            for param_group in optimizer.param_groups:
-                for param in param_group["params"]:
-                    slow_param_data = lookahead_cache[param]
-                    param.data.copy_(slow_param_data)
+            with torch.no_grad():
+                torch._foreach_copy_(lookahead_fast_params, lookahead_slow_params)
 
+        flush_pending_metrics(pending_metrics, running_metrics)
         save(ddp_model, swa_model, optimizer, metrics_obj, running_metrics, train_state, last_val_metrics)
+        samples_since_last_checkpoint = 0
 
         num_epochs_this_instance += 1
 
@@ -1191,7 +1472,7 @@ def main(rank: int, world_size: int, args, multi_gpu_device_ids, readpipes, writ
             logging.info("Beginning validation after epoch!")
             val_files = []
             if os.path.exists(vdatadir):
-                val_files = [os.path.join(vdatadir,fname) for fname in os.listdir(vdatadir) if fname.endswith(".npz")]
+                val_files = [os.path.join(vdatadir,fname) for fname in os.listdir(vdatadir) if data_processing_pytorch.is_training_data_file(fname)]
             if randomize_val:
                 random.shuffle(val_files)
             else:
@@ -1208,15 +1489,16 @@ def main(rank: int, world_size: int, args, multi_gpu_device_ids, readpipes, writ
                     t0 = time.perf_counter()
                     for batch in data_processing_pytorch.read_npz_training_data(
                         val_files,
-                        batch_size,
+                        micro_batch_size,
                         world_size=1,  # Only the main process validates
                         rank=0,        # Only the main process validates
                         pos_len=pos_len,
                         device=device,
                         randomize_symmetries=True,
-                        model_config=model_config
+                        model_config=model_config,
+                        num_prefetch_files=num_prefetch_files,
                     ):
-                        model_outputs = ddp_model(batch["binaryInputNCHW"],batch["globalInputNC"])
+                        model_outputs = ddp_model(batch["binaryInputNCHW"],batch["globalInputNC"],**get_forward_hints(batch))
                         postprocessed = raw_model.postprocess_output(model_outputs)
                         metrics = metrics_obj.metrics_dict_batchwise(
                             raw_model,
@@ -1230,8 +1512,8 @@ def main(rank: int, world_size: int, args, multi_gpu_device_ids, readpipes, writ
                             intermediate_loss_scale=intermediate_loss_scale,
                         )
                         metrics = detensorify_metrics(metrics)
-                        accumulate_metrics(val_metric_sums, val_metric_weights, metrics, batch_size, decay=1.0, new_weight=1.0)
-                        val_samples += batch_size
+                        accumulate_metrics(val_metric_sums, val_metric_weights, metrics, micro_batch_size, decay=1.0, new_weight=1.0)
+                        val_samples += micro_batch_size
                         if max_val_samples is not None and val_samples > max_val_samples:
                             break
                         val_metric_sums["nsamp_train"] = running_metrics["sums"]["nsamp"]
@@ -1277,7 +1559,7 @@ def main(rank: int, world_size: int, args, multi_gpu_device_ids, readpipes, writ
                 else:
                     os.mkdir(savepathtmp)
                     logging.info("SAVING MODEL FOR EXPORT TO: " + savepath)
-                    save(ddp_model, swa_model, optimizer, metrics_obj, running_metrics, train_state, last_val_metrics, path=os.path.join(savepathtmp,"model.ckpt"))
+                    save(ddp_model, swa_model, optimizer, metrics_obj, running_metrics, train_state, last_val_metrics, path=os.path.join(savepathtmp,"model.ckpt"), wait=True)
                     time.sleep(2)
                     os.rename(savepathtmp,savepath)
 
@@ -1297,6 +1579,9 @@ def main(rank: int, world_size: int, args, multi_gpu_device_ids, readpipes, writ
                 dated_name = datetime.datetime.now(timezone.utc).strftime("%Y%m%d-%H%M%S")
                 save(ddp_model, swa_model, optimizer, metrics_obj, running_metrics, train_state, last_val_metrics, path=os.path.join(longterm_checkpoints_dir,f"{dated_name}.ckpt"))
 
+    if rank == 0:
+        wait_for_checkpoint_write()
+
     train_metrics_out.close()
     val_metrics_out.close()
 